@@ -4,8 +4,16 @@
 from brubeck.request_handling import Brubeck
 from brubeck.connections import Mongrel2Connection
 
-from readify.handlers import APIListDisplayHandler
-from readify.queries import init_db_conn
+from readify.handlers import (APIListDisplayHandler,
+                              APIBulkHandler,
+                              APIImportHandler,
+                              APIExportHandler,
+                              APISyncHandler,
+                              APITagsHandler,
+                              APISearchHandler,
+                              APITokensHandler,
+                              APIMetricsHandler)
+from readify.storage import init_storage
 
 import logging
 
@@ -14,24 +22,46 @@ import logging
 ### Configuration
 ###
 
-# Instantiate database connection
-db_conn = init_db_conn()
-
 # Routing config
 handler_tuples = [
+    (r'^/bulk', APIBulkHandler),
+    (r'^/import', APIImportHandler),
+    (r'^/export', APIExportHandler),
+    (r'^/sync', APISyncHandler),
+    (r'^/tags', APITagsHandler),
+    (r'^/search', APISearchHandler),
+    (r'^/tokens', APITokensHandler),
+    (r'^/metrics', APIMetricsHandler),
     (r'^/', APIListDisplayHandler),
 ]
 
-# Application config
-config = {
-    'msg_conn': Mongrel2Connection('tcp://127.0.0.1:9999', 'tcp://127.0.0.1:9998'),
-    'handler_tuples': handler_tuples,
-    'db_conn': db_conn,
-    'cookie_secret': 'OMGSOOOOOSECRET',
-    'log_level': logging.DEBUG,
-}
+
+def make_app():
+    """Builds the app with its own database and Mongrel2 connections. The
+    supervisor calls this in each worker process.
+    """
+    # Instantiate database connection. Handlers use it through the storage
+    # interface in `readify.storage`. Pooling, timeouts and read routing are
+    # configured in `readify.settings`.
+    db_conn = init_storage()
+
+    # Indexes are applied once here, instead of on every write
+    db_conn.ensure_indexes()
+
+    # Application config
+    config = {
+        'msg_conn': Mongrel2Connection('tcp://127.0.0.1:9999',
+                                       'tcp://127.0.0.1:9998'),
+        'handler_tuples': handler_tuples,
+        'db_conn': db_conn,
+        'cookie_secret': 'OMGSOOOOOSECRET',
+        'log_level': logging.DEBUG,
+    }
+
+    return Brubeck(**config)
 
 
-# Instantiate app instance
-app = Brubeck(**config)
-app.run()
+if __name__ == '__main__':
+    # Instantiate app instance
+    app = make_app()
+    app.run()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+
+from readify.queries import (init_db_conn,
+                             ensure_indexes,
+                             rebuild_all_tag_counts,
+                             backfill_url_hashes,
+                             backfill_changed_at)
+
+import argparse
+import logging
+
+
+###
+### Index Migration
+###
+
+parser = argparse.ArgumentParser(
+    description='Applies the indexes declared in readify.queries')
+parser.add_argument('--force', action='store_true',
+                    help='apply indexes even if the version markers match')
+parser.add_argument('--drop-stale', action='store_true',
+                    help='drop indexes that are no longer declared')
+parser.add_argument('--rebuild-tag-counts', action='store_true',
+                    help='recount every user\'s tags from their items')
+parser.add_argument('--backfill-url-hashes', action='store_true',
+                    help='set the canonical url key on items saved before it')
+parser.add_argument('--backfill-changed-at', action='store_true',
+                    help='set the sync watermark on items saved before it')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+db_conn = init_db_conn()
+applied = ensure_indexes(db_conn, force=args.force,
+                         drop_stale=args.drop_stale)
+
+if applied:
+    for collection in applied:
+        logging.info('Applied indexes for <%s>' % (collection))
+else:
+    logging.info('Indexes are up to date')
+
+if args.rebuild_tag_counts:
+    num_owners = rebuild_all_tag_counts(db_conn)
+    logging.info('Rebuilt tag counts for %d users' % (num_owners))
+
+if args.backfill_url_hashes:
+    num_items = backfill_url_hashes(db_conn)
+    logging.info('Set url hashes on %d items' % (num_items))
+
+if args.backfill_changed_at:
+    num_items = backfill_changed_at(db_conn)
+    logging.info('Set changed_at on %d items' % (num_items))
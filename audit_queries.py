@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+
+from readify.queries import init_db_conn, ensure_indexes
+from readify.audit import (AUDIT_DB_NAME,
+                           seed_listitems,
+                           audit_queries)
+
+import argparse
+import logging
+import sys
+
+
+###
+### Query Plan Audit
+###
+
+parser = argparse.ArgumentParser(
+    description='Seeds a throwaway database and checks the query plan of each '
+                'canonical list query')
+parser.add_argument('--items', type=int, default=5000,
+                    help='number of items to seed for the audited user')
+parser.add_argument('--users', type=int, default=3,
+                    help='number of other users to seed alongside')
+parser.add_argument('--db-name', default=AUDIT_DB_NAME,
+                    help='database to seed; it is dropped first')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+db_conn = init_db_conn(db_name=args.db_name)
+db_conn.connection.drop_database(args.db_name)
+
+# Other users make sure the owner fields have to be selective
+for n in xrange(args.users):
+    seed_listitems(db_conn, 'neighbor%d' % (n), args.items)
+owner_id = seed_listitems(db_conn, 'audited', args.items)
+
+ensure_indexes(db_conn, force=True)
+
+failed = False
+for name, problems in audit_queries(db_conn, owner_id, 'audited'):
+    if problems:
+        failed = True
+        logging.error('%s: %s' % (name, ', '.join(problems)))
+    else:
+        logging.info('%s: ok' % (name))
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+
+from readify.queries import init_db_conn
+from readify.storage import MongoStorage, MemoryStorage
+from readify.benchmark import (BENCHMARK_DB_NAME,
+                               benchmark_cases,
+                               run_benchmarks,
+                               find_regressions)
+
+import argparse
+import json
+import os
+import sys
+
+
+###
+### Request Benchmarks
+###
+
+parser = argparse.ArgumentParser(
+    description='Seeds a user with synthetic links at each size and measures '
+                'the request hot paths against them')
+parser.add_argument('--sizes', default='100,1000,10000,100000',
+                    help='comma separated numbers of items to seed')
+parser.add_argument('--cases', nargs='+',
+                    choices=[name for (name, case) in benchmark_cases],
+                    help='cases to run, defaults to all of them')
+parser.add_argument('--requests', type=int, default=200,
+                    help='timed requests per case')
+parser.add_argument('--warmup', type=int, default=20,
+                    help='untimed requests per case, made first')
+parser.add_argument('--mongo', action='store_true',
+                    help='use MongoDB instead of the in-memory storage')
+parser.add_argument('--db-name', default=BENCHMARK_DB_NAME,
+                    help='database to seed with --mongo; it is dropped first')
+parser.add_argument('--baseline', default='benchmark_baseline.json',
+                    help='results to compare against, if the file exists')
+parser.add_argument('--save-baseline', action='store_true',
+                    help='write the results to the baseline file')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='allowed growth in latency and objects, as a fraction')
+args = parser.parse_args()
+
+sizes = [int(size) for size in args.sizes.split(',')]
+
+
+def make_storage():
+    if not args.mongo:
+        return MemoryStorage()
+    db_conn = init_db_conn(db_name=args.db_name)
+    db_conn.connection.drop_database(args.db_name)
+    storage = MongoStorage(db_conn)
+    storage.ensure_indexes(force=True)
+    return storage
+
+
+results = run_benchmarks(make_storage, sizes, case_names=args.cases,
+                         num_requests=args.requests, warmup=args.warmup)
+
+print '%8s %-18s %9s %9s %9s %9s %9s %7s' % ('items', 'case', 'p50 ms',
+                                            'p90 ms', 'p99 ms', 'max ms',
+                                            'objects', 'calls')
+for size in sizes:
+    for (name, case) in benchmark_cases:
+        metrics = results[str(size)].get(name)
+        if metrics is None:
+            continue
+        print '%8d %-18s %9.2f %9.2f %9.2f %9.2f %9.1f %7.1f' % (
+            size, name, metrics['p50'], metrics['p90'], metrics['p99'],
+            metrics['max'], metrics['objects'], metrics['storage_calls'])
+
+if args.save_baseline:
+    with open(args.baseline, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+    print 'Saved baseline to %s' % (args.baseline)
+    sys.exit(0)
+
+if not os.path.exists(args.baseline):
+    sys.exit(0)
+
+with open(args.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+
+regressions = find_regressions(results, baseline, tolerance=args.tolerance)
+for (size, name, metric, expected, value) in regressions:
+    print 'REGRESSION %s items %s: %s %.2f -> %.2f' % (size, name, metric,
+                                                       expected, value)
+
+sys.exit(1 if regressions else 0)
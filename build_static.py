@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+
+from readify.assets import build_assets, STATIC_DIR
+
+import argparse
+import logging
+
+
+###
+### Static Asset Build
+###
+
+parser = argparse.ArgumentParser(
+    description='Minifies, fingerprints and precompresses the static assets '
+                'into the build directory')
+parser.add_argument('--static-dir', default=STATIC_DIR,
+                    help='directory with the css and img directories')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+manifest = build_assets(static_dir=args.static_dir)
+for source in sorted(manifest):
+    logging.info('Built <%s> as <%s>' % (source, manifest[source]))
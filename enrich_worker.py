@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+
+from readify.storage import init_storage
+from readify.enrichment import EnrichmentPool
+
+import argparse
+import logging
+import signal
+import time
+
+
+###
+### Link Enrichment Workers
+###
+
+parser = argparse.ArgumentParser(
+    description='Fetches titles and descriptions for newly saved links')
+parser.add_argument('--workers', type=int, default=8,
+                    help='number of concurrent fetches')
+parser.add_argument('--host-interval', type=float, default=1.0,
+                    help='minimum seconds between requests to one host')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+storage = init_storage()
+pool = EnrichmentPool(storage, num_workers=args.workers,
+                      host_interval=args.host_interval)
+
+stopping = []
+def stop(signum, frame):
+    stopping.append(signum)
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+pool.start()
+logging.info('Started %d enrichment workers' % (args.workers))
+while not stopping:
+    time.sleep(1)
+
+logging.info('Stopping enrichment workers')
+pool.stop()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+
+from readify.queries import init_db_conn
+from readify.storage import MongoStorage
+from readify.exporter import export_formats, export_chunks
+
+import argparse
+import logging
+import sys
+
+
+###
+### Link Export
+###
+
+parser = argparse.ArgumentParser(
+    description='Exports a user\'s full list of links')
+parser.add_argument('username')
+parser.add_argument('--format', choices=export_formats.keys(), default='jsonl')
+parser.add_argument('--since', type=int,
+                    help='only export items changed at or after this time, '
+                         'in milliseconds, to resume an export')
+parser.add_argument('--output', help='file to write, defaults to stdout')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+storage = MongoStorage(init_db_conn())
+user = storage.load_user(username=args.username)
+if user is None:
+    logging.error('No such user: %s' % (args.username))
+    sys.exit(1)
+
+if args.output:
+    output = open(args.output, 'wb')
+else:
+    output = sys.stdout
+
+for chunk in export_chunks(storage, user.id, args.format, since=args.since):
+    output.write(chunk)
+output.flush()
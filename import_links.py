@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+
+from readify.queries import init_db_conn
+from readify.storage import MongoStorage
+from readify.importer import row_parsers, import_rows
+
+import argparse
+import logging
+import sys
+
+
+###
+### Bulk Link Import
+###
+
+parser = argparse.ArgumentParser(
+    description='Imports a bookmark file or JSON lines file into a user\'s list')
+parser.add_argument('username')
+parser.add_argument('path', help='file to import, or - for stdin')
+parser.add_argument('--format', choices=row_parsers.keys(),
+                    help='defaults to jsonl for .jsonl files, otherwise html')
+parser.add_argument('--batch-size', type=int, default=500)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+storage = MongoStorage(init_db_conn())
+user = storage.load_user(username=args.username)
+if user is None:
+    logging.error('No such user: %s' % (args.username))
+    sys.exit(1)
+
+file_format = args.format
+if file_format is None:
+    file_format = 'jsonl' if args.path.endswith('.jsonl') else 'html'
+
+if args.path == '-':
+    stream = sys.stdin
+else:
+    stream = open(args.path, 'rb')
+
+def progress(report):
+    logging.info('%d imported, %d duplicates, %d rejected, %.0f items/sec'
+                 % (report['imported'], report['duplicates'],
+                    len(report['rejected']), report['rate']))
+
+rows = row_parsers[file_format](stream)
+report = import_rows(storage, user, rows, batch_size=args.batch_size,
+                     progress=progress)
+
+for (row_number, reason) in report['rejected']:
+    logging.warning('Rejected row %d: %s' % (row_number, reason))
+logging.info('Imported %d items in %.2fs (%.0f items/sec), skipped %d '
+             'duplicates, rejected %d'
+             % (report['imported'], report['elapsed'], report['rate'],
+                report['duplicates'], len(report['rejected'])))
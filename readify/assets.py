@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import gzip
+import shutil
+import posixpath
+from hashlib import md5
+from cStringIO import StringIO
+
+from brubeck import templating
+
+
+###
+### Static Asset Builds
+###
+
+STATIC_DIR = './static'
+
+# Built assets go under the static directory, so Mongrel2 serves them with
+# the rest. Their names change with their content, so they can be cached
+# forever.
+BUILD_DIR = 'build'
+MANIFEST_FILE = 'manifest.json'
+
+# Directories of the static directory that are built
+asset_dirs = ['img', 'css']
+
+# Types that are minified or precompressed. Images are already compressed.
+minified_types = ['.css']
+precompressed_types = ['.css', '.js', '.svg', '.txt']
+
+FINGERPRINT_LENGTH = 12
+
+
+def minify_css(css):
+    """Strips comments and the whitespace that doesn't change how a
+    stylesheet is read.
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    # Whitespace around `:` is only removed inside declaration blocks. In a
+    # selector, `div :first-child` and `div:first-child` differ.
+    css = re.sub(r'(?<=[{;])[^{};]*(?=[;}])',
+                 lambda m: re.sub(r'\s*:\s*', ':', m.group(0)), css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def fingerprint(path, content):
+    """Adds a hash of `content` to the file name in `path`, eg.
+    `css/style.css` becomes `css/style.0123456789ab.css`.
+    """
+    (base, ext) = posixpath.splitext(path)
+    digest = md5(content).hexdigest()[:FINGERPRINT_LENGTH]
+    return '%s.%s%s' % (base, digest, ext)
+
+
+def rewrite_css_urls(css, css_path, manifest):
+    """Points the `url()`s in a stylesheet at the built versions of the
+    assets they name. `css_path` and the manifest's keys are relative to the
+    static directory. The URLs are made relative to where the stylesheet is
+    built.
+    """
+    css_dir = posixpath.dirname(css_path)
+    built_dir = posixpath.join(BUILD_DIR, css_dir)
+
+    def rewrite(match):
+        url = match.group(2)
+        if ':' in url or url.startswith('/'):
+            return match.group(0)
+        source = posixpath.normpath(posixpath.join(css_dir, url))
+        if source not in manifest:
+            return match.group(0)
+        built = posixpath.relpath(manifest[source], built_dir)
+        return 'url(%s%s%s)' % (match.group(1), built, match.group(1))
+
+    return re.sub(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''', rewrite, css)
+
+
+def gzip_file(path, content):
+    """Writes `content` gzipped next to `path`, with a fixed timestamp so
+    the same content always builds the same file.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0) as gz:
+        gz.write(content)
+    with open('%s.gz' % (path), 'wb') as gz_file:
+        gz_file.write(buf.getvalue())
+
+
+def build_assets(static_dir=STATIC_DIR, dirs=asset_dirs):
+    """Builds every file in `dirs` of the static directory into its build
+    directory. Stylesheets are minified and have their `url()`s rewritten.
+    Each file gets a fingerprinted name and text files get a gzipped copy
+    alongside, for servers that send precompressed files.
+
+    Stylesheets are built last, so the images they use are in the manifest.
+    The manifest maps each source path to its built path, both relative to
+    the static directory, and is written to the build directory. The
+    previous build is replaced.
+
+    Returns the manifest.
+    """
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+
+    sources = []
+    for asset_dir in dirs:
+        for (dirpath, dirnames, filenames) in os.walk(
+                os.path.join(static_dir, asset_dir)):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(dirpath, filename),
+                                       static_dir)
+                sources.append(path.replace(os.sep, '/'))
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = dict()
+    for source in sources:
+        with open(os.path.join(static_dir, source), 'rb') as source_file:
+            content = source_file.read()
+
+        ext = posixpath.splitext(source)[1].lower()
+        if ext == '.css':
+            content = rewrite_css_urls(content, source, manifest)
+        if ext in minified_types:
+            content = minify_css(content)
+
+        built = posixpath.join(BUILD_DIR, fingerprint(source, content))
+        built_path = os.path.join(static_dir, built)
+        if not os.path.isdir(os.path.dirname(built_path)):
+            os.makedirs(os.path.dirname(built_path))
+        with open(built_path, 'wb') as built_file:
+            built_file.write(content)
+        if ext in precompressed_types:
+            gzip_file(built_path, content)
+
+        manifest[source] = built
+
+    with open(os.path.join(build_dir, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+###
+### Templates
+###
+
+def load_manifest(static_dir=STATIC_DIR):
+    """Loads the manifest of the last build, or an empty one if the assets
+    haven't been built.
+    """
+    path = os.path.join(static_dir, BUILD_DIR, MANIFEST_FILE)
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except IOError:
+        return dict()
+
+
+def static_url_for(manifest, url_prefix='/static/'):
+    """Returns the `static_url` function for templates. It maps a source
+    path like `css/style.css` to the URL of its built version, or of the
+    source itself if it hasn't been built.
+    """
+    def static_url(path):
+        return '%s%s' % (url_prefix, manifest.get(path, path))
+    return static_url
+
+
+def load_jinja2_env(template_dir, static_dir=STATIC_DIR, *args, **kwargs):
+    """Like `brubeck.templating.load_jinja2_env`, with `static_url` available
+    in templates. The manifest is read when the environment is loaded, so
+    new builds are picked up when the workers are reloaded.
+    """
+    loader = templating.load_jinja2_env(template_dir, *args, **kwargs)
+
+    def asset_loader():
+        env = loader()
+        if env is not None:
+            manifest = load_manifest(static_dir)
+            env.globals['static_url'] = static_url_for(manifest)
+        return env
+    return asset_loader
@@ -0,0 +1,135 @@
+import random
+import time
+import bson
+
+from models import ListItem
+from queries import (LISTITEM_COLLECTION,
+                     load_listitems)
+
+
+###
+### Dataset Seeding
+###
+
+AUDIT_DB_NAME = 'readify_audit'
+
+seed_tags = ['python', 'mongodb', 'news', 'music', 'design', 'science',
+             'recipes', 'travel', 'video', 'longform']
+
+
+def seed_listitems(db, username, num_items, batch_size=1000):
+    """Inserts `num_items` synthetic list items for `username` and returns the
+    generated owner id.
+
+    Items get a spread of `updated_at` values, tags and liked / archived /
+    deleted flags so every list view has something to match.
+    """
+    owner_id = bson.objectid.ObjectId()
+    now = int(time.time() * 1000)
+
+    batch = []
+    for n in xrange(num_items):
+        updated_at = now - random.randint(0, 1000 * 60 * 60 * 24 * 365)
+        item = ListItem(owner_id=owner_id,
+                        owner_username=username,
+                        created_at=updated_at,
+                        updated_at=updated_at,
+                        url='http://example.com/%s/%d' % (username, n),
+                        title='Synthetic link %d' % (n),
+                        tags=random.sample(seed_tags, random.randint(0, 3)),
+                        liked=random.random() < 0.2,
+                        archived=random.random() < 0.5,
+                        deleted=random.random() < 0.05)
+        item_doc = item.to_python()
+        item_doc.pop('_id', None)
+        batch.append(item_doc)
+
+        if len(batch) >= batch_size:
+            db[LISTITEM_COLLECTION].insert(batch)
+            batch = []
+
+    if batch:
+        db[LISTITEM_COLLECTION].insert(batch)
+
+    return owner_id
+
+
+###
+### Canonical Queries
+###
+
+def canonical_queries(owner_id, username):
+    """The `load_listitems` calls made by each list handler, keyed by a name
+    that describes the handler.
+    """
+    since = int(time.time() * 1000) - (1000 * 60 * 60 * 24 * 30)
+    return [
+        ('dashboard', {'owner_id': owner_id}),
+        ('dashboard_tagged', {'owner_id': owner_id, 'tags': ['python']}),
+        ('archived', {'owner_id': owner_id, 'archived': True}),
+        ('archived_tagged', {'owner_id': owner_id, 'archived': True,
+                             'tags': ['news']}),
+        ('liked', {'owner_id': owner_id, 'liked': True, 'archived': None}),
+        ('liked_tagged', {'owner_id': owner_id, 'liked': True,
+                          'archived': None, 'tags': ['music']}),
+        ('profile', {'owner_username': username, 'archived': None}),
+        ('api', {'owner_id': owner_id}),
+        ('api_stream', {'owner_id': owner_id, 'updated_after': since}),
+        ('api_keyset', {'owner_id': owner_id,
+                        'before': (since, bson.objectid.ObjectId())}),
+    ]
+
+
+###
+### Plan Inspection
+###
+
+def _plan_stages(plan):
+    """Yields every stage name in a `queryPlanner` plan tree.
+    """
+    if 'stage' in plan:
+        yield plan['stage']
+    if 'inputStage' in plan:
+        for stage in _plan_stages(plan['inputStage']):
+            yield stage
+    for input_stage in plan.get('inputStages', []):
+        for stage in _plan_stages(input_stage):
+            yield stage
+
+
+def explain_problems(explanation):
+    """Returns a list of problems found in the output of `cursor.explain()`.
+
+    Handles both the `queryPlanner` format and the older `cursor` /
+    `scanAndOrder` format.
+    """
+    problems = []
+
+    if 'queryPlanner' in explanation:
+        stages = list(_plan_stages(explanation['queryPlanner']['winningPlan']))
+        if 'COLLSCAN' in stages:
+            problems.append('collection scan')
+        if 'SORT' in stages:
+            problems.append('in-memory sort')
+    else:
+        clauses = explanation.get('clauses', [explanation])
+        for clause in clauses:
+            if clause.get('cursor', '').startswith('BasicCursor'):
+                problems.append('collection scan')
+            if clause.get('scanAndOrder'):
+                problems.append('in-memory sort')
+
+    return problems
+
+
+def audit_queries(db, owner_id, username):
+    """Runs `explain()` for each canonical query and returns a list of
+    `(name, problems)` tuples.
+    """
+    results = []
+    for name, query_args in canonical_queries(owner_id, username):
+        query_set = load_listitems(db, **query_args)
+        problems = explain_problems(query_set.explain())
+        results.append((name, problems))
+
+    return results
@@ -0,0 +1,382 @@
+import gc
+import json
+import time
+import logging
+import random
+import urllib
+import Cookie
+import itertools
+
+from brubeck.request_handling import Brubeck, cookie_encode
+from brubeck.request import Request
+from brubeck.connections import Connection
+
+from models import User, ListItem
+from handlers import (DashboardDisplayHandler,
+                      ItemAddHandler,
+                      APIListDisplayHandler,
+                      page_cache)
+from audit import seed_tags
+from assets import load_jinja2_env
+
+
+###
+### Dataset Seeding
+###
+
+BENCHMARK_DB_NAME = 'readify_benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+BENCHMARK_SECRET = 'benchmark secret'
+
+
+def seed_user(storage, username, num_items, batch_size=1000):
+    """Creates `username` with `num_items` synthetic list items and returns
+    the loaded user.
+
+    Items are generated from a random number generator seeded by
+    `num_items`, so each size produces the same dataset on every run.
+    """
+    user = User.create_user(username, BENCHMARK_PASSWORD)
+    user.validate()
+    storage.save_user(user)
+    user = storage.load_user(username=username)
+
+    rand = random.Random(num_items)
+    now = int(time.time() * 1000)
+
+    batch = []
+    for n in xrange(num_items):
+        updated_at = now - rand.randint(0, 1000 * 60 * 60 * 24 * 365)
+        item = ListItem(owner_id=user.id,
+                        owner_username=user.username,
+                        created_at=updated_at,
+                        updated_at=updated_at,
+                        url='http://example.com/%s/%d' % (username, n),
+                        title='Synthetic link %d' % (n),
+                        tags=rand.sample(seed_tags, rand.randint(0, 3)),
+                        liked=rand.random() < 0.2,
+                        archived=rand.random() < 0.5,
+                        deleted=rand.random() < 0.05)
+        batch.append(item)
+
+        if len(batch) >= batch_size:
+            storage.insert_listitems(user.id, batch)
+            batch = []
+
+    if batch:
+        storage.insert_listitems(user.id, batch)
+
+    return user
+
+
+###
+### Request Driving
+###
+
+class CountingStorage(object):
+    """Wraps a `readify.storage` engine and counts the calls made through it.
+    Each call costs at least one round trip with `MongoStorage`.
+    """
+    def __init__(self, storage, counter=None):
+        self.storage = storage
+        self.counter = counter or self
+        self.calls = 0
+
+    def with_secondary_reads(self):
+        # Calls through the engine for a read-only request are counted here
+        return CountingStorage(self.storage.with_secondary_reads(),
+                               counter=self.counter)
+
+    def end_request(self):
+        # Returns sockets to the pool without a round trip
+        return self.storage.end_request()
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.counter.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class BenchmarkConnection(Connection):
+    """Stands in for Mongrel2. Replies are kept in `replies` instead of being
+    sent, for handlers that stream their response.
+    """
+    def __init__(self):
+        Connection.__init__(self)
+        self.replies = []
+
+    def reply(self, req, msg):
+        self.replies.append(msg)
+
+
+def build_message(method, path, arguments=None, cookie=None, headers=None,
+                  conn_id=0):
+    """Builds a request in the format Mongrel2 sends over ZeroMQ, so it goes
+    through the same parsing as a live request.
+    """
+    query = urllib.urlencode(arguments or [])
+    headers = dict(headers or {})
+    headers.update({
+        'METHOD': method,
+        'PATH': path,
+        'VERSION': 'HTTP/1.1',
+        'x-forwarded-for': '127.0.0.1',
+    })
+
+    body = ''
+    if method == 'POST':
+        headers['content-type'] = 'application/x-www-form-urlencoded'
+        body = query
+    elif query:
+        headers['QUERY'] = query
+    if cookie:
+        headers['cookie'] = cookie
+
+    headers = json.dumps(headers)
+    return '%s %d %s %d:%s,%d:%s,' % ('benchmark', conn_id, path,
+                                      len(headers), headers, len(body), body)
+
+
+def auth_cookie(username, secret=BENCHMARK_SECRET):
+    """The signed `user_id` cookie set by `AccountLoginHandler`.
+    """
+    cookie = Cookie.SimpleCookie()
+    cookie['user_id'] = cookie_encode(('user_id', username), secret)
+    return cookie['user_id'].OutputString()
+
+
+web_handler_tuples = [
+    (r'^/add_item', ItemAddHandler),
+    (r'^/$', DashboardDisplayHandler),
+]
+
+api_handler_tuples = [
+    (r'^/', APIListDisplayHandler),
+]
+
+
+class Benchmark(object):
+    """A web app and an API app wired to `storage` and a seeded user with
+    `num_items` items, ready to handle requests without Mongrel2.
+    """
+    def __init__(self, storage, num_items, username='bench',
+                 template_dir='./templates'):
+        self.user = seed_user(storage, username, num_items)
+        self.cookie = auth_cookie(self.user.username)
+        self.storage = CountingStorage(storage)
+        self.msg_conn = BenchmarkConnection()
+        self.counter = itertools.count()
+
+        app_config = {
+            'msg_conn': self.msg_conn,
+            'db_conn': self.storage,
+            'cookie_secret': BENCHMARK_SECRET,
+            'login_url': '/login',
+            'log_level': logging.WARNING,
+        }
+        self.web_app = Brubeck(handler_tuples=web_handler_tuples,
+                               template_loader=load_jinja2_env(template_dir),
+                               **app_config)
+        self.api_app = Brubeck(handler_tuples=api_handler_tuples,
+                               **app_config)
+
+    def route(self, app, method, path, arguments=None, headers=None):
+        """Parses a request from the benchmark user and returns the handler
+        that would process it.
+        """
+        message = build_message(method, path, arguments=arguments,
+                                cookie=self.cookie, headers=headers)
+        request = Request.parse_msg(message)
+        return app.route_message(request)
+
+    def handle(self, app, method, path, arguments=None, headers=None):
+        """Handles a request from the benchmark user and returns the
+        response, as it would be sent to Mongrel2.
+        """
+        handler = self.route(app, method, path, arguments=arguments,
+                             headers=headers)
+        return handler()
+
+
+###
+### Cases
+###
+
+# Each case makes one request and is named after the hot path it measures
+
+def case_current_user(bench):
+    handler = bench.route(bench.web_app, 'GET', '/')
+    return handler.get_current_user()
+
+
+def case_dashboard(bench):
+    # Every request misses `page_cache`, so items are loaded and rendered
+    page_cache.clear()
+    return bench.handle(bench.web_app, 'GET', '/')
+
+
+def case_dashboard_cached(bench):
+    return bench.handle(bench.web_app, 'GET', '/')
+
+
+def case_dashboard_gzip(bench):
+    # A browser that accepts gzip, which is how most pages are served
+    return bench.handle(bench.web_app, 'GET', '/',
+                        headers={'accept-encoding': 'gzip, deflate'})
+
+
+def case_api_list(bench):
+    return bench.handle(bench.api_app, 'GET', '/', [('count', 25)])
+
+
+def case_api_list_unchanged(bench):
+    # A client polling with the ETag of its last response
+    etag = getattr(bench, 'api_list_etag', None)
+    if etag is None:
+        handler = bench.route(bench.api_app, 'GET', '/', [('count', 25)])
+        handler()
+        etag = bench.api_list_etag = handler.headers['ETag']
+    return bench.handle(bench.api_app, 'GET', '/', [('count', 25)],
+                        headers={'if-none-match': etag})
+
+
+def case_add_item(bench):
+    url = 'http://example.com/added/%d' % (bench.counter.next())
+    arguments = [('url', url), ('title', 'Added link'), ('tags', 'news')]
+    return bench.handle(bench.web_app, 'POST', '/add_item', arguments)
+
+
+benchmark_cases = [
+    ('current_user', case_current_user),
+    ('dashboard', case_dashboard),
+    ('dashboard_cached', case_dashboard_cached),
+    ('dashboard_gzip', case_dashboard_gzip),
+    ('api_list', case_api_list),
+    ('api_list_unchanged', case_api_list_unchanged),
+    ('add_item', case_add_item),
+]
+
+
+###
+### Measurement
+###
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list.
+    """
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def run_case(bench, case, num_requests=200, warmup=20):
+    """Times `num_requests` calls of `case` after `warmup` untimed ones.
+
+    Returns a dict with latency percentiles in milliseconds, the mean number
+    of objects each request leaves for the garbage collector and the mean
+    number of storage calls per request.
+
+    The collector is disabled while a request runs and the growth of its
+    youngest generation is recorded, which counts the container objects
+    allocated and not yet freed. It runs between requests, untimed.
+    """
+    for n in xrange(warmup):
+        case(bench)
+
+    latencies = []
+    objects = 0
+    storage_calls = 0
+
+    gc.collect()
+    gc.disable()
+    try:
+        for n in xrange(num_requests):
+            bench.storage.calls = 0
+            allocated = gc.get_count()[0]
+            started = time.time()
+
+            case(bench)
+
+            latencies.append((time.time() - started) * 1000)
+            objects += gc.get_count()[0] - allocated
+            storage_calls += bench.storage.calls
+            gc.collect()
+    finally:
+        gc.enable()
+
+    latencies.sort()
+    return {
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1],
+        'objects': float(objects) / num_requests,
+        'storage_calls': float(storage_calls) / num_requests,
+    }
+
+
+def run_benchmarks(make_storage, sizes, case_names=None, num_requests=200,
+                   warmup=20, template_dir='./templates'):
+    """Runs each case against a fresh storage engine, returned by
+    `make_storage`, for each number of items in `sizes`.
+
+    Returns results keyed by size, as a string so they survive a round trip
+    through JSON, then by case name.
+    """
+    results = dict()
+    for size in sizes:
+        storage = make_storage()
+        bench = Benchmark(storage, size, username='bench%d' % (size),
+                          template_dir=template_dir)
+
+        size_results = dict()
+        for (name, case) in benchmark_cases:
+            if case_names and name not in case_names:
+                continue
+            size_results[name] = run_case(bench, case,
+                                          num_requests=num_requests,
+                                          warmup=warmup)
+        results[str(size)] = size_results
+
+    return results
+
+
+###
+### Baselines
+###
+
+# Latencies and object counts vary between runs, so they're allowed to grow
+# by a tolerance. Storage calls don't, so any increase is a regression.
+tolerant_metrics = ['p50', 'p90', 'objects']
+strict_metrics = ['storage_calls']
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """Compares `results` to a baseline produced by `run_benchmarks`.
+
+    Returns a list of `(size, case, metric, baseline value, value)` tuples
+    for each metric that got worse. Sizes and cases missing from either side
+    are skipped.
+    """
+    regressions = []
+    for (size, size_results) in sorted(results.items()):
+        for (name, metrics) in sorted(size_results.items()):
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+
+            for metric in tolerant_metrics + strict_metrics:
+                if metric not in expected:
+                    continue
+                allowed = expected[metric]
+                if metric in tolerant_metrics:
+                    allowed = allowed * (1 + tolerance)
+                if metrics[metric] > allowed:
+                    regressions.append((size, name, metric, expected[metric],
+                                        metrics[metric]))
+
+    return regressions
@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+
+###
+### Process-local Caching
+###
+
+class TTLCache(object):
+    """A small LRU cache where entries also expire after `ttl` seconds.
+
+    The cache is local to the process, so anything that changes cached data
+    must call `delete` for it. The TTL bounds how long other processes can
+    serve stale entries.
+    """
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns the value stored for `key`, or `default` if it's missing or
+        has expired.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+
+        (expires, value) = entry
+        if expires < time.time():
+            return default
+
+        # Reinsert to mark it as the most recently used
+        self._entries[key] = entry
+        return value
+
+    def set(self, key, value):
+        """Stores `value` for `key`, evicting the least recently used entry if
+        the cache is full.
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, value)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
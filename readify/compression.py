@@ -0,0 +1,111 @@
+import zlib
+
+
+###
+### Response Compression
+###
+
+# Content types worth compressing. Responses without a Content-Type are HTML
+# rendered by `WebMessageHandler`.
+compressible_types = frozenset([
+    'text/html',
+    'text/plain',
+    'text/css',
+    'text/csv',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+])
+
+
+def accepts_gzip(accept_encoding):
+    """Reads an `Accept-Encoding` header. Returns True if it allows gzip,
+    either by name or with `*`, without a `q=0`.
+    """
+    if not accept_encoding:
+        return False
+
+    allowed = dict()
+    for coding in accept_encoding.split(','):
+        params = coding.strip().split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            (key, _, value) = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        allowed[name] = q
+
+    if 'gzip' in allowed:
+        return allowed['gzip'] > 0
+    return allowed.get('*', 0) > 0
+
+
+def gzip_bytes(data, level=6):
+    """Compresses `data` in the gzip format with a single zlib call, which
+    is cheaper than going through `gzip.GzipFile`.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_response(response, accept_encoding, min_size=1024, level=6):
+    """Gzips the body of a rendered HTTP response if the client accepts gzip
+    and the response is a 200 with a compressible body of at least
+    `min_size` bytes. Content-Length is updated and `Accept-Encoding` is
+    added to Vary.
+
+    Anything else, including streamed responses, which are rendered empty,
+    is returned unchanged.
+    """
+    if not response or not accepts_gzip(accept_encoding):
+        return response
+    if isinstance(response, unicode):
+        response = response.encode('utf-8')
+
+    (head, _, body) = response.partition('\r\n\r\n')
+    if len(body) < min_size:
+        return response
+
+    lines = head.split('\r\n')
+    status = lines[0].split(' ', 2)
+    if len(status) < 2 or status[1] != '200':
+        return response
+
+    headers = []
+    vary = None
+    for line in lines[1:]:
+        (name, _, value) = line.partition(': ')
+        name = name.lower()
+        if name == 'content-encoding':
+            return response
+        elif name == 'content-type':
+            if value.split(';')[0].strip().lower() not in compressible_types:
+                return response
+        elif name == 'vary':
+            vary = value
+            continue
+        elif name == 'content-length':
+            continue
+        headers.append(line)
+
+    compressed = gzip_bytes(body, level)
+    if len(compressed) >= len(body):
+        return response
+
+    if vary:
+        vary = '%s, Accept-Encoding' % (vary)
+    else:
+        vary = 'Accept-Encoding'
+    headers.extend([
+        'Content-Length: %d' % (len(compressed)),
+        'Content-Encoding: gzip',
+        'Vary: %s' % (vary),
+    ])
+
+    return '%s\r\n%s\r\n\r\n%s' % (lines[0], '\r\n'.join(headers),
+                                   compressed)
@@ -0,0 +1,419 @@
+import time
+import socket
+import httplib
+import logging
+import binascii
+import urllib2
+import urlparse
+import functools
+import threading
+from HTMLParser import HTMLParser, HTMLParseError
+
+from queries import current_millis
+from urls import normalize_url, url_host, url_hash
+
+
+###
+### Fetching Safely
+###
+
+# Pages are fetched from URLs users give us, so a fetch must not be able to
+# reach this host, its private network or a cloud metadata service. Hosts are
+# resolved before connecting and the connection is made to the address that
+# was checked, so a name can't resolve to a public address for the check and
+# a private one for the connection.
+
+class UnsafeURLError(ValueError):
+    """Raised for URLs that aren't http(s) or that reach a private address.
+    """
+    pass
+
+
+fetched_schemes = ('http', 'https')
+
+
+def address_number(address):
+    """Returns the family of an IPv4 or IPv6 address and the address as an
+    integer.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    return (family, int(binascii.hexlify(packed), 16))
+
+
+def parse_network(network):
+    """Turns a network like `10.0.0.0/8` into its family, prefix and the
+    number of bits after the prefix.
+    """
+    (address, prefix_len) = network.split('/')
+    (family, number) = address_number(address)
+    host_bits = (32 if family == socket.AF_INET else 128) - int(prefix_len)
+    return (family, number >> host_bits, host_bits)
+
+
+# Loopback, link-local (which has the metadata services at 169.254.169.254),
+# RFC 1918 and the other ranges that aren't the public internet
+private_networks = [parse_network(network) for network in [
+    '0.0.0.0/8',
+    '10.0.0.0/8',
+    '100.64.0.0/10',
+    '127.0.0.0/8',
+    '169.254.0.0/16',
+    '172.16.0.0/12',
+    '192.0.0.0/24',
+    '192.168.0.0/16',
+    '198.18.0.0/15',
+    '224.0.0.0/4',
+    '240.0.0.0/4',
+    '::/128',
+    '::1/128',
+    'fc00::/7',
+    'fe80::/10',
+    'ff00::/8',
+]]
+
+
+def is_public_address(address):
+    """Returns True if `address` is on the public internet. IPv4 addresses
+    mapped into IPv6 are checked as IPv4.
+    """
+    (family, number) = address_number(address.split('%')[0])
+    if family == socket.AF_INET6 and number >> 32 == 0xffff:
+        (family, number) = (socket.AF_INET, number & 0xffffffff)
+
+    for (network_family, prefix, host_bits) in private_networks:
+        if family == network_family and number >> host_bits == prefix:
+            return False
+    return True
+
+
+def create_checked_connection(address, timeout, source_address=None,
+                              is_allowed=is_public_address):
+    """Like `socket.create_connection`, but only connects to the addresses
+    `host` resolves to that `is_allowed` accepts. Raises `UnsafeURLError` if
+    it accepts none of them.
+    """
+    (host, port) = address
+    refused = None
+    error = None
+    for (family, socktype, proto, canonname, sockaddr) in \
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        if not is_allowed(sockaddr[0]):
+            refused = sockaddr[0]
+            continue
+
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except socket.error, e:
+            error = e
+            if sock is not None:
+                sock.close()
+
+    if error is not None:
+        raise error
+    raise UnsafeURLError('%s resolves to %s' % (host, refused))
+
+
+class CheckedHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, host, is_allowed=is_public_address, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self._create_connection = functools.partial(
+            create_checked_connection, is_allowed=is_allowed)
+
+
+class CheckedHTTPSConnection(httplib.HTTPSConnection):
+    def __init__(self, host, is_allowed=is_public_address, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self._create_connection = functools.partial(
+            create_checked_connection, is_allowed=is_allowed)
+
+
+class CheckedHTTPHandler(urllib2.HTTPHandler):
+    def __init__(self, is_allowed=is_public_address):
+        urllib2.HTTPHandler.__init__(self)
+        self.is_allowed = is_allowed
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(CheckedHTTPConnection,
+                                              is_allowed=self.is_allowed),
+                            req)
+
+
+class CheckedHTTPSHandler(urllib2.HTTPSHandler):
+    def __init__(self, is_allowed=is_public_address):
+        urllib2.HTTPSHandler.__init__(self)
+        self.is_allowed = is_allowed
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(CheckedHTTPSConnection,
+                                              is_allowed=self.is_allowed),
+                            req, context=self._context)
+
+
+class CheckedRedirectHandler(urllib2.HTTPRedirectHandler):
+    def http_error_302(self, req, fp, code, msg, headers):
+        location = headers.getheaders('location') or headers.getheaders('uri')
+        if location:
+            check_url(urlparse.urljoin(req.get_full_url(), location[0]))
+        return urllib2.HTTPRedirectHandler.http_error_302(
+            self, req, fp, code, msg, headers)
+
+    http_error_301 = http_error_303 = http_error_307 = http_error_302
+
+
+def check_url(url):
+    """Raises `UnsafeURLError` unless `url` is an http(s) URL with a host.
+    """
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme.lower() not in fetched_schemes or not parsed.hostname:
+        raise UnsafeURLError('Not fetching %s' % (url))
+
+
+def build_checked_opener(is_allowed=is_public_address):
+    """Builds an opener for http(s) only, that follows redirects and only
+    connects to addresses `is_allowed` accepts. Proxies from the environment
+    aren't used, as they would make the connections instead.
+    """
+    opener = urllib2.OpenerDirector()
+    for handler in [CheckedHTTPHandler(is_allowed),
+                    CheckedHTTPSHandler(is_allowed),
+                    CheckedRedirectHandler(),
+                    urllib2.HTTPDefaultErrorHandler(),
+                    urllib2.HTTPErrorProcessor(),
+                    urllib2.UnknownHandler()]:
+        opener.add_handler(handler)
+    return opener
+
+
+###
+### Page Metadata
+###
+
+USER_AGENT = 'Readify/1.0 (+http://github.com/j2labs/readify)'
+FETCH_TIMEOUT = 10
+MAX_FETCH_BYTES = 256 * 1024
+
+
+class MetadataParser(HTMLParser):
+    """Pulls the title, description and canonical link out of the head of an
+    HTML page.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.title = None
+        self.og_title = None
+        self.description = None
+        self.canonical = None
+        self._in_title = False
+        self._title_parts = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'title':
+            self._in_title = True
+        elif tag == 'meta':
+            name = (attrs.get('name') or attrs.get('property') or '').lower()
+            content = (attrs.get('content') or '').strip()
+            if name in ('description', 'og:description') and content:
+                self.description = self.description or content
+            elif name == 'og:title' and content:
+                self.og_title = content
+        elif tag == 'link' and (attrs.get('rel') or '').lower() == 'canonical':
+            self.canonical = attrs.get('href')
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title = ' '.join(''.join(self._title_parts).split())
+
+
+def fetch_metadata(url, opener=None, timeout=FETCH_TIMEOUT,
+                   max_bytes=MAX_FETCH_BYTES):
+    """Fetches `url` and returns a dict with its canonical URL, title and
+    description. Only the first `max_bytes` of the page are read.
+
+    Raises `UnsafeURLError` for URLs that aren't http(s) or that reach a
+    private address, including through a redirect.
+    """
+    check_url(url)
+    opener = opener or build_checked_opener()
+    request = urllib2.Request(url, headers={'User-Agent': USER_AGENT})
+    response = opener.open(request, timeout=timeout)
+
+    # Redirects are followed, so the final URL is the best canonical guess
+    # unless the page names one
+    metadata = {
+        'canonical_url': normalize_url(response.geturl()),
+        'title': None,
+        'description': None,
+    }
+
+    content_type = response.info().gettype()
+    if content_type not in ('text/html', 'application/xhtml+xml'):
+        return metadata
+
+    charset = response.info().getparam('charset') or 'utf-8'
+    page = response.read(max_bytes).decode(charset, 'replace')
+
+    parser = MetadataParser()
+    try:
+        parser.feed(page)
+    except HTMLParseError, e:
+        logging.debug('Partial parse of %s: %s' % (url, e))
+
+    metadata['title'] = parser.og_title or parser.title
+    metadata['description'] = parser.description
+    if parser.canonical and parser.canonical.startswith('http'):
+        metadata['canonical_url'] = normalize_url(parser.canonical)
+
+    return metadata
+
+
+###
+### Rate Limiting
+###
+
+class HostRateLimiter(object):
+    """Spaces out requests to each host by at least `min_interval` seconds,
+    across all the threads sharing the limiter.
+    """
+    def __init__(self, min_interval=1.0):
+        self.min_interval = min_interval
+        self._next_slot = dict()
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        """Blocks until a request to `host` is allowed.
+        """
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+###
+### Workers
+###
+
+METADATA_TTL = 7 * 24 * 60 * 60 * 1000
+MAX_ATTEMPTS = 3
+STALE_AFTER = 5 * 60 * 1000
+
+# A failed fetch is retried after this many milliseconds, doubled for each
+# attempt after the first
+RETRY_DELAY = 60 * 1000
+
+
+def is_permanent_failure(error):
+    """Returns True for fetch errors that fetching again won't fix: unsafe
+    URLs and client errors other than being rate limited.
+    """
+    if isinstance(error, UnsafeURLError):
+        return True
+    if isinstance(error, urllib2.HTTPError):
+        return 400 <= error.code < 500 and error.code != 429
+    return False
+
+
+def enrich_item(storage, item_id, limiter, fetch=fetch_metadata,
+                metadata_ttl=METADATA_TTL):
+    """Fetches the metadata for an item's URL, unless another user's item
+    fetched it recently, and copies it onto the item. `storage` is a
+    `readify.storage.Storage`.
+
+    The URL is fetched as the user saved it, since a page can depend on
+    what normalizing changes, like the order of its query parameters or a
+    parameter taken for tracking. The normalized URL is only the key the
+    metadata is shared by.
+    """
+    item_doc = storage.load_listitem_by_id(item_id,
+                                           fields=['owner_id', 'url',
+                                                   'url_hash', 'title'])
+    if item_doc is None:
+        return None
+
+    url = item_doc['url']
+    normalized_url = normalize_url(url)
+    url_key = item_doc.get('url_hash') or url_hash(normalized_url)
+
+    metadata = storage.load_url_metadata(url_key)
+    expired = current_millis() - metadata_ttl
+    if metadata is None or metadata['fetched_at'] < expired:
+        limiter.wait(url_host(url))
+        metadata = fetch(url)
+        metadata['url'] = normalized_url
+        metadata['fetched_at'] = current_millis()
+        storage.save_url_metadata(url_key, metadata)
+
+    return storage.apply_url_metadata(item_doc, metadata)
+
+
+class EnrichmentPool(object):
+    """Runs `num_workers` threads that take items off the enrichment queue
+    and fetch their metadata. Requests to the same host are spaced out by
+    `host_interval` seconds. Failed items are retried after `retry_delay`
+    milliseconds, doubled for each attempt.
+    """
+    def __init__(self, storage, num_workers=8, host_interval=1.0,
+                 fetch=fetch_metadata, poll_interval=1.0,
+                 retry_delay=RETRY_DELAY):
+        self.storage = storage
+        self.num_workers = num_workers
+        self.limiter = HostRateLimiter(host_interval)
+        self.fetch = fetch
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._running = threading.Event()
+        self._threads = []
+
+    def work(self):
+        """The loop run by each worker thread.
+        """
+        while self._running.is_set():
+            job = self.storage.claim_enrichment(STALE_AFTER)
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            try:
+                enrich_item(self.storage, job['_id'], self.limiter,
+                            fetch=self.fetch)
+                self.storage.finish_enrichment(job['_id'])
+            except Exception, e:
+                if is_permanent_failure(e):
+                    logging.warning('Not enriching %s: %s' % (job['_id'], e))
+                    self.storage.finish_enrichment(job['_id'])
+                    continue
+                logging.error('Enrichment failed for %s: %s' % (job['_id'], e))
+                self.storage.retry_enrichment(job, MAX_ATTEMPTS,
+                                              self.retry_delay)
+
+    def start(self):
+        self._running.set()
+        for n in xrange(self.num_workers):
+            thread = threading.Thread(target=self.work,
+                                      name='enrichment-%d' % (n))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Lets each worker finish its current item, then waits for them.
+        """
+        self._running.clear()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
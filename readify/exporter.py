@@ -0,0 +1,106 @@
+import csv
+import json
+import cgi
+from cStringIO import StringIO
+
+from formatting import make_ownersafe
+
+
+###
+### Row Formatting
+###
+
+# Each format has a header, a function that formats one item and a footer.
+# Items are read straight from the cursor and formatted one at a time, so an
+# export uses the same memory no matter how long the list is.
+
+CHUNK_SIZE = 64 * 1024
+
+csv_fields = ['url', 'title', 'tags', 'liked', 'archived', 'created_at',
+              'updated_at', 'changed_at']
+
+
+def format_jsonl(item):
+    return json.dumps(item) + '\n'
+
+
+def format_csv(item):
+    row = []
+    for field in csv_fields:
+        value = item.get(field)
+        if field == 'tags':
+            value = ','.join(value or [])
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(value)
+
+    buf = StringIO()
+    csv.writer(buf).writerow(row)
+    return buf.getvalue()
+
+
+def format_bookmark(item):
+    """Formats an item as a Netscape bookmark entry, which can be imported by
+    `readify.importer` and most browsers.
+    """
+    entry = u'<DT><A HREF="%s" ADD_DATE="%d" TAGS="%s">%s</A>\n' % (
+        cgi.escape(item['url'], quote=True),
+        item['created_at'] / 1000,
+        cgi.escape(','.join(item.get('tags') or []), quote=True),
+        cgi.escape(item['title']))
+    return entry.encode('utf-8')
+
+
+bookmarks_header = '''<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+'''
+
+export_formats = {
+    # name: (content type, header, formatter, footer)
+    'jsonl': ('application/x-ndjson', '', format_jsonl, ''),
+    'csv': ('text/csv', ','.join(csv_fields) + '\r\n', format_csv, ''),
+    'html': ('text/html', bookmarks_header, format_bookmark, '</DL><p>\n'),
+}
+
+
+###
+### Exporting
+###
+
+def iter_export_items(storage, owner_id, since=None):
+    """Yields the owner-safe version of every item owned by `owner_id`,
+    oldest change first, with its id as a string. `storage` is a
+    `readify.storage` engine.
+    """
+    query_set = storage.load_listitem_history(owner_id, since=since,
+                                              batch_size=500)
+    for i in query_set:
+        item_id = i['_id']
+        item = make_ownersafe(i)
+        item['id'] = str(item_id)
+        yield item
+
+
+def export_chunks(storage, owner_id, file_format, since=None,
+                  chunk_size=CHUNK_SIZE):
+    """Yields an export of `owner_id`'s items in `file_format`, a key of
+    `export_formats`, as byte strings of roughly `chunk_size`.
+    """
+    (content_type, header, formatter, footer) = export_formats[file_format]
+
+    buf = [header]
+    buffered = len(header)
+    for item in iter_export_items(storage, owner_id, since=since):
+        row = formatter(item)
+        buf.append(row)
+        buffered += len(row)
+        if buffered >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+
+    buf.append(footer)
+    yield ''.join(buf)
@@ -0,0 +1,116 @@
+import time
+from datetime import datetime
+
+from models import ListItem
+
+
+###
+### Owner-safe Items
+###
+
+# The keys `ListItem.make_ownersafe` strips, computed once instead of for
+# every document
+listitem_private_keys = frozenset(ListItem._get_internal_fields())
+
+
+def make_ownersafe(item_doc):
+    """Returns a copy of a loaded item document in the form produced by
+    `ListItem.make_ownersafe`: private and internal keys and `None` values
+    are left out.
+    """
+    return dict((k, v) for (k, v) in item_doc.iteritems()
+                if v is not None and k not in listitem_private_keys)
+
+
+###
+### Relative Dates
+###
+
+DAY_MILLIS = 24 * 60 * 60 * 1000
+
+# Every timezone offset is a multiple of 15 minutes, so timestamps in the same
+# slot share a local date
+DATE_SLOT_MILLIS = 15 * 60 * 1000
+
+
+class RelativeDates(object):
+    """Formats millisecond timestamps like `brubeck.timekeeping.prettydate`,
+    relative to a single `now` for a whole page. Each distinct string is only
+    formatted once and shared by the items that use it.
+    """
+    def __init__(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        # `prettydate` subtracts a local datetime from UTC now, so now is read
+        # as a local time to give the same results
+        self.now_millis = (time.mktime(now.timetuple()) * 1000 +
+                           now.microsecond / 1000)
+        self.strings = dict()
+
+    def format(self, millis):
+        (days, rest) = divmod(int(self.now_millis - millis), DAY_MILLIS)
+        s = rest / 1000
+
+        if days > 7 or days < 0:
+            key = ('date', millis / DATE_SLOT_MILLIS)
+        elif days >= 1:
+            key = ('days', days)
+        elif s <= 1:
+            key = ('now', 0)
+        elif s < 60:
+            key = ('seconds', s)
+        elif s < 3600:
+            key = ('minutes', s / 60)
+        else:
+            key = ('hours', s / 3600)
+
+        string = self.strings.get(key)
+        if string is None:
+            string = self.strings[key] = self._format(key, millis)
+        return string
+
+    def _format(self, key, millis):
+        (unit, n) = key
+        if unit == 'date':
+            return datetime.fromtimestamp(millis / 1000.0).strftime('%d %b %y')
+        elif unit == 'now':
+            return 'just now'
+        elif n == 1:
+            return '1 %s ago' % (unit[:-1])
+        return '%d %s ago' % (n, unit)
+
+
+###
+### List Pages
+###
+
+class PreparedItems(object):
+    """The items of a list page, prepared for templates as they are iterated.
+
+    Each item is made owner-safe, gets its id as `id` and its `updated_at` as
+    a relative date in `formatted_date`. Dates are relative to one `now` for
+    the whole page. The number of items is known up front, so templates can
+    test and count the list before iterating it.
+
+    If a `trace` is given, preparation time is added to its `format` phase.
+    """
+    def __init__(self, item_docs, now=None, trace=None):
+        self.item_docs = item_docs
+        self.dates = RelativeDates(now)
+        self.trace = trace
+        if trace is not None:
+            trace.add('format', 0.0)
+
+    def __len__(self):
+        return len(self.item_docs)
+
+    def __iter__(self):
+        for item_doc in self.item_docs:
+            started = time.time()
+            item = make_ownersafe(item_doc)
+            item['formatted_date'] = self.dates.format(item_doc['updated_at'])
+            item['id'] = item_doc['_id']
+            if self.trace is not None:
+                self.trace.add('format', (time.time() - started) * 1000,
+                               count=0)
+            yield item
@@ -1,5 +1,6 @@
-import copy
+import cgi
 from dictshield.forms import Form
+from dictshield.fields import StringField
 
 from models import (User,
                     UserProfile,
@@ -16,17 +17,98 @@ style_dict = {
     'input_class': 'forms_value',
 }
 
+# Form markup, see `compile_form`
+compiled_forms = {}
+
+
+def form_args(kwargs):
+    """Merges the keyword arguments for `as_div` over `style_dict`.
+    """
+    as_div_args = dict(style_dict)
+    as_div_args.update(kwargs)
+    return as_div_args
+
+
+def compile_form(model, private_fields=None, **kwargs):
+    """Generates the markup for a form once and caches it. Each string field
+    that is rendered gets a placeholder in place of its value, which
+    `fill_form` swaps for the escaped per-request value.
+
+    Forms are cached by the arguments given, so `kwargs` are only merged over
+    `style_dict` when a form is compiled.
+
+    Returns None if the markup couldn't be compiled safely, in which case the
+    form is generated on every call instead.
+    """
+    cache_key = (model, tuple(private_fields or []),
+                 tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                              for (k, v) in kwargs.items())))
+    if cache_key in compiled_forms:
+        return compiled_forms[cache_key]
+
+    as_div_args = form_args(kwargs)
+    hidden = set(as_div_args.get('skip_fields') or [])
+    hidden.update(private_fields or [])
+    rendered = set(name for name in model._fields if name not in hidden)
+    placeholders = dict((name, '__readify_form_%s__' % (name))
+                        for name in rendered
+                        if isinstance(model._fields[name], StringField))
+
+    f = Form(model, private_fields=private_fields)
+    markup = f.as_div(values=placeholders, **as_div_args)
+
+    compiled = (markup, placeholders, rendered)
+    for placeholder in placeholders.values():
+        if markup.count(placeholder) != 1:
+            compiled = None
+            break
+
+    compiled_forms[cache_key] = compiled
+    return compiled
+
+
+def fill_form(compiled, values):
+    """Fills `values` into markup built by `compile_form`. Returns None if a
+    value is given for a rendered field that has no placeholder.
+    """
+    (markup, placeholders, rendered) = compiled
+    values = values or {}
+
+    for name in rendered:
+        value = values.get(name)
+        if name not in placeholders:
+            if value is not None:
+                return None
+            continue
+
+        if value is None:
+            value = u''
+        markup = markup.replace(placeholders[name],
+                                cgi.escape(unicode(value), quote=True))
+
+    return markup
+
 
 def gen_doc_as_div(model, private_fields=None, **kwargs):
     """A function that handles the details of generating a Form around some
     document model.
-    """
-    # Use `style_dict` as basis for new forms
-    as_div_args = copy.copy(style_dict)
 
-    # Add keywords and overwrite `style_dict` keys if necessary
-    for kword,value in kwargs.items():
-        as_div_args[kword] = value
+    The markup for each combination of model and arguments is compiled once,
+    see `compile_form`.
+    """
+    values = kwargs.pop('values', None)
+
+    compiled = compile_form(model, private_fields=private_fields, **kwargs)
+    if compiled is not None:
+        markup = fill_form(compiled, values)
+        if markup is not None:
+            return markup
+
+    # Use `style_dict` as basis for forms that can't be compiled, overwriting
+    # its keys if necessary
+    as_div_args = form_args(kwargs)
+    if values is not None:
+        as_div_args['values'] = values
 
     f = Form(model, private_fields=private_fields)
 
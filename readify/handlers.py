@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import datetime
@@ -5,41 +6,127 @@ import logging
 import pymongo
 import json
 import copy
+import urllib
+import httplib
+from cStringIO import StringIO
 from hashlib import md5
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 from brubeck.auth import authenticated, web_authenticated, UserHandlingMixin
 from brubeck.request_handling import WebMessageHandler, JSONMessageHandler
 from brubeck.templating import Jinja2Rendering
-from brubeck.timekeeping import millis_to_datetime, prettydate
 from brubeck.datamosh import StreamedHandlerMixin
 
+import settings
 from models import (User,
                     UserProfile,
                     ListItem,
                     ObjectIdField)
-from queries import (load_user,
-                     save_user,
-                     load_listitems,
-                     save_listitem,
-                     update_listitem,
-                     load_userprofile,
-                     save_userprofile)
+from queries import listitem_actions, current_millis
+from storage import DuplicateKeyError
+from paging import decode_cursor, cursor_for_item
+from cache import TTLCache
+from importer import row_parsers, import_rows
+from exporter import export_formats, export_chunks
 from forms import (user_form,
                    userprofile_form,
                    listitem_form)
+from formatting import PreparedItems, make_ownersafe
+from compression import compress_response
+from tracing import (RequestTrace,
+                     TracedStorage,
+                     finish_trace,
+                     request_metrics)
 
 
 ###
 ### Handler Infrastructure
 ###
 
+# Rendered list pages, see `ListHandlerBase.render_cached`
+PAGE_CACHE_SIZE = 1000
+PAGE_CACHE_TTL = 60
+
+page_cache = TTLCache(max_size=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+
+
 class BaseHandler(WebMessageHandler, UserHandlingMixin):
     """This Mixin provides a `get_current_user` implementation that
     validates auth against documents in mongodb.
+
+    Each request is traced with `readify.tracing`. Storage calls made through
+    `self.db_conn` are recorded automatically and handlers measure their
+    other phases with `self.trace.measure`.
+
+    Responses are gzipped for clients that accept it, see
+    `readify.compression`.
+
+    Handlers that only read set `secondary_reads`, which lets their lists be
+    loaded from a MongoDB secondary if the storage engine has one. The
+    engine's sockets are returned to its pool after every request.
     """
+    secondary_reads = False
+
+    def __init__(self, application, message, *args, **kwargs):
+        self.trace = RequestTrace()
+        self._storage = application.db_conn
+        if self.secondary_reads:
+            self._storage = self._storage.with_secondary_reads()
+        self._db_conn = TracedStorage(self._storage, self.trace)
+        super(BaseHandler, self).__init__(application, message, *args,
+                                          **kwargs)
+
+    def __call__(self):
+        try:
+            response = super(BaseHandler, self).__call__()
+            with self.trace.measure('compress'):
+                return compress_response(
+                    response, self.message.headers.get('accept-encoding'),
+                    min_size=settings.GZIP_MIN_SIZE,
+                    level=settings.GZIP_LEVEL)
+        finally:
+            self._storage.end_request()
+            finish_trace(self.__class__.__name__, self.message,
+                         self.status_code, self.trace)
+
+    @property
+    def db_conn(self):
+        return self._db_conn
+
+    def render_template(self, template_file, *args, **context):
+        """Measures template rendering for handlers that mix in
+        `Jinja2Rendering`.
+        """
+        with self.trace.measure('render'):
+            return super(BaseHandler, self).render_template(template_file,
+                                                            *args, **context)
+
+    # Set to the token document when a request authenticated with an API
+    # token
+    current_token = None
+
+    # API handlers also read tokens from a `token` argument. Pages don't, as
+    # a token in a link would end up in browser history and referers.
+    token_argument = False
+
+    def get_api_token(self):
+        """Reads an API token from an `Authorization: Token <token>` header,
+        `Bearer` also being accepted, or from the `token` argument if the
+        handler sets `token_argument`.
+        """
+        authorization = self.message.headers.get('authorization')
+        if authorization:
+            parts = authorization.split(None, 1)
+            if len(parts) == 2 and parts[0].lower() in ('token', 'bearer'):
+                return parts[1].strip()
+        if self.token_argument:
+            return self.get_argument('token')
+        return None
+
     def get_current_user(self):
         """Attempts to load user information from cookie. If that
-        fails, it looks for credentials as arguments.
+        fails, it looks for an API token and then for credentials as
+        arguments.
 
         It then attempts auth with the found credentials by checking for that in
         the database.
@@ -52,15 +139,26 @@ class BaseHandler(WebMessageHandler, UserHandlingMixin):
 
         # If secure cookies yields username, load it
         if user_id:
-            user = load_user(self.db_conn, username=user_id)
+            user = self.db_conn.load_user(username=user_id)
             return user
+
+        # API tokens are verified against a cache, so polling clients skip
+        # the password check
+        token = self.get_api_token()
+        if token:
+            token_doc = self.db_conn.verify_api_token(token)
+            if token_doc is None:
+                logging.error('Auth fail: bad token')
+                return
+            self.current_token = token_doc
+            return self.db_conn.load_user(username=token_doc['owner_username'])
         
         # If not, check POST args and attempt load
         else:
             username = self.get_argument('username')
             password = self.get_argument('password')
             if username:
-                user = load_user(self.db_conn, username=username)
+                user = self.db_conn.load_user(username=username)
 
         if not user or (user and user.username != username):
             logging.error('Auth fail: bad username')
@@ -74,12 +172,130 @@ class BaseHandler(WebMessageHandler, UserHandlingMixin):
 
         return user
 
+    def check_not_modified(self, variant, changed_at=None):
+        """Sets the cache headers for a response that only changes with
+        `variant`, a tuple of everything the response depends on, usually
+        including an owner's version. Its hash is sent as a weak ETag.
+        `changed_at`, in milliseconds, is sent as `Last-Modified`.
+
+        HTTP dates are in whole seconds, so `changed_at` is rounded up to the
+        next second. Another change in that same second would be sent with
+        the same date, so `Last-Modified` is left out until the second has
+        passed and clients revalidate with the ETag meanwhile.
+
+        Clients may keep the response but must revalidate it on every use.
+        Returns True if the request is a GET whose `If-None-Match`, or
+        otherwise `If-Modified-Since`, shows the client's copy is current.
+        The handler should then return `render_not_modified()` without
+        loading anything else.
+        """
+        etag = 'W/"%s"' % (md5(repr(variant)).hexdigest())
+        self.headers['ETag'] = etag
+        self.headers['Cache-Control'] = 'private, no-cache'
+        self.headers['Vary'] = 'Cookie, Authorization'
+        if changed_at is not None:
+            last_modified = (changed_at + 999) // 1000
+            if last_modified * 1000 <= current_millis():
+                self.headers['Last-Modified'] = formatdate(last_modified,
+                                                           usegmt=True)
+
+        if self.message.method != 'GET':
+            return False
+
+        if_none_match = self.message.headers.get('if-none-match')
+        if if_none_match is not None:
+            # ETags are compared weakly, so the W/ prefix is ignored
+            tags = [t.strip() for t in if_none_match.split(',')]
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+            return etag[2:] in tags or '*' in tags
+
+        if_modified_since = self.message.headers.get('if-modified-since')
+        if if_modified_since and changed_at is not None:
+            since = parsedate_tz(if_modified_since)
+            return (since is not None and
+                    changed_at <= mktime_tz(since) * 1000)
+
+        return False
+
+    def render_not_modified(self):
+        """Renders a 304 with the headers set by `check_not_modified` and no
+        body.
+        """
+        self.set_status(304, status_msg='Not Modified')
+        self.convert_cookies()
+        header_lines = ''.join('%s: %s\r\n' % (k, v)
+                               for (k, v) in self.headers.items())
+        logging.info('304 %s %s (%s)' % (self.message.method,
+                                         self.message.path,
+                                         self.message.remote_addr))
+        return 'HTTP/1.1 304 Not Modified\r\n%s\r\n' % (header_lines)
+
+    def get_boolean_argument(self, name, default=False):
+        """Reads a flag argument like `with_count=1`. Returns `default` if the
+        argument wasn't given.
+        """
+        value = self.get_argument(name)
+        if value is None:
+            return default
+        return value.lower() in ('1', 'true', 'yes', 'on')
+
+    def apply_item_actions(self):
+        """Applies the item actions found in the request arguments to the
+        current user's items. Actions can be given as `<action>=<item_id>`,
+        repeated for as many items as needed, or as `action=<action>` with
+        repeated `item_id` arguments.
+
+        Each action is applied with one `bulk_update_listitems` call. Returns
+        a dict mapping each action to its per-item results.
+        """
+        requested = dict()
+        for action in listitem_actions:
+            item_ids = self.get_arguments(action, None)
+            if item_ids:
+                requested.setdefault(action, []).extend(item_ids)
+
+        action = self.get_argument('action')
+        if action in listitem_actions:
+            item_ids = self.get_arguments('item_id', None) or []
+            requested.setdefault(action, []).extend(item_ids)
+
+        results = dict()
+        for (action, item_ids) in requested.items():
+            results[action] = self.db_conn.bulk_update_listitems(
+                self.current_user.id, item_ids, action)
+
+        return results
+
+    def stream_response(self, chunks, headers=None, status_code=200):
+        """Sends `chunks` to the client as they are produced, with chunked
+        transfer encoding, instead of building the whole body first.
+
+        Returns an empty response, which tells Mongrel2 to close the
+        connection once the last chunk is sent.
+        """
+        headers = dict(headers or {})
+        headers['Transfer-Encoding'] = 'chunked'
+        header_lines = ''.join('%s: %s\r\n' % (k, v)
+                               for (k, v) in headers.items())
+
+        msg_conn = self.application.msg_conn
+        msg_conn.reply(self.message, 'HTTP/1.1 %d %s\r\n%s\r\n'
+                       % (status_code, httplib.responses[status_code],
+                          header_lines))
+        for chunk in chunks:
+            if chunk:
+                msg_conn.reply(self.message,
+                               '%x\r\n%s\r\n' % (len(chunk), chunk))
+        msg_conn.reply(self.message, '0\r\n\r\n')
+
+        return ''
+
     def get_current_userprofile(self):
         """Attempts to load the userprofile associated with `self.current_user`.
         If no profile is found it prepares a blank one.
         """
-        userprofile_dict = load_userprofile(self.db_conn,
-                                            owner_id=self.current_user.id)
+        userprofile_dict = self.db_conn.load_userprofile(
+            owner_id=self.current_user.id)
 
         if userprofile_dict:
             userprofile = UserProfile(**userprofile_dict)
@@ -123,8 +339,9 @@ class AccountCreateHandler(BaseHandler, Jinja2Rendering):
 
         try:
             u = User.create_user(username, password)
-            u.validate()
-            save_user(self.db_conn, u)
+            with self.trace.measure('validation'):
+                u.validate()
+            self.db_conn.save_user(u)
         except Exception, e:
             logging.error('Credentials failed')
             logging.error(e)
@@ -181,28 +398,28 @@ class AccountLogoutHandler(BaseHandler, Jinja2Rendering):
 class ListHandlerBase(BaseHandler, Jinja2Rendering):
     """Base handler for list handlers that provides some commonly needed
     functions.
+
+    List pages are bounded at `page_size` items, which a request can change
+    with the `count` argument up to `max_page_size`.
     """
+    page_size = 25
+    max_page_size = 200
+
+    # Actions applied by `handle_updates` switch the request back to the
+    # primary before the list is loaded
+    secondary_reads = True
+
+    # Where the bulk action form returns to
+    list_path = '/'
+
+    # Fields used by `link_list.html`. `_id` is always loaded.
+    list_fields = ['url', 'title', 'tags', 'updated_at',
+                   'liked', 'archived', 'deleted']
+
     def handle_updates(self):
-        """I'm not a huge fan of how this works yet. Got any ideas?
-        """
-        archive = self.get_argument('archive', None)
-        unarchive = self.get_argument('unarchive', None)
-        like = self.get_argument('like', None)
-        unlike = self.get_argument('unlike', None)
-        delete = self.get_argument('delete', None)
-        undelete = self.get_argument('undelete', None)
-
-        # Simple closure to simplify updating code
-        def updater(item_id, **kw):
-            update_listitem(self.db_conn, self.current_user.id, item_id, **kw)
-
-        # This could def be cleaner
-        if archive: updater(archive, archived=True)
-        elif unarchive: updater(unarchive, archived=False)
-        elif like: updater(like, liked=True)
-        elif unlike: updater(unlike, liked=False)
-        elif delete: updater(delete, deleted=True)
-        elif undelete: updater(undelete, deleted=False)
+        """Applies any item actions in the request, eg. `?archive=<item_id>`.
+        """
+        return self.apply_item_actions()
 
     def get_tags(self):
         """
@@ -211,23 +428,96 @@ class ListHandlerBase(BaseHandler, Jinja2Rendering):
         tags = self.get_arguments('tag', None)
         return tags
 
-    @classmethod
-    def prepare_items(self, query_set, sort_field='updated_at'):
-        query_set.sort(sort_field, direction=pymongo.DESCENDING)
+    def get_page_size(self):
+        """Reads the page size from the `count` argument, bounded by
+        `max_page_size`. Falls back to `page_size`.
+        """
+        try:
+            count = int(self.get_argument('count'))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(count, self.max_page_size))
+
+    def load_page(self, **query_args):
+        """Loads a single page of items with `load_listitems`, starting after
+        the `cursor` argument if one is given.
+
+        Returns a tuple of the prepared items and the URL of the next page,
+        which is None on the last page. Raises `ValueError` for a malformed
+        cursor.
+        """
+        before = decode_cursor(self.get_argument('cursor'))
+        page_size = self.get_page_size()
+
+        # One extra item is loaded to find out if there's another page
+        items_qs = self.db_conn.load_listitems(before=before,
+                                               limit=page_size + 1,
+                                               fields=self.list_fields,
+                                               **query_args)
+        loaded = list(items_qs)
+
+        next_url = None
+        if len(loaded) > page_size:
+            loaded = loaded[:page_size]
+            next_args = [('tag', tag.encode('utf-8'))
+                         for tag in query_args.get('tags') or []]
+            if page_size != self.page_size:
+                next_args.append(('count', page_size))
+            next_args.append(('cursor', cursor_for_item(loaded[-1])))
+            next_url = '?%s' % (urllib.urlencode(next_args))
+
+        items = ListHandlerBase.prepare_items(loaded, trace=self.trace)
+        return (items, next_url)
+
+    def render_cached(self, template_file, owner_id, load_context):
+        """Renders `template_file` with the context returned by
+        `load_context`, unless a current rendering is in `page_cache`.
+
+        Pages are cached by handler, list arguments and the owner's version
+        counter, which is bumped whenever their items change. A hit costs a
+        single version lookup and skips loading items and rendering. Entries
+        expire after `PAGE_CACHE_TTL` seconds so relative dates stay fresh.
+
+        The same version lookup answers conditional requests. The ETag also
+        depends on the viewer and changes every `PAGE_CACHE_TTL` seconds, for
+        the relative dates.
+        """
+        cache_key = None
+        if owner_id is not None:
+            version = self.db_conn.load_owner_version(owner_id)
+            cache_key = (self.__class__.__name__, owner_id, version,
+                         tuple(self.get_tags() or []),
+                         self.get_argument('cursor'), self.get_page_size())
+
+            viewer = self.current_user and self.current_user.username
+            period = int(time.time() / PAGE_CACHE_TTL)
+            if self.check_not_modified(cache_key + (viewer, period)):
+                return self.render_not_modified()
+
+            body = page_cache.get(cache_key)
+            if body is not None:
+                self.set_body(body)
+                return self.render()
 
-        items = []
-        for i in query_set:
-            item_id = i['_id']
-            item = ListItem.make_ownersafe(i)
-            
-            updated = millis_to_datetime(item['updated_at'])
-            formatted_date = prettydate(updated)
-            item['formatted_date'] = formatted_date
+        try:
+            context = load_context()
+        except ValueError, e:
+            logging.error(e)
+            return self.render_error(400)
 
-            item['id'] = item_id
-            items.append(item)
+        context.setdefault('list_path', self.list_path)
+        response = self.render_template(template_file, **context)
+        if cache_key is not None:
+            page_cache.set(cache_key, self.body)
 
-        return items
+        return response
+
+    @classmethod
+    def prepare_items(self, query_set, now=None, trace=None):
+        """Prepares loaded items for the list templates. Items are formatted
+        as the template iterates them, see `PreparedItems`.
+        """
+        return PreparedItems(list(query_set), now=now, trace=trace)
 
 
 class DashboardDisplayHandler(ListHandlerBase):
@@ -240,17 +530,22 @@ class DashboardDisplayHandler(ListHandlerBase):
         self.handle_updates()
         tags = self.get_tags()
         
-        items_qs = load_listitems(self.db_conn, owner_id=self.current_user.id,
-                                  tags=tags)
-        items = ListHandlerBase.prepare_items(items_qs)
+        owner_id = self.current_user.id
 
-        context = {
-            'links': items,
-        }
-        return self.render_template('linklists/link_list.html', **context)
+        def load_context():
+            (items, next_url) = self.load_page(owner_id=owner_id, tags=tags)
+            return {
+                'links': items,
+                'next_url': next_url,
+            }
+
+        return self.render_cached('linklists/link_list.html', owner_id,
+                                  load_context)
 
 
 class ArchivedDisplayHandler(ListHandlerBase):
+    list_path = '/archived'
+
     @web_authenticated
     def get(self):
         """A list display matching the parameters of a user's archive with
@@ -259,17 +554,23 @@ class ArchivedDisplayHandler(ListHandlerBase):
         self.handle_updates()
         tags = self.get_tags()
         
-        items_qs = load_listitems(self.db_conn, owner_id=self.current_user.id,
-                                  archived=True, tags=tags)
-        items = ListHandlerBase.prepare_items(items_qs)
-        
-        context = {
-            'links': items,
-        }
-        return self.render_template('linklists/link_list.html', **context)
+        owner_id = self.current_user.id
+
+        def load_context():
+            (items, next_url) = self.load_page(owner_id=owner_id,
+                                               archived=True, tags=tags)
+            return {
+                'links': items,
+                'next_url': next_url,
+            }
+
+        return self.render_cached('linklists/link_list.html', owner_id,
+                                  load_context)
 
 
 class LikedDisplayHandler(ListHandlerBase):
+    list_path = '/liked'
+
     @web_authenticated
     def get(self):
         """A list display matching the parameters of a user's liked items list
@@ -278,12 +579,68 @@ class LikedDisplayHandler(ListHandlerBase):
         self.handle_updates()
         tags = self.get_tags()
         
-        items_qs = load_listitems(self.db_conn, owner_id=self.current_user.id,
-                                  liked=True, archived=None, tags=tags)
-        items = ListHandlerBase.prepare_items(items_qs)
-        
+        owner_id = self.current_user.id
+
+        def load_context():
+            (items, next_url) = self.load_page(owner_id=owner_id, liked=True,
+                                               archived=None, tags=tags)
+            return {
+                'links': items,
+                'next_url': next_url,
+            }
+
+        return self.render_cached('linklists/link_list.html', owner_id,
+                                  load_context)
+
+
+class SearchHandler(ListHandlerBase):
+    """Ranked search over the titles, URLs and tags of a user's items.
+    Results are paged by number, up to `max_search_pages` pages.
+    """
+    max_search_pages = 20
+
+    @web_authenticated
+    def get(self):
+        """Renders the page of results given by the `page` argument for the
+        terms in `q`.
+
+        Item actions and the bulk form return to the same page of results.
+        Tags link to the dashboard's tag filter.
+        """
+        self.handle_updates()
+        terms = (self.get_argument('q') or '').strip()
+        page_size = self.get_page_size()
+        try:
+            page = int(self.get_argument('page', 1))
+        except ValueError:
+            page = 1
+        page = max(1, min(page, self.max_search_pages))
+
+        def search_args(page):
+            args = [('q', terms.encode('utf-8')), ('page', page)]
+            if page_size != self.page_size:
+                args.append(('count', page_size))
+            return urllib.urlencode(args)
+
+        items = []
+        next_url = None
+        if terms:
+            # One extra item is loaded to find out if there's another page
+            items_qs = self.db_conn.search_listitems(
+                self.current_user.id, terms, skip=(page - 1) * page_size,
+                limit=page_size + 1, fields=self.list_fields)
+            loaded = list(items_qs)
+            if len(loaded) > page_size and page < self.max_search_pages:
+                next_url = '?%s' % (search_args(page + 1))
+            items = ListHandlerBase.prepare_items(loaded[:page_size],
+                                                  trace=self.trace)
+
         context = {
             'links': items,
+            'next_url': next_url,
+            'list_path': '/search',
+            'list_args': search_args(page),
+            'tag_path': '/',
         }
         return self.render_template('linklists/link_list.html', **context)
 
@@ -292,9 +649,18 @@ class LikedDisplayHandler(ListHandlerBase):
 ### Item Handlers
 ###
 
+# Fields of a list item that are set by the app, not on the submit and edit
+# forms
+ITEM_FORM_SKIP_FIELDS = ['deleted', 'archived', 'created_at', 'updated_at',
+                         'changed_at', 'liked', 'owner_username', 'url_hash',
+                         'canonical_url', 'description']
+
+
 class ItemAddHandler(BaseHandler, Jinja2Rendering):
     """
     """
+    skip_fields = ITEM_FORM_SKIP_FIELDS
+
     @web_authenticated
     def get(self):
         """Renders a template with our links listed
@@ -305,13 +671,17 @@ class ItemAddHandler(BaseHandler, Jinja2Rendering):
         title = self.get_argument('title')
         
         if url is not None:
+            # Links already saved are edited instead of added twice
+            item = self.db_conn.load_listitem_by_url(
+                self.current_user.id, url, fields=['_id', 'deleted'])
+            if item is not None and not item.get('deleted'):
+                return self.redirect('/edit_item/%s' % (item['_id']))
             values['url'] = url
         if title is not None:
             values['title'] = title
 
-        skip_fields = ['deleted', 'archived', 'created_at', 'updated_at',
-                       'liked', 'owner_username']
-        form_fields = listitem_form(skip_fields=skip_fields, values=values)
+        form_fields = listitem_form(skip_fields=self.skip_fields,
+                                    values=values)
         return self.render_template('linklists/item_submit.html',
                                     form_fields=form_fields)
 
@@ -345,19 +715,26 @@ class ItemAddHandler(BaseHandler, Jinja2Rendering):
         item = ListItem(**link_item)
 
         try:
-            item.validate()
+            with self.trace.measure('validation'):
+                item.validate()
         except Exception, e:
             logging.error('Item validatiom failed')
             logging.error(e)
             return self.render_error(500)
 
-        save_listitem(self.db_conn, item)
+        item_id = self.db_conn.save_listitem(item)
+
+        # Page metadata is fetched by the enrichment workers
+        self.db_conn.enqueue_enrichment([item_id])
+
         return self.redirect('/')
 
 
 class ItemEditHandler(BaseHandler, Jinja2Rendering):
     """
     """
+    skip_fields = ITEM_FORM_SKIP_FIELDS
+
     def _load_item(self, owner_id, item_id):
         """Helper for loading a single item, if `item_id` is good.
         """
@@ -367,8 +744,8 @@ class ItemEditHandler(BaseHandler, Jinja2Rendering):
             except:
                 return None
         
-        item_qs = load_listitems(self.db_conn, owner_id=self.current_user.id,
-                                 item_id=item_id)
+        item_qs = self.db_conn.load_listitems(owner_id=self.current_user.id,
+                                              item_id=item_id)
 
         items = list(item_qs)
         if len(items) != 1:
@@ -384,9 +761,8 @@ class ItemEditHandler(BaseHandler, Jinja2Rendering):
         """
         item = self._load_item(self.current_user.id, item_id)
 
-        skip_fields = ['deleted', 'archived', 'created_at', 'updated_at',
-                       'liked', 'owner_username']
-        form_fields = listitem_form(skip_fields=skip_fields, values=item)
+        form_fields = listitem_form(skip_fields=self.skip_fields,
+                                    values=item)
         return self.render_template('linklists/item_submit.html',
                                     form_fields=form_fields)
 
@@ -413,16 +789,44 @@ class ItemEditHandler(BaseHandler, Jinja2Rendering):
         item.tags = tag_list
 
         try:
-            item.validate()
+            with self.trace.measure('validation'):
+                item.validate()
         except Exception, e:
             logging.error('Item validatiom failed')
             logging.error(e)
             return self.render_error(500)
 
-        save_listitem(self.db_conn, item)
+        try:
+            item_id = self.db_conn.save_listitem(item)
+        except DuplicateKeyError:
+            logging.error('Item url is already in the list: %s' % (url))
+            return self.render_error(400)
+
+        if url != item_data['url']:
+            self.db_conn.enqueue_enrichment([item_id])
+
         return self.redirect('/')
 
 
+class ItemBulkHandler(BaseHandler, Jinja2Rendering):
+    """Applies an action to many items at once, as submitted by the
+    checkboxes on a list page.
+    """
+    @web_authenticated
+    def post(self):
+        """Applies the requested actions and sends the user back to the list
+        they came from.
+        """
+        self.apply_item_actions()
+
+        next_url = self.get_argument('next')
+        if not next_url or not next_url.startswith('/') or \
+           next_url.startswith('//'):
+            next_url = '/'
+
+        return self.redirect(next_url)
+
+
 ###
 ### User Handlers
 ###
@@ -469,8 +873,9 @@ class SettingsHandler(BaseHandler, Jinja2Rendering):
         # Save values if they pass validation
         try:
             new_up = UserProfile(**new_profile)
-            new_up.validate()
-            save_userprofile(self.db_conn, new_up)
+            with self.trace.measure('validation'):
+                new_up.validate()
+            self.db_conn.save_userprofile(new_up)
             self._current_userprofile = new_up
         except Exception, e:
             # TODO handle errors nicely
@@ -479,36 +884,48 @@ class SettingsHandler(BaseHandler, Jinja2Rendering):
         return self.redirect("/" + self.current_user.username)
 
 
-class ProfilesHandler(BaseHandler, Jinja2Rendering):
+class ProfilesHandler(ListHandlerBase):
     """
     """
+    # Fields used by `profiles/view.html`
+    list_fields = ['url', 'title', 'tags', 'updated_at']
+
     def get(self, username):
         """
         """
         if username == 'profile':
-            up_dict = self.current_userprofile.to_python()
+            owner = self.current_user
             username = self.current_user.username
         else:
-            # Load user's profile, if available.
-            up_dict = load_userprofile(self.db_conn, owner_username=username)
-
-        if up_dict and 'email' in up_dict and 'avatar_url' not in up_dict:
-            # ad-hoc gravatar support!
-            email = up_dict['email']
-            email_hash = md5(email).hexdigest()
-            avatar_url = 'http://www.gravatar.com/avatar/%s?s=100' % email_hash
-            up_dict['avatar_url'] = avatar_url
-
-        user_links = load_listitems(self.db_conn, owner_username=username,
-                                    archived=None)
-        user_links = ListHandlerBase.prepare_items(user_links)
-
-        context = {
-            'userprofile': up_dict,
-            'links': user_links,
-        }
+            owner = self.db_conn.load_user(username=username)
+
+        def load_context():
+            if owner is self.current_user:
+                up_dict = self.current_userprofile.to_python()
+            else:
+                # Load user's profile, if available.
+                up_dict = self.db_conn.load_userprofile(
+                    owner_username=username)
+
+            if up_dict and 'email' in up_dict and 'avatar_url' not in up_dict:
+                # ad-hoc gravatar support!
+                email = up_dict['email']
+                email_hash = md5(email).hexdigest()
+                avatar_url = ('http://www.gravatar.com/avatar/%s?s=100'
+                              % email_hash)
+                up_dict['avatar_url'] = avatar_url
+
+            (user_links, next_url) = self.load_page(owner_username=username,
+                                                    archived=None)
+            return {
+                'userprofile': up_dict,
+                'links': user_links,
+                'next_url': next_url,
+            }
 
-        return self.render_template('profiles/view.html', **context)
+        owner_id = owner.id if owner else None
+        return self.render_cached('profiles/view.html', owner_id,
+                                  load_context)
 
 
 ###
@@ -518,42 +935,426 @@ class ProfilesHandler(BaseHandler, Jinja2Rendering):
 class JSONBaseHandler(JSONMessageHandler, BaseHandler):
     """Merges the JSONMessageHandler and BaseHandler classes
     """
+    token_argument = True
+
+    def render(self, *args, **kwargs):
+        with self.trace.measure('render'):
+            return super(JSONBaseHandler, self).render(*args, **kwargs)
     
 
 class APIListDisplayHandler(JSONBaseHandler, StreamedHandlerMixin):
     """
     """
+    # Private fields are excluded by the query instead of loaded and dropped
+    item_fields = dict((f, False) for f in ListItem._private_fields)
+    secondary_reads = True
+
+    # Arguments that authenticate instead of changing the list
+    credential_arguments = ('username', 'password', 'token')
+
     def get(self):
         return self.post()
     
     @authenticated
     def post(self):
         """Renders a JSON list of link data
+
+        Pages can be requested with `page` and `count`, or by passing the
+        `next_cursor` value from the previous response as `cursor`. Cursors
+        cost the same at any depth, so the total count is only computed for
+        them if `with_count` is set. `num_items` counts the whole list, not
+        the items left after the cursor, so it's the same on every page.
+
+        GET requests are conditional. The ETag and `Last-Modified` come from
+        the owner's version, so polls that find nothing changed are answered
+        with a 304 after a single lookup.
         """
+        ### Unchanged lists are answered before anything is loaded
+        owner_state = self.db_conn.load_owner_state(self.current_user.id)
+        arguments = sorted((k, v) for (k, v) in self.message.arguments.items()
+                           if k not in self.credential_arguments)
+        variant = (self.__class__.__name__, self.current_user.id,
+                   owner_state['version'], arguments)
+        if self.check_not_modified(variant, owner_state['changed_at']):
+            return self.render_not_modified()
+
         ### Stream offset
         updated_offset = self.get_stream_offset()
 
-        ### Load the owner_id's list of items, sorted by `updated_at`.
-        items_qs = load_listitems(self.db_conn, owner_id=self.current_user.id,
-                                  updated_after=updated_offset)
-        items_qs.sort('updated_at', direction=pymongo.DESCENDING)
-        num_items = items_qs.count()
-
         ### Page list
         (page, count, skip) = self.get_paging_arguments()
 
-        items_qs.skip(skip)
-        items_qs.limit(count)
+        try:
+            before = decode_cursor(self.get_argument('cursor'))
+        except ValueError, e:
+            logging.error(e)
+            return self.render(status_code=400)
+
+        if before is not None:
+            skip = None
+        with_count = self.get_boolean_argument('with_count',
+                                               default=(before is None))
+
+        ### Load the owner_id's list of items, sorted by `updated_at`. One
+        ### extra item is loaded to find out if there's another page.
+        items_qs = self.db_conn.load_listitems(owner_id=self.current_user.id,
+                                               updated_after=updated_offset,
+                                               before=before, skip=skip,
+                                               limit=count + 1,
+                                               fields=self.item_fields)
+
+        loaded = list(items_qs)
+        next_cursor = None
+        if len(loaded) > count:
+            loaded = loaded[:count]
+            next_cursor = cursor_for_item(loaded[-1])
 
         ### Generate safe list out of loaded items
-        items = [ListItem.make_ownersafe(i) for i in items_qs]
+        items = []
+        for i in loaded:
+            item_id = i['_id']
+            item = make_ownersafe(i)
+            item['id'] = str(item_id)
+            items.append(item)
 
         data = {
-            'num_items': num_items,
             'items': items,
+            'next_cursor': next_cursor,
         }
+        # Counted without `before`, which only positions the page
+        if with_count:
+            data['num_items'] = self.db_conn.count_listitems(
+                owner_id=self.current_user.id, updated_after=updated_offset)
 
         self.add_to_payload('data', data)
 
         return self.render(status_code=200)
     
+
+
+class APIBulkHandler(JSONBaseHandler):
+    """Applies actions to many items in one request and reports the result
+    for each item.
+    """
+    @authenticated
+    def post(self):
+        """Accepts `<action>=<item_id>` arguments, or `action=<action>` with
+        repeated `item_id` arguments, where the action is one of `archive`,
+        `unarchive`, `like`, `unlike`, `delete` or `undelete`.
+        """
+        action = self.get_argument('action')
+        if action is not None and action not in listitem_actions:
+            logging.error('Unknown action: %s' % (action))
+            return self.render(status_code=400)
+
+        results = self.apply_item_actions()
+
+        data = {
+            'results': results,
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+
+class APIImportHandler(JSONBaseHandler):
+    """Imports a Netscape bookmark file or JSON lines file, sent as the
+    request body, into the current user's list.
+    """
+    # Rejected rows beyond this are counted but not listed
+    max_reported_rejects = 100
+
+    @authenticated
+    def post(self):
+        """The body format is given by the `format` argument, either `html`
+        or `jsonl`.
+        """
+        file_format = self.get_argument('format', 'html')
+        if file_format not in row_parsers:
+            logging.error('Unknown import format: %s' % (file_format))
+            return self.render(status_code=400)
+
+        rows = row_parsers[file_format](StringIO(self.message.body))
+        report = import_rows(self.db_conn, self.current_user, rows)
+
+        data = {
+            'imported': report['imported'],
+            'duplicates': report['duplicates'],
+            'num_rejected': len(report['rejected']),
+            'rejected': report['rejected'][:self.max_reported_rejects],
+            'elapsed': report['elapsed'],
+            'rate': report['rate'],
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+
+class APIExportHandler(JSONBaseHandler):
+    """Streams the current user's full list of items in one response.
+    """
+    secondary_reads = True
+
+    def get(self):
+        return self.post()
+
+    @authenticated
+    def post(self):
+        """The export format is given by the `format` argument, one of
+        `jsonl`, `csv` or `html`. An interrupted export can be resumed by
+        passing the `changed_at` of the last item received as `since`.
+        """
+        file_format = self.get_argument('format', 'jsonl')
+        if file_format not in export_formats:
+            logging.error('Unknown export format: %s' % (file_format))
+            return self.render(status_code=400)
+
+        since = self.get_argument('since')
+        try:
+            if since is not None:
+                since = int(since)
+        except ValueError, e:
+            logging.error(e)
+            return self.render(status_code=400)
+
+        headers = {
+            'Content-Type': export_formats[file_format][0],
+            'Content-Disposition': ('attachment; filename=readify.%s'
+                                    % (file_format)),
+        }
+        chunks = export_chunks(self.db_conn, self.current_user.id,
+                               file_format, since=since)
+
+        return self.stream_response(chunks, headers=headers)
+
+
+class APISyncHandler(JSONBaseHandler):
+    """Incremental sync for clients that keep a local copy of the list.
+
+    Every change to an item sets its `changed_at`, so the changes since a
+    client's last sync are the items that sort after its watermark. Deleted
+    items are sent as tombstones.
+    """
+    max_changes = 500
+
+    item_fields = APIListDisplayHandler.item_fields
+
+    def get(self):
+        return self.post()
+
+    @authenticated
+    def post(self):
+        """Renders the changes made after the `watermark` argument, which is
+        omitted for a first sync. The response carries the watermark to send
+        next time and `has_more` if the changes didn't fit in one response.
+        """
+        try:
+            after = decode_cursor(self.get_argument('watermark'))
+        except ValueError, e:
+            logging.error(e)
+            return self.render(status_code=400)
+
+        try:
+            count = int(self.get_argument('count', self.max_changes))
+        except ValueError:
+            count = self.max_changes
+        count = max(1, min(count, self.max_changes))
+
+        items_qs = self.db_conn.load_listitem_history(
+            self.current_user.id, after=after, include_deleted=True,
+            fields=self.item_fields, limit=count + 1)
+        loaded = list(items_qs)
+
+        has_more = len(loaded) > count
+        loaded = loaded[:count]
+
+        changes = []
+        for i in loaded:
+            if i.get('deleted'):
+                item = {
+                    'deleted': True,
+                    'updated_at': i['updated_at'],
+                }
+            else:
+                item = make_ownersafe(i)
+            item['id'] = str(i['_id'])
+            changes.append(item)
+
+        if loaded:
+            watermark = cursor_for_item(loaded[-1], field='changed_at')
+        else:
+            watermark = self.get_argument('watermark')
+
+        data = {
+            'changes': changes,
+            'watermark': watermark,
+            'has_more': has_more,
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+
+class APITagsHandler(JSONBaseHandler):
+    """Lists the current user's tags with their item counts, for tag clouds
+    and autocompletion.
+    """
+    max_tags = 200
+    secondary_reads = True
+
+    def get(self):
+        return self.post()
+
+    @authenticated
+    def post(self):
+        """Renders the most used tags, or the tags starting with the `prefix`
+        argument, up to `count` of them.
+        """
+        try:
+            count = int(self.get_argument('count', 50))
+        except ValueError:
+            count = 50
+        count = max(1, min(count, self.max_tags))
+
+        tags = self.db_conn.load_tags(self.current_user.id,
+                                      prefix=self.get_argument('prefix'),
+                                      limit=count)
+
+        data = {
+            'tags': tags,
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+
+class APISearchHandler(JSONBaseHandler, StreamedHandlerMixin):
+    """Ranked search over the titles, URLs and tags of the current user's
+    items.
+    """
+    item_fields = APIListDisplayHandler.item_fields
+    max_search_results = 1000
+    secondary_reads = True
+
+    def get(self):
+        return self.post()
+
+    @authenticated
+    def post(self):
+        """Renders the results for the terms in `q`, paged with `page` and
+        `count`. Each item has its match `score`.
+        """
+        terms = (self.get_argument('q') or '').strip()
+        if not terms:
+            return self.render(status_code=400)
+
+        (page, count, skip) = self.get_paging_arguments()
+        if skip + count > self.max_search_results:
+            count = max(0, self.max_search_results - skip)
+
+        items = []
+        if count:
+            items_qs = self.db_conn.search_listitems(self.current_user.id,
+                                                     terms, skip=skip,
+                                                     limit=count)
+            for i in items_qs:
+                item_id = i['_id']
+                item = make_ownersafe(i)
+                item['id'] = str(item_id)
+                items.append(item)
+
+        data = {
+            'items': items,
+            'page': page,
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+
+class APITokensHandler(JSONBaseHandler):
+    """Issues, lists and revokes the current user's API tokens.
+
+    Tokens can list tokens, but can't issue or revoke them, so a leaked token
+    can't issue others. Those requests authenticate with the account's
+    password instead, and are only accepted as POSTs.
+    """
+    @authenticated
+    def get(self):
+        """Lists the unrevoked tokens.
+        """
+        data = {
+            'tokens': self.list_tokens(),
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+    @authenticated
+    def post(self):
+        """With `action=create` a token is issued, labelled with the `name`
+        argument, and returned as `token`. This is the only time it can be
+        read. With `action=revoke` the token with the id given as `token_id`
+        is revoked. The unrevoked tokens are listed after either, or on
+        their own without an action.
+        """
+        if self.current_token is not None:
+            logging.error('Auth fail: tokens cannot manage tokens')
+            return self.render(status_code=403)
+
+        data = dict()
+        action = self.get_argument('action')
+        if action == 'create':
+            (token, token_doc) = self.db_conn.create_api_token(
+                self.current_user, name=self.get_argument('name'))
+            data['token'] = token
+            data['token_id'] = str(token_doc['_id'])
+        elif action == 'revoke':
+            revoked = self.db_conn.revoke_api_token(
+                self.current_user.id, self.get_argument('token_id'))
+            if not revoked:
+                return self.render(status_code=404)
+        elif action is not None:
+            logging.error('Unknown action: %s' % (action))
+            return self.render(status_code=400)
+
+        data['tokens'] = self.list_tokens()
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
+
+    def list_tokens(self):
+        tokens = []
+        for t in self.db_conn.load_api_tokens(self.current_user.id):
+            tokens.append({
+                'id': str(t['_id']),
+                'name': t.get('name'),
+                'created_at': t['created_at'],
+            })
+        return tokens
+
+
+class APIMetricsHandler(JSONBaseHandler):
+    """Renders the request metrics collected by `readify.tracing` in this
+    process: histograms of request duration, of the time spent in each phase
+    and of storage calls per request, for each handler.
+
+    Only users listed in `settings.ADMIN_USERNAMES` can read them. Metrics
+    aren't shared between processes, so under the supervisor each response
+    covers only the worker that answered it, whose `pid` is included.
+    """
+    @authenticated
+    def get(self):
+        admins = [u.lower() for u in settings.ADMIN_USERNAMES]
+        if self.current_user.username.lower() not in admins:
+            logging.error('Auth fail: %s is not an admin' % (
+                self.current_user.username))
+            return self.render(status_code=403)
+
+        data = {
+            'pid': os.getpid(),
+            'handlers': request_metrics.to_dict(),
+        }
+        self.add_to_payload('data', data)
+
+        return self.render(status_code=200)
@@ -0,0 +1,207 @@
+import time
+import json
+import codecs
+import logging
+from HTMLParser import HTMLParser
+
+from models import ListItem
+
+
+###
+### Row Parsing
+###
+
+# Parsers are generators of `(row_number, row, error)` tuples. `row` is a dict
+# of item fields, or None if the row couldn't be parsed, in which case `error`
+# says why.
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BookmarkParser(HTMLParser):
+    """Collects links from a Netscape bookmark file, as exported by delicious
+    and most browsers, as they are fed in.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.rows = []
+        self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        attrs = dict(attrs)
+        self._link = {
+            'url': attrs.get('href'),
+            'title': u'',
+            'tags': attrs.get('tags'),
+            'add_date': attrs.get('add_date'),
+        }
+
+    def handle_data(self, data):
+        if self._link is not None:
+            self._link['title'] += data
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % (name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % (name)))
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._link is not None:
+            self.rows.append(self._link)
+            self._link = None
+
+
+def iter_bookmarks_html(stream, chunk_size=CHUNK_SIZE):
+    """Parses a Netscape bookmark file from `stream` a chunk at a time.
+    """
+    parser = BookmarkParser()
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    row_number = 0
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if chunk:
+            parser.feed(decoder.decode(chunk))
+        else:
+            parser.feed(decoder.decode('', final=True))
+            parser.close()
+
+        for link in parser.rows:
+            row_number += 1
+            try:
+                row = {
+                    'url': link['url'],
+                    'title': link['title'].strip() or link['url'],
+                    'tags': link['tags'],
+                }
+                if link['add_date']:
+                    row['created_at'] = int(link['add_date']) * 1000
+                yield (row_number, row, None)
+            except ValueError, e:
+                yield (row_number, None, 'bad add_date: %s' % (e))
+        parser.rows = []
+
+        if not chunk:
+            break
+
+
+def iter_jsonl(stream):
+    """Parses one JSON object per line from `stream`. Blank lines are skipped.
+    """
+    for (row_number, line) in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError, e:
+            yield (row_number, None, 'bad json: %s' % (e))
+            continue
+        if not isinstance(row, dict):
+            yield (row_number, None, 'not an object')
+            continue
+        yield (row_number, row, None)
+
+
+row_parsers = {
+    'html': iter_bookmarks_html,
+    'jsonl': iter_jsonl,
+}
+
+
+###
+### Importing
+###
+
+def build_listitem(user, row, now):
+    """Turns a parsed row into a validated `ListItem` owned by `user`. Raises
+    an exception if the row isn't valid.
+    """
+    url = row.get('url')
+    if not url:
+        raise ValueError('missing url')
+    # Matches the normalization done by `ItemAddHandler`
+    if not url.startswith('http'):
+        url = 'http://%s' % (url)
+
+    tags = row.get('tags')
+    if isinstance(tags, basestring):
+        tags = [t.strip() for t in tags.split(',') if t.strip()]
+
+    # `updated_at` is the time of the import so syncing clients see the items
+    link_item = {
+        'owner_id': user.id,
+        'owner_username': user.username,
+        'created_at': row.get('created_at') or now,
+        'updated_at': now,
+
+        'title': row.get('title') or url,
+        'url': url,
+        'tags': tags or None,
+        'liked': bool(row.get('liked')),
+        'archived': bool(row.get('archived')),
+    }
+
+    item = ListItem(**link_item)
+    item.validate()
+    return item
+
+
+def import_rows(storage, user, rows, batch_size=500, progress=None):
+    """Validates the rows produced by a parser in `row_parsers` and writes
+    them to `user`'s list in batches, through a `readify.storage` engine.
+
+    `progress` is called with the running report after each batch. The final
+    report is returned as a dict with the number of imported items, the
+    number of duplicates skipped because the user already had their URL, the
+    rejected rows as `(row_number, reason)` tuples, the elapsed seconds and
+    the rate in items per second.
+    """
+    started = time.time()
+    now = int(started * 1000)
+    report = {
+        'imported': 0,
+        'duplicates': 0,
+        'rejected': [],
+        'elapsed': 0.0,
+        'rate': 0.0,
+    }
+
+    def flush(batch):
+        item_ids = storage.insert_listitems(user.id, batch)
+        storage.enqueue_enrichment(item_ids)
+        report['imported'] += len(item_ids)
+        report['duplicates'] += len(batch) - len(item_ids)
+        report['elapsed'] = time.time() - started
+        report['rate'] = report['imported'] / max(report['elapsed'], 0.001)
+        if progress is not None:
+            progress(report)
+
+    batch = []
+    for (row_number, row, error) in rows:
+        if row is not None:
+            try:
+                batch.append(build_listitem(user, row, now))
+            except Exception, e:
+                error = str(e) or e.__class__.__name__
+
+        if error is not None:
+            logging.debug('Rejected row %d: %s' % (row_number, error))
+            report['rejected'].append((row_number, error))
+
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+
+    if batch:
+        flush(batch)
+
+    # Indexes are checked once for the whole import
+    storage.ensure_indexes()
+
+    report['elapsed'] = time.time() - started
+    report['rate'] = report['imported'] / max(report['elapsed'], 0.001)
+    return report
@@ -22,8 +22,16 @@ from dictshield.document import swap_field
 ### Override the id fields to be ObjectIdFields
 ###
 
+# `swap_field` only handles `id`. Other fields it swaps lose their name and
+# are left out of `to_python`, so `owner_id` is declared again on each owned
+# model instead. Subclassing rebuilds `id`, so it's swapped last.
+
+class UserProfile(UserProfile):
+    owner_id = ObjectIdField(required=True)
+
+
 User = swap_field(User, ObjectIdField, ['id'])
-UserProfile = swap_field(UserProfile, ObjectIdField, ['id', 'owner_id'])
+UserProfile = swap_field(UserProfile, ObjectIdField, ['id'])
 
 
 ###
@@ -33,6 +41,8 @@ UserProfile = swap_field(UserProfile, ObjectIdField, ['id', 'owner_id'])
 class ListItem(Document, OwnedModelMixin, StreamedModelMixin):
     """Bare minimum to have the concept of streamed item.
     """
+    owner_id = ObjectIdField(required=True)
+
     # status fields
     liked = BooleanField(default=False)
     deleted = BooleanField(default=False)
@@ -42,6 +52,17 @@ class ListItem(Document, OwnedModelMixin, StreamedModelMixin):
     title = StringField(required=True)
     tags = ListField(StringField())
 
+    # key of the shared document for the normalized url, set when saved
+    url_hash = StringField()
+
+    # filled in by `readify.enrichment` after the item is saved
+    canonical_url = URLField()
+    description = StringField()
+
+    # set by the storage engine on every write, including background ones
+    # that leave `updated_at` alone, for incremental syncs
+    changed_at = MillisecondField()
+
     class Meta:
         id_field = ObjectIdField
 
@@ -51,3 +72,8 @@ class ListItem(Document, OwnedModelMixin, StreamedModelMixin):
    
     def __unicode__(self):
         return u'%s' % (self.url)
+
+
+# `id_field` alone stores the id as `id`, so items that are loaded and saved
+# again would be saved as new documents
+ListItem = swap_field(ListItem, ObjectIdField, ['id'])
@@ -0,0 +1,39 @@
+import base64
+import bson
+from bson.errors import InvalidId
+
+
+###
+### Keyset Cursors
+###
+
+def encode_cursor(updated_at, item_id):
+    """Generates an opaque continuation token for the item at the end of a
+    page. Lists are sorted by `(updated_at, _id)`, so that pair is enough to
+    find where the next page starts.
+    """
+    key = '%d:%s' % (updated_at, item_id)
+    return base64.urlsafe_b64encode(key)
+
+
+def decode_cursor(token):
+    """Turns a token generated by `encode_cursor` back into an
+    `(updated_at, _id)` tuple. Returns None if no token was given and raises
+    `ValueError` if the token is malformed.
+    """
+    if not token:
+        return None
+
+    try:
+        key = base64.urlsafe_b64decode(str(token))
+        (updated_at, item_id) = key.split(':', 1)
+        return (int(updated_at), bson.objectid.ObjectId(item_id))
+    except (TypeError, ValueError, InvalidId):
+        raise ValueError('Malformed cursor: %s' % (token))
+
+
+def cursor_for_item(item, field='updated_at'):
+    """Generates a continuation token for a loaded item document. Lists are
+    sorted by `updated_at`, and histories by `changed_at`.
+    """
+    return encode_cursor(item[field], item['_id'])
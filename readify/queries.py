@@ -1,29 +1,76 @@
 #!/usr/bin/env python
 
 
+import os
+import re
+import time
+import logging
+import binascii
 import pymongo
 import bson
+from pymongo.errors import DuplicateKeyError
+from collections import defaultdict
+from bson.errors import InvalidId
+from hashlib import md5, sha256
 
+import settings
 from models import User, UserProfile
+from cache import TTLCache
+from urls import normalize_url, url_hash
 
 
 ###
-### Database config # put in settings abstraction eventually
+### Database Connection Handling
 ###
 
-DB_NAME = 'readify'
+# Connections are configured by the `MONGO_` settings in `readify.settings`
+DB_NAME = settings.DB_NAME
 
 
-###
-### Database Connection Handling
-###
+def connection_options():
+    """The keyword arguments for a pymongo connection built from the pool,
+    timeout and write concern settings.
+    """
+    options = {
+        'max_pool_size': settings.MONGO_MAX_POOL_SIZE,
+        'waitQueueTimeoutMS': settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        'connectTimeoutMS': settings.MONGO_CONNECT_TIMEOUT_MS,
+        'socketTimeoutMS': settings.MONGO_SOCKET_TIMEOUT_MS,
+        'w': settings.MONGO_WRITE_CONCERN,
+    }
+    if settings.MONGO_WRITE_TIMEOUT_MS:
+        options['wtimeout'] = settings.MONGO_WRITE_TIMEOUT_MS
+    return options
+
+
+def init_db_conn(db_name=None, **kwargs):
+    """Connects to MongoDB and returns the database named `db_name`, which
+    defaults to `DB_NAME`. Keyword arguments override `connection_options`.
+    """
+    options = connection_options()
+    options.update(kwargs)
 
-def init_db_conn(**kwargs):
-    dbc = pymongo.Connection(**kwargs)
-    db_conn = dbc[DB_NAME]
+    if settings.MONGO_REPLICA_SET:
+        options.setdefault('replicaSet', settings.MONGO_REPLICA_SET)
+        dbc = pymongo.ReplicaSetConnection(settings.MONGO_HOSTS, **options)
+    else:
+        dbc = pymongo.Connection(settings.MONGO_HOSTS, **options)
+
+    db_conn = dbc[db_name or DB_NAME]
     return db_conn
 
 
+def init_secondary_db(db_conn):
+    """Returns another handle on the database `db_conn` that sends queries to
+    a secondary when one is available. Writes made through it still go to the
+    primary.
+    """
+    secondary_db = db_conn.connection[db_conn.name]
+    read_preference = pymongo.ReadPreference.SECONDARY_PREFERRED
+    secondary_db.read_preference = read_preference
+    return secondary_db
+
+
 def end_request(db_conn):
     """Here as a visual reminder that this funciton must be called at the end
     of a request to return the socket back to pymongo's built-in thread pooling.
@@ -31,29 +78,147 @@ def end_request(db_conn):
     return db_conn.end_request()
 
 
+def current_millis():
+    """The current time in milliseconds, as stored in `MillisecondField`s.
+    """
+    return int(time.time() * 1000)
+
+
+###
+### Caching
+###
+
+# Users and profiles are read on every authenticated request. They're cached
+# for a short time in each process and invalidated when saved.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+
+user_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+userprofile_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+# Marks a cached lookup that found nothing
+NOT_FOUND = 'not found'
+
+
 ###
 ### Index Handling
 ###
 
+INDEX_MARKER_COLLECTION = 'indexmarkers'
+
+
 def apply_all_indexes(db, indexes, collection):
     """Takes a list of indexes and applies them to a collection.
 
-    Intended for use after functions that create/update/delete entire
-    documents.
+    Intended for use by `ensure_indexes`, which is run once at startup or by
+    the `apply_indexes.py` migration command. The write path does no index
+    work.
     """
     for index in indexes:
-        db[collection].ensure_index(index)
+        (keys, options) = index_options(index)
+        db[collection].ensure_index(keys, **options)
 
     return True
 
 
+def index_options(index):
+    """Index declarations are either a list of keys or a tuple of a list of
+    keys and a dict of options for `ensure_index`, eg. `unique`.
+    """
+    if isinstance(index, tuple):
+        return index
+    return (index, {})
+
+
+def index_signature(indexes):
+    """Generates a version marker for a list of index declarations. Changing
+    the declarations changes the marker, which causes `ensure_indexes` to
+    apply them again.
+    """
+    return md5(repr(indexes)).hexdigest()
+
+
+def index_spec(index):
+    """Describes a declared index the way `index_information` reports it:
+    its keys, whether it's unique or sparse and its partial filter. Text
+    indexes are reported with their text fields replaced by `_fts` and
+    `_ftsx` keys.
+    """
+    (keys, options) = index_options(index)
+    key = []
+    for (field, direction) in keys:
+        if direction != 'text':
+            key.append((field, direction))
+        elif ('_fts', 'text') not in key:
+            key.extend([('_fts', 'text'), ('_ftsx', 1)])
+    return (key, bool(options.get('unique')), bool(options.get('sparse')),
+            options.get('partialFilterExpression'))
+
+
+def drop_stale_indexes(db, indexes, collection):
+    """Drops any index on `collection` that isn't in the list of declared
+    indexes, including one on declared keys whose `unique`, `sparse` or
+    `partialFilterExpression` option changed. The `_id` index is always kept.
+    """
+    declared = [index_spec(index) for index in indexes]
+    dropped = []
+    for name, info in db[collection].index_information().items():
+        if name == '_id_':
+            continue
+        key = [(field, direction) for (field, direction) in info['key']]
+        spec = (key, bool(info.get('unique')), bool(info.get('sparse')),
+                info.get('partialFilterExpression'))
+        if spec not in declared:
+            db[collection].drop_index(name)
+            dropped.append(name)
+
+    return dropped
+
+
+def ensure_indexes(db, force=False, drop_stale=False):
+    """Applies the indexes declared for each collection in `collection_indexes`
+    if the version marker stored for that collection doesn't match the
+    current declarations.
+
+    Indexes that are no longer declared are only dropped if `drop_stale` is
+    set. That's checked whether or not the marker matches, and a collection
+    that had indexes dropped has its declared indexes applied again, which
+    replaces any that were dropped for a changed option.
+
+    Returns the list of collections that had indexes applied.
+    """
+    applied = []
+    for collection, indexes in collection_indexes.items():
+        dropped = []
+        if drop_stale:
+            dropped = drop_stale_indexes(db, indexes, collection)
+            for name in dropped:
+                logging.info('Dropped stale index <%s> on <%s>' % (name,
+                                                                  collection))
+
+        signature = index_signature(indexes)
+        marker = db[INDEX_MARKER_COLLECTION].find_one({'_id': collection})
+        if (not force and not dropped and marker
+                and marker.get('signature') == signature):
+            continue
+
+        apply_all_indexes(db, indexes, collection)
+        db[INDEX_MARKER_COLLECTION].save({'_id': collection,
+                                          'signature': signature})
+        applied.append(collection)
+
+    return applied
+
+
 ###
 ### User Handling
 ###
 
 USER_COLLECTION = 'users'
 indexes_user = [
-    [('username', pymongo.ASCENDING)],
+    # Usernames are stored lowercased, so names that only differ in case
+    # collide too
+    ([('username', pymongo.ASCENDING)], {'unique': True}),
 ]
     
 
@@ -66,7 +231,11 @@ def load_user(db, username=None, email=None):
     else:
         raise ValueError('Username field required')
 
-    user_dict = db[USER_COLLECTION].find_one(query_dict)
+    user_dict = user_cache.get(query_dict['username'])
+    if user_dict is None:
+        user_dict = db[USER_COLLECTION].find_one(query_dict)
+        if user_dict is not None:
+            user_cache.set(query_dict['username'], user_dict)
 
     # In most cases, the python representation of the data is returned. User
     # documents are instantiated to provide access to commonly needed User
@@ -85,7 +254,7 @@ def save_user(db, user):
     uid = db[USER_COLLECTION].insert(user_doc)
     user._id = uid
 
-    apply_all_indexes(db, indexes_user, USER_COLLECTION)
+    user_cache.delete(user.username.lower())
 
     return uid
 
@@ -112,9 +281,18 @@ def load_userprofile(db, owner_username=None, owner_id=None):
     else:
         raise ValueError('<owner_username> or <owner_id> field required')
 
-    userprofile_dict = db[USERPROFILE_COLLECTION].find_one(query_dict)
-    
-    return userprofile_dict
+    cache_key = query_dict.items()[0]
+    userprofile_dict = userprofile_cache.get(cache_key)
+    if userprofile_dict is None:
+        userprofile_dict = db[USERPROFILE_COLLECTION].find_one(query_dict)
+        # Users without a profile are common, so misses are cached too
+        userprofile_cache.set(cache_key, userprofile_dict or NOT_FOUND)
+
+    if not userprofile_dict or userprofile_dict == NOT_FOUND:
+        return None
+
+    # Callers are free to modify the returned dict
+    return dict(userprofile_dict)
 
 
 def save_userprofile(db, userprofile):
@@ -123,26 +301,226 @@ def save_userprofile(db, userprofile):
     userprofile_doc = userprofile.to_python()
     userprofile.id = db[USERPROFILE_COLLECTION].save(userprofile_doc)
 
-    apply_all_indexes(db, indexes_userprofile, USERPROFILE_COLLECTION)
+    userprofile_cache.delete(('owner_id', userprofile.owner_id))
+    userprofile_cache.delete(('owner_username',
+                              userprofile.owner_username.lower()))
+    bump_owner_version(db, userprofile.owner_id)
 
     return userprofile.id
 
 
+###
+### API Token Handling
+###
+
+# API clients authenticate with issued tokens instead of a password. Only a
+# hash of each token is stored. Tokens are long and random, so a fast hash is
+# enough, unlike passwords.
+APITOKEN_COLLECTION = 'apitokens'
+indexes_apitoken = [
+    ([('token_hash', pymongo.ASCENDING)], {'unique': True}),
+    [('owner_id', pymongo.ASCENDING)],
+]
+
+API_TOKEN_BYTES = 20
+
+# Verified tokens are cached in each process, keyed by their hash. Revoking a
+# token drops it from the cache of the process that revoked it, so the TTL
+# bounds how long other processes keep accepting it.
+APITOKEN_CACHE_TTL = 60
+
+apitoken_cache = TTLCache(max_size=USER_CACHE_SIZE, ttl=APITOKEN_CACHE_TTL)
+
+
+def generate_api_token():
+    return binascii.hexlify(os.urandom(API_TOKEN_BYTES))
+
+
+def hash_api_token(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return sha256(token).hexdigest()
+
+
+def create_api_token(db, user, name=None):
+    """Issues a new API token for `user`. Returns the token, which can't be
+    recovered later, and the stored token document.
+    """
+    token = generate_api_token()
+    token_doc = {
+        'token_hash': hash_api_token(token),
+        'owner_id': user.id,
+        'owner_username': user.username,
+        'name': name,
+        'created_at': current_millis(),
+        'revoked': False,
+    }
+    token_doc['_id'] = db[APITOKEN_COLLECTION].insert(token_doc)
+
+    return (token, token_doc)
+
+
+def verify_api_token(db, token):
+    """Returns the document for `token` if it was issued and hasn't been
+    revoked, otherwise None.
+    """
+    token_hash = hash_api_token(token)
+    token_doc = apitoken_cache.get(token_hash)
+    if token_doc is None:
+        token_doc = db[APITOKEN_COLLECTION].find_one({'token_hash': token_hash,
+                                                      'revoked': False})
+        # Misses are cached too, so a client retrying a bad token doesn't
+        # query for it every time. Tokens are never reissued.
+        apitoken_cache.set(token_hash, token_doc or NOT_FOUND)
+
+    if not token_doc or token_doc == NOT_FOUND:
+        return None
+    return token_doc
+
+
+def load_api_tokens(db, owner_id):
+    """Loads the unrevoked tokens issued to `owner_id`, oldest first. Token
+    hashes are left out.
+    """
+    query_set = db[APITOKEN_COLLECTION].find({'owner_id': owner_id,
+                                              'revoked': False},
+                                             fields={'token_hash': False})
+    query_set.sort('created_at', pymongo.ASCENDING)
+    return query_set
+
+
+def revoke_api_token(db, owner_id, token_id):
+    """Revokes one of the tokens issued to `owner_id`. Returns True if an
+    unrevoked token was found.
+    """
+    try:
+        token_id = bson.objectid.ObjectId(unicode(token_id))
+    except (TypeError, InvalidId):
+        return False
+
+    token_doc = db[APITOKEN_COLLECTION].find_and_modify(
+        {'_id': token_id, 'owner_id': owner_id, 'revoked': False},
+        {'$set': {'revoked': True, 'revoked_at': current_millis()}})
+    if token_doc is None:
+        return False
+
+    apitoken_cache.delete(token_doc['token_hash'])
+    return True
+
+
+###
+### Owner Versions
+###
+
+# Each owner has a counter that is bumped whenever their items or profile
+# change, along with the time of the change. Cached renderings of their pages
+# and the validators for conditional requests are derived from them.
+OWNERVERSION_COLLECTION = 'ownerversions'
+
+
+def load_owner_version(db, owner_id):
+    """Loads the current version counter for `owner_id`.
+    """
+    return load_owner_state(db, owner_id)['version']
+
+
+def load_owner_state(db, owner_id):
+    """Loads the version counter for `owner_id` and the time it was last
+    bumped, in milliseconds. The time is None for owners that haven't changed
+    anything since it was recorded.
+    """
+    version_doc = db[OWNERVERSION_COLLECTION].find_one({'_id': owner_id})
+    if version_doc is None:
+        return {'version': 0, 'changed_at': None}
+    return {
+        'version': version_doc['version'],
+        'changed_at': version_doc.get('changed_at'),
+    }
+
+
+def bump_owner_version(db, owner_id):
+    """Increments the version counter for `owner_id`.
+    """
+    db[OWNERVERSION_COLLECTION].update({'_id': owner_id},
+                                       {'$inc': {'version': 1},
+                                        '$set': {'changed_at':
+                                                 current_millis()}},
+                                       upsert=True)
+
+
 ###
 ### ListItem Handling
 ###
 
 LISTITEM_COLLECTION = 'listitems'
+listitem_sort = [
+    ('updated_at', pymongo.DESCENDING),
+    ('_id', pymongo.DESCENDING),
+]
+# How much a search match in each field counts towards an item's score
+listitem_search_weights = {
+    'title': 10,
+    'tags': 5,
+    'url': 1,
+}
 indexes_listitem = [
-    [('owner_id', pymongo.ASCENDING)],
-    [('owner_username', pymongo.ASCENDING)],
+    # Dashboard, archive and API lists
+    [('owner_id', pymongo.ASCENDING),
+     ('archived', pymongo.ASCENDING),
+     ('deleted', pymongo.ASCENDING)] + listitem_sort,
+    # Liked list, which ignores `archived`
+    [('owner_id', pymongo.ASCENDING),
+     ('liked', pymongo.ASCENDING),
+     ('deleted', pymongo.ASCENDING)] + listitem_sort,
+    # Public profile list
+    [('owner_username', pymongo.ASCENDING),
+     ('deleted', pymongo.ASCENDING)] + listitem_sort,
+    # Full history, oldest change first
+    [('owner_id', pymongo.ASCENDING),
+     ('changed_at', pymongo.ASCENDING),
+     ('_id', pymongo.ASCENDING)],
+    # Tag filtered dashboard and archive lists. `tags` is multikey, so only
+    # the first tag of an `$all` query bounds the scan.
+    [('owner_id', pymongo.ASCENDING),
+     ('tags', pymongo.ASCENDING),
+     ('archived', pymongo.ASCENDING),
+     ('deleted', pymongo.ASCENDING)] + listitem_sort,
+    # Tag filtered liked list
+    [('owner_id', pymongo.ASCENDING),
+     ('tags', pymongo.ASCENDING),
+     ('liked', pymongo.ASCENDING),
+     ('deleted', pymongo.ASCENDING)] + listitem_sort,
+    # One item per owner and normalized URL. Only items with a `url_hash` are
+    # indexed, so items saved before it existed don't collide on a null key
+    # until they're backfilled. A sparse index wouldn't do: it still indexes
+    # every item that has an `owner_id`.
+    ([('owner_id', pymongo.ASCENDING),
+      ('url_hash', pymongo.ASCENDING)],
+     {'unique': True,
+      'partialFilterExpression': {'url_hash': {'$exists': True}}}),
+    # Search, see `search_listitems`
+    ([('owner_id', pymongo.ASCENDING),
+      ('title', 'text'),
+      ('url', 'text'),
+      ('tags', 'text')],
+     {'name': 'listitem_search',
+      'weights': listitem_search_weights}),
 ]
     
 
 def load_listitems(db, item_id=None, owner_id=None, owner_username=None,
                    archived=False, deleted=False, liked=None, tags=None,
-                   updated_after=None):
-    """Loads a user document from MongoDB.
+                   updated_after=None, before=None, skip=None, limit=None,
+                   fields=None):
+    """Loads list items from MongoDB, newest first.
+
+    `before` is an `(updated_at, _id)` tuple, as decoded from a continuation
+    token, and limits the results to items that sort after it. Ties on
+    `updated_at` are broken by `_id`, so each page costs the same index range
+    scan no matter how deep it is.
+
+    `fields` is passed to `find` as the projection, so callers can load only
+    the fields they render.
     """
     query_dict = dict()
  
@@ -168,26 +546,236 @@ def load_listitems(db, item_id=None, owner_id=None, owner_username=None,
         query_dict['tags'] = {'$all': tags}
     if updated_after is not None:
         query_dict['updated_at'] = {'$gte': updated_after}
+    if before is not None:
+        (before_updated, before_id) = before
+        query_dict.setdefault('updated_at', {})['$lte'] = before_updated
+        # Skips the items at `before_updated` that were on earlier pages
+        query_dict['$nor'] = [{'updated_at': before_updated,
+                               '_id': {'$gte': before_id}}]
+
+    query_set = db[LISTITEM_COLLECTION].find(query_dict, fields=fields)
+    query_set.sort(listitem_sort)
+    if skip:
+        query_set.skip(skip)
+    if limit:
+        query_set.limit(limit)
 
-    query_set = db[LISTITEM_COLLECTION].find(query_dict)
     return query_set
 
+def load_listitem_history(db, owner_id, since=None, after=None,
+                          include_deleted=False, fields=None, limit=None,
+                          batch_size=None):
+    """Loads every item owned by `owner_id`, oldest change first, regardless
+    of its archived or liked state. Deleted items are only included if
+    `include_deleted` is set.
+
+    Changes are ordered by `changed_at`, which every write sets, unlike
+    `updated_at`, which orders lists and is left alone by background updates.
+    `since` limits the results to items changed at or after that time, which
+    lets a long read resume where it stopped. `after` is a `(changed_at,
+    _id)` tuple and limits the results to changes made after that item.
+    """
+    query_dict = {
+        'owner_id': owner_id,
+    }
+    if not include_deleted:
+        query_dict['deleted'] = False
+    if since is not None:
+        query_dict['changed_at'] = {'$gte': since}
+    if after is not None:
+        (after_changed, after_id) = after
+        changed_range = query_dict.setdefault('changed_at', {})
+        changed_range['$gte'] = max(after_changed,
+                                    changed_range.get('$gte', after_changed))
+        # Skips the items at `after_changed` that were already seen
+        query_dict['$nor'] = [{'changed_at': after_changed,
+                               '_id': {'$lte': after_id}}]
+
+    query_set = db[LISTITEM_COLLECTION].find(query_dict, fields=fields)
+    query_set.sort([('changed_at', pymongo.ASCENDING),
+                    ('_id', pymongo.ASCENDING)])
+    if limit:
+        query_set.limit(limit)
+    if batch_size:
+        query_set.batch_size(batch_size)
+
+    return query_set
+
+
+def search_listitems(db, owner_id, terms, skip=None, limit=None,
+                     fields=None):
+    """Searches the titles, URLs and tags of `owner_id`'s items that aren't
+    deleted, best match first.
+
+    Uses the `listitem_search` text index, which is prefixed by `owner_id`
+    so only the owner's items are scanned. Each result has its match `score`.
+    """
+    query_dict = {
+        'owner_id': owner_id,
+        'deleted': False,
+        '$text': {'$search': terms},
+    }
+
+    score = {'$meta': 'textScore'}
+    projection = {'score': score}
+    if fields:
+        projection.update((field, True) for field in fields)
+
+    query_set = db[LISTITEM_COLLECTION].find(query_dict, fields=projection)
+    query_set.sort([('score', score)])
+    if skip:
+        query_set.skip(skip)
+    if limit:
+        query_set.limit(limit)
+
+    return query_set
+
+
+def load_listitem_by_url(db, owner_id, url, fields=None):
+    """Loads `owner_id`'s item for `url`, or any URL that normalizes to the
+    same address. Returns None if they haven't saved it.
+    """
+    query_dict = {
+        'owner_id': owner_id,
+        'url_hash': url_hash(normalize_url(url)),
+    }
+    return db[LISTITEM_COLLECTION].find_one(query_dict, fields=fields)
+
+
+def load_listitem_by_id(db, item_id, fields=None):
+    """Loads an item by its id alone, whoever owns it, for background work
+    like enrichment. Returns None if there's no such item.
+    """
+    return db[LISTITEM_COLLECTION].find_one({'_id': item_id}, fields=fields)
+
+
 def save_listitem(db, item):
-    """Loads a user document from MongoDB.
+    """Saves an item to MongoDB.
+
+    Items reference the shared document for their normalized URL in the
+    `urls` collection by `url_hash`. Each owner has at most one item per
+    normalized URL. Saving a new item for a URL the owner already has
+    updates the existing item instead, keeping its `created_at` and `liked`
+    state. A deleted item is restored this way too, as `insert_listitems`
+    does. Changing an item's URL to one the owner already has raises
+    `DuplicateKeyError`.
     """
     item_doc = item.to_python()
-    item_id = db[LISTITEM_COLLECTION].save(item_doc)
+    item_doc['url_hash'] = url_hash(normalize_url(item_doc['url']))
+    item_doc['changed_at'] = current_millis()
+
+    # The previous version of the item is needed to adjust tag counts
+    previous = None
+    previous_fields = ['tags', 'deleted', 'created_at', 'liked']
+    if item_doc.get('_id'):
+        previous = db[LISTITEM_COLLECTION].find_one(
+            {'_id': item_doc['_id']}, fields=previous_fields)
+    else:
+        previous = load_listitem_by_url(db, item_doc['owner_id'],
+                                        item_doc['url'],
+                                        fields=previous_fields)
+        if previous is not None:
+            item_doc['_id'] = previous['_id']
+            item_doc['created_at'] = previous['created_at']
+            item_doc['liked'] = previous.get('liked', False)
+
+    try:
+        item_id = db[LISTITEM_COLLECTION].save(item_doc)
+    except DuplicateKeyError:
+        if previous is not None:
+            raise
+        # Another request saved the same URL first, so update that item
+        return save_listitem(db, item)
     item._id = item_id
 
-    apply_all_indexes(db, indexes_listitem, LISTITEM_COLLECTION)
+    tag_deltas = defaultdict(int)
+    count_tags(tag_deltas, previous, -1)
+    count_tags(tag_deltas, item_doc, 1)
+    adjust_tag_counts(db, item.owner_id, tag_deltas)
+
+    bump_owner_version(db, item.owner_id)
 
     return item_id
 
+
+def insert_listitems(db, owner_id, items):
+    """Inserts a batch of new, validated items with a single insert. All
+    items must belong to `owner_id`.
+
+    Items for URLs the owner already has in their list, or that appear
+    earlier in the batch, are skipped. Items for URLs the owner deleted
+    restore the deleted item, keeping its `created_at` and `liked` state,
+    as `save_listitem` does. Returns the list of new and restored item ids.
+    """
+    item_docs = []
+    seen = set()
+    now = current_millis()
+    for item in items:
+        item_doc = item.to_python()
+        item_doc.pop('_id', None)
+        item_doc['url_hash'] = url_hash(normalize_url(item_doc['url']))
+        item_doc['changed_at'] = now
+        if item_doc['url_hash'] not in seen:
+            seen.add(item_doc['url_hash'])
+            item_docs.append(item_doc)
+
+    # One indexed lookup finds the URLs the owner already has
+    existing = db[LISTITEM_COLLECTION].find(
+        {'owner_id': owner_id, 'url_hash': {'$in': list(seen)}},
+        fields=['url_hash', 'deleted', 'created_at', 'liked'])
+    existing = dict((doc['url_hash'], doc) for doc in existing)
+
+    new_docs = []
+    restored_docs = []
+    for item_doc in item_docs:
+        previous = existing.get(item_doc['url_hash'])
+        if previous is None:
+            new_docs.append(item_doc)
+        elif previous.get('deleted'):
+            item_doc['_id'] = previous['_id']
+            item_doc['created_at'] = previous['created_at']
+            item_doc['liked'] = previous.get('liked', False)
+            restored_docs.append(item_doc)
+
+    if new_docs:
+        try:
+            db[LISTITEM_COLLECTION].insert(new_docs, continue_on_error=True)
+        except DuplicateKeyError:
+            # Another request saved some of the same URLs first. The rest
+            # were inserted, and are found by the ids the driver gave them.
+            inserted = db[LISTITEM_COLLECTION].find(
+                {'_id': {'$in': [doc['_id'] for doc in new_docs]}},
+                fields=['_id'])
+            inserted = set(doc['_id'] for doc in inserted)
+            new_docs = [doc for doc in new_docs if doc['_id'] in inserted]
+
+    # Restoring is rare, so each restored item is saved on its own
+    for item_doc in restored_docs:
+        db[LISTITEM_COLLECTION].save(item_doc)
+
+    item_docs = new_docs + restored_docs
+    if not item_docs:
+        return []
+
+    # Deleted items don't count towards tags, so restored ones count as new
+    tag_deltas = defaultdict(int)
+    for item_doc in item_docs:
+        count_tags(tag_deltas, item_doc, 1)
+    adjust_tag_counts(db, owner_id, tag_deltas)
+
+    bump_owner_version(db, owner_id)
+
+    return [item_doc['_id'] for item_doc in item_docs]
+
+
 def update_listitem(db, owner_id, item_id, archived=None, liked=None,
                     deleted=None):
     """`archive` should be boolean
     `like` should be boolean
     `delete` should be boolean
+
+    `updated_at` and `changed_at` are set too, so the change shows up in
+    incremental syncs.
     """
     query_dict = {
         '_id': bson.objectid.ObjectId(unicode(item_id)), # string is given
@@ -205,7 +793,378 @@ def update_listitem(db, owner_id, item_id, archived=None, liked=None,
     else:
         return None
 
-    # TODO set updated_at
-    db[LISTITEM_COLLECTION].update(query_dict, {'$set': update_dict})
+    update_dict['updated_at'] = update_dict['changed_at'] = current_millis()
+    if deleted is None:
+        db[LISTITEM_COLLECTION].update(query_dict, {'$set': update_dict})
+    else:
+        # Deleted items don't count towards tags, so the previous state of
+        # the item is needed
+        previous = db[LISTITEM_COLLECTION].find_and_modify(
+            query_dict, {'$set': update_dict}, fields=['tags', 'deleted'])
+        if previous is not None and previous.get('deleted') != deleted:
+            tag_deltas = defaultdict(int)
+            count_tags(tag_deltas, previous, -1 if deleted else 1,
+                       include_deleted=True)
+            adjust_tag_counts(db, owner_id, tag_deltas)
+
+    bump_owner_version(db, owner_id)
+
+    return True
+
+
+# Maps each item action to the flag it sets
+listitem_actions = {
+    'archive': ('archived', True),
+    'unarchive': ('archived', False),
+    'like': ('liked', True),
+    'unlike': ('liked', False),
+    'delete': ('deleted', True),
+    'undelete': ('deleted', False),
+}
+
+
+def bulk_update_listitems(db, owner_id, item_ids, action):
+    """Applies `action`, a key of `listitem_actions`, to every item in
+    `item_ids` owned by `owner_id` with a single multi-document update.
+
+    Returns a dict mapping each given id to `updated`, `not_found` or
+    `invalid`.
+    """
+    if action not in listitem_actions:
+        raise ValueError('Unknown action: %s' % (action))
+    (field, value) = listitem_actions[action]
+
+    results = dict()
+    object_ids = dict()
+    for item_id in item_ids:
+        try:
+            object_ids[item_id] = bson.objectid.ObjectId(unicode(item_id))
+        except (TypeError, InvalidId):
+            results[item_id] = 'invalid'
+
+    if not object_ids:
+        return results
+
+    query_dict = {
+        '_id': {'$in': object_ids.values()},
+        'owner_id': owner_id,
+    }
+    found_docs = list(db[LISTITEM_COLLECTION].find(
+        query_dict, fields=['_id', 'tags', 'deleted']))
+    found = set(doc['_id'] for doc in found_docs)
+
+    if found:
+        now = current_millis()
+        update_dict = {
+            field: value,
+            'updated_at': now,
+            'changed_at': now,
+        }
+        db[LISTITEM_COLLECTION].update(query_dict, {'$set': update_dict},
+                                       multi=True)
+
+        if field == 'deleted':
+            tag_deltas = defaultdict(int)
+            for doc in found_docs:
+                if doc.get('deleted') != value:
+                    count_tags(tag_deltas, doc, -1 if value else 1,
+                               include_deleted=True)
+            adjust_tag_counts(db, owner_id, tag_deltas)
+
+        bump_owner_version(db, owner_id)
+
+    for (item_id, object_id) in object_ids.items():
+        if object_id in found:
+            results[item_id] = 'updated'
+        else:
+            results[item_id] = 'not_found'
+
+    return results
+
+
+###
+### Tag Counts
+###
+
+# The number of items using each tag is kept per owner, counting every item
+# that isn't deleted. Writes to list items adjust the counts as they go.
+TAGCOUNT_COLLECTION = 'tagcounts'
+indexes_tagcount = [
+    ([('owner_id', pymongo.ASCENDING),
+      ('tag', pymongo.ASCENDING)], {'unique': True}),
+    [('owner_id', pymongo.ASCENDING),
+     ('count', pymongo.DESCENDING)],
+]
+
+
+def count_tags(tag_deltas, item_doc, delta, include_deleted=False):
+    """Adds `delta` to `tag_deltas` for each tag of `item_doc`. Deleted items
+    are skipped unless `include_deleted` is set.
+    """
+    if item_doc is None:
+        return
+    if item_doc.get('deleted') and not include_deleted:
+        return
+    for tag in set(item_doc.get('tags') or []):
+        tag_deltas[tag] += delta
+
+
+def adjust_tag_counts(db, owner_id, tag_deltas):
+    """Applies a dict of tag count changes for `owner_id`. Tags that drop to
+    zero are removed.
+    """
+    for (tag, delta) in tag_deltas.items():
+        if not delta:
+            continue
+        db[TAGCOUNT_COLLECTION].update({'owner_id': owner_id, 'tag': tag},
+                                       {'$inc': {'count': delta}},
+                                       upsert=True)
+        if delta < 0:
+            db[TAGCOUNT_COLLECTION].remove({'owner_id': owner_id,
+                                            'tag': tag,
+                                            'count': {'$lte': 0}})
+
+
+def load_tags(db, owner_id, prefix=None, limit=50):
+    """Loads `owner_id`'s tags with their item counts. Tags are sorted by
+    count, or alphabetically when autocompleting a `prefix`.
+    """
+    query_dict = {
+        'owner_id': owner_id,
+    }
+    if prefix:
+        query_dict['tag'] = {'$regex': '^%s' % (re.escape(prefix))}
+        sort = [('tag', pymongo.ASCENDING)]
+    else:
+        sort = [('count', pymongo.DESCENDING)]
+
+    query_set = db[TAGCOUNT_COLLECTION].find(query_dict,
+                                             fields=['tag', 'count'])
+    query_set.sort(sort).limit(limit)
+
+    return [{'tag': t['tag'], 'count': t['count']} for t in query_set]
+
+
+def rebuild_tag_counts(db, owner_id):
+    """Recounts `owner_id`'s tags from their items, replacing the stored
+    counts. Used to backfill or repair counts.
+    """
+    tag_deltas = defaultdict(int)
+    for item_doc in load_listitem_history(db, owner_id,
+                                          fields=['tags', 'deleted']):
+        count_tags(tag_deltas, item_doc, 1)
+
+    db[TAGCOUNT_COLLECTION].remove({'owner_id': owner_id})
+    if tag_deltas:
+        db[TAGCOUNT_COLLECTION].insert([
+            {'owner_id': owner_id, 'tag': tag, 'count': count}
+            for (tag, count) in tag_deltas.items()])
+
+
+def rebuild_all_tag_counts(db):
+    """Runs `rebuild_tag_counts` for every owner with list items.
+    """
+    owner_ids = db[LISTITEM_COLLECTION].distinct('owner_id')
+    for owner_id in owner_ids:
+        rebuild_tag_counts(db, owner_id)
+
+    return len(owner_ids)
+
+
+###
+### Link Enrichment
+###
+
+# Newly saved items are queued for `readify.enrichment`, which fetches their
+# pages outside the request path.
+ENRICHMENT_COLLECTION = 'enrichmentqueue'
+indexes_enrichment = [
+    [('state', pymongo.ASCENDING),
+     ('next_attempt_at', pymongo.ASCENDING)],
+]
+
+# One document per normalized URL, keyed by the `url_hash` stored on items.
+# It holds the metadata fetched for the URL, shared by every user who saves
+# it, and is created by the first fetch.
+URL_COLLECTION = 'urls'
+
+
+def enqueue_enrichment(db, item_ids):
+    """Queues items to have their page metadata fetched, with one insert.
+    Items that are already queued keep their place.
+    """
+    if not item_ids:
+        return
+
+    now = current_millis()
+    jobs = [{'_id': item_id,
+             'state': 'pending',
+             'queued_at': now,
+             'next_attempt_at': now,
+             'attempts': 0} for item_id in item_ids]
+    try:
+        db[ENRICHMENT_COLLECTION].insert(jobs, continue_on_error=True)
+    except DuplicateKeyError:
+        pass
+
+
+def claim_enrichment(db, stale_after):
+    """Claims the pending job that has waited longest for its next attempt,
+    or a job whose worker hasn't finished it within `stale_after`
+    milliseconds. Jobs waiting to be retried aren't claimed until their
+    `next_attempt_at`. Returns None if there's no work.
+    """
+    now = current_millis()
+    query_dict = {
+        '$or': [
+            {'state': 'pending', 'next_attempt_at': {'$lte': now}},
+            # Queued before retries were delayed
+            {'state': 'pending', 'next_attempt_at': None},
+            {'state': 'working', 'claimed_at': {'$lt': now - stale_after}},
+        ],
+    }
+    update_dict = {
+        '$set': {'state': 'working', 'claimed_at': now},
+        '$inc': {'attempts': 1},
+    }
+    return db[ENRICHMENT_COLLECTION].find_and_modify(
+        query_dict, update_dict,
+        sort=[('next_attempt_at', pymongo.ASCENDING)], new=True)
+
+
+def finish_enrichment(db, item_id):
+    db[ENRICHMENT_COLLECTION].remove({'_id': item_id})
+
+
+def retry_delay_for(job, retry_delay):
+    """Milliseconds to wait before the next attempt at a job, doubling with
+    each attempt made.
+    """
+    return retry_delay * 2 ** max(job['attempts'] - 1, 0)
+
+
+def retry_enrichment(db, job, max_attempts, retry_delay):
+    """Puts a failed job back in the queue, to be claimed again after an
+    exponential backoff starting at `retry_delay` milliseconds, or drops it
+    after `max_attempts`.
+    """
+    if job['attempts'] >= max_attempts:
+        return finish_enrichment(db, job['_id'])
+    next_attempt_at = current_millis() + retry_delay_for(job, retry_delay)
+    db[ENRICHMENT_COLLECTION].update({'_id': job['_id']},
+                                     {'$set': {'state': 'pending',
+                                               'next_attempt_at':
+                                                   next_attempt_at}})
+
+
+def load_url_metadata(db, url_key):
+    return db[URL_COLLECTION].find_one({'_id': url_key})
+
+
+def save_url_metadata(db, url_key, metadata):
+    metadata = dict(metadata)
+    metadata['_id'] = url_key
+    db[URL_COLLECTION].save(metadata)
+
+
+def url_metadata_update(item_doc, metadata):
+    """The fields to set on an item, given as a dict with at least its `url`
+    and `title`, to copy fetched page metadata onto it. The title is only
+    replaced if the user didn't give one, which the bookmarklet does by
+    saving the URL as the title.
+
+    Only `changed_at` is set, so syncing clients get the metadata without
+    the item moving to the top of its lists.
+    """
+    update_dict = {
+        'canonical_url': metadata['canonical_url'],
+        'changed_at': current_millis(),
+    }
+    if metadata.get('description'):
+        update_dict['description'] = metadata['description']
+    if metadata.get('title') and item_doc['title'] in ('', item_doc['url']):
+        update_dict['title'] = metadata['title']
+    return update_dict
+
+
+def apply_url_metadata(db, item_doc, metadata):
+    """Copies fetched page metadata onto an item, given as a dict with at
+    least its `_id`, `owner_id`, `url` and `title`. See
+    `url_metadata_update`.
+    """
+    update_dict = url_metadata_update(item_doc, metadata)
+    db[LISTITEM_COLLECTION].update({'_id': item_doc['_id']},
+                                   {'$set': update_dict})
+    bump_owner_version(db, item_doc['owner_id'])
 
     return True
+
+
+def backfill_url_hashes(db):
+    """Sets `url_hash` on items saved before it existed. When an owner has
+    several items for the same URL only the most recently updated one gets
+    the hash, as the unique index allows one per owner.
+
+    Returns the number of items updated.
+    """
+    query_set = db[LISTITEM_COLLECTION].find(
+        {'url_hash': {'$exists': False}}, fields=['owner_id', 'url'])
+    query_set.sort([('owner_id', pymongo.ASCENDING),
+                    ('updated_at', pymongo.DESCENDING)])
+
+    updated = 0
+    owner_id = None
+    owner_hashes = set()
+    for item_doc in query_set:
+        if item_doc['owner_id'] != owner_id:
+            owner_id = item_doc['owner_id']
+            owner_hashes = set(doc['url_hash'] for doc in
+                               db[LISTITEM_COLLECTION].find(
+                                   {'owner_id': owner_id,
+                                    'url_hash': {'$exists': True}},
+                                   fields=['url_hash']))
+
+        url_key = url_hash(normalize_url(item_doc['url']))
+        if url_key in owner_hashes:
+            continue
+        owner_hashes.add(url_key)
+
+        db[LISTITEM_COLLECTION].update({'_id': item_doc['_id']},
+                                       {'$set': {'url_hash': url_key}})
+        updated += 1
+
+    return updated
+
+
+def backfill_changed_at(db):
+    """Sets `changed_at` to `updated_at` on items saved before it existed,
+    so they're included in incremental syncs and exports resumed with
+    `since`.
+
+    Returns the number of items updated.
+    """
+    query_set = db[LISTITEM_COLLECTION].find(
+        {'changed_at': {'$exists': False}}, fields=['updated_at'])
+
+    updated = 0
+    for item_doc in query_set:
+        db[LISTITEM_COLLECTION].update(
+            {'_id': item_doc['_id'], 'changed_at': {'$exists': False}},
+            {'$set': {'changed_at': item_doc.get('updated_at', 0)}})
+        updated += 1
+
+    return updated
+
+
+###
+### Index Declarations
+###
+
+collection_indexes = {
+    USER_COLLECTION: indexes_user,
+    USERPROFILE_COLLECTION: indexes_userprofile,
+    APITOKEN_COLLECTION: indexes_apitoken,
+    LISTITEM_COLLECTION: indexes_listitem,
+    TAGCOUNT_COLLECTION: indexes_tagcount,
+    ENRICHMENT_COLLECTION: indexes_enrichment,
+}
@@ -0,0 +1,88 @@
+import os
+
+
+###
+### Environment Overrides
+###
+
+# Each setting below can be overridden with an environment variable named
+# after it with a `READIFY_` prefix, eg. `READIFY_MONGO_MAX_POOL_SIZE=50`.
+
+def from_env(name, default, parse=None):
+    value = os.environ.get('READIFY_%s' % (name))
+    if value is None:
+        return default
+    if parse is None:
+        return value
+    return parse(value)
+
+
+def parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_list(value):
+    """Lists are comma separated.
+    """
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def parse_write_concern(value):
+    """Write concerns are a number of members, or a mode like `majority`.
+    """
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+###
+### MongoDB
+###
+
+DB_NAME = from_env('DB_NAME', 'readify')
+
+# A `host:port`, or a comma separated list of replica set members
+MONGO_HOSTS = from_env('MONGO_HOSTS', 'localhost:27017')
+
+# Set to the replica set's name to connect to all of its members. Reads can
+# only go to secondaries with a replica set.
+MONGO_REPLICA_SET = from_env('MONGO_REPLICA_SET', None)
+
+# Sockets each process keeps open. A request waits up to
+# `MONGO_WAIT_QUEUE_TIMEOUT_MS` for one when they're all in use.
+MONGO_MAX_POOL_SIZE = from_env('MONGO_MAX_POOL_SIZE', 10, int)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = from_env('MONGO_WAIT_QUEUE_TIMEOUT_MS', 1000,
+                                       int)
+
+MONGO_CONNECT_TIMEOUT_MS = from_env('MONGO_CONNECT_TIMEOUT_MS', 2000, int)
+MONGO_SOCKET_TIMEOUT_MS = from_env('MONGO_SOCKET_TIMEOUT_MS', 10000, int)
+
+# Writes are acknowledged, so errors like `DuplicateKeyError` are raised.
+# `MONGO_WRITE_TIMEOUT_MS` bounds the wait for replication with a write
+# concern above 1.
+MONGO_WRITE_CONCERN = from_env('MONGO_WRITE_CONCERN', 1, parse_write_concern)
+MONGO_WRITE_TIMEOUT_MS = from_env('MONGO_WRITE_TIMEOUT_MS', None, int)
+
+# Lets read-only handlers, like list pages, profiles and the list API, read
+# from secondaries. Secondaries lag behind the primary, so a user may not see
+# a change they made in an earlier request until it has replicated.
+MONGO_SECONDARY_READS = from_env('MONGO_SECONDARY_READS', False, parse_bool)
+
+
+###
+### Responses
+###
+
+# Dynamic responses at least this big are gzipped for clients that accept it.
+# Smaller ones don't save enough to be worth the CPU.
+GZIP_MIN_SIZE = from_env('GZIP_MIN_SIZE', 1024, int)
+GZIP_LEVEL = from_env('GZIP_LEVEL', 6, int)
+
+
+###
+### Administration
+###
+
+# Users who can read the request metrics served from `/metrics` on the API
+# host, eg. `READIFY_ADMIN_USERNAMES=alice,bob`. Nobody can by default.
+ADMIN_USERNAMES = from_env('ADMIN_USERNAMES', [], parse_list)
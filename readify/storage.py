@@ -0,0 +1,815 @@
+import re
+import heapq
+import functools
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+
+import settings
+from models import User
+import queries
+from queries import (count_tags,
+                     current_millis,
+                     generate_api_token,
+                     hash_api_token,
+                     listitem_actions,
+                     listitem_search_weights,
+                     retry_delay_for,
+                     url_metadata_update)
+from urls import normalize_url, url_hash
+
+
+###
+### Storage Interface
+###
+
+# Handlers reach the database through a storage object, which Brubeck hands
+# them as `self.db_conn`. `MongoStorage` is the production engine. The
+# in-memory engine runs the same handlers without a database server, for
+# tests, benchmarks and load tests on a single box.
+#
+# Methods that load items return an iterable of item dicts. `fields` is a
+# list of fields to load, or a dict of fields mapped to False to skip.
+#
+# Saving an item for a URL its owner already has in another item raises
+# `DuplicateKeyError` with every engine.
+
+class Storage(object):
+    """The operations readify needs from a database, covering users, user
+    profiles, API tokens, list items and the link enrichment queue. See
+    `readify.queries` for the behavior of each operation.
+
+    Engines must implement every abstract method, or they can't be created.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def ensure_indexes(self, force=False, drop_stale=False):
+        pass
+
+    @abstractmethod
+    def end_request(self):
+        pass
+
+    def with_secondary_reads(self):
+        """Returns an engine for one read-only request, whose reads may be
+        served by a replica that lags behind. Engines without replicas return
+        themselves.
+        """
+        return self
+
+    ### Users
+
+    @abstractmethod
+    def load_user(self, username=None, email=None):
+        pass
+
+    @abstractmethod
+    def save_user(self, user):
+        pass
+
+    ### UserProfiles
+
+    @abstractmethod
+    def load_userprofile(self, owner_username=None, owner_id=None):
+        pass
+
+    @abstractmethod
+    def save_userprofile(self, userprofile):
+        pass
+
+    @abstractmethod
+    def load_owner_version(self, owner_id):
+        pass
+
+    @abstractmethod
+    def load_owner_state(self, owner_id):
+        pass
+
+    ### API Tokens
+
+    @abstractmethod
+    def create_api_token(self, user, name=None):
+        pass
+
+    @abstractmethod
+    def verify_api_token(self, token):
+        pass
+
+    @abstractmethod
+    def load_api_tokens(self, owner_id):
+        pass
+
+    @abstractmethod
+    def revoke_api_token(self, owner_id, token_id):
+        pass
+
+    ### ListItems
+
+    @abstractmethod
+    def load_listitems(self, item_id=None, owner_id=None, owner_username=None,
+                       archived=False, deleted=False, liked=None, tags=None,
+                       updated_after=None, before=None, skip=None,
+                       limit=None, fields=None):
+        pass
+
+    @abstractmethod
+    def count_listitems(self, owner_id=None, owner_username=None,
+                        archived=False, deleted=False, liked=None, tags=None,
+                        updated_after=None):
+        pass
+
+    @abstractmethod
+    def load_listitem_by_url(self, owner_id, url, fields=None):
+        pass
+
+    @abstractmethod
+    def load_listitem_by_id(self, item_id, fields=None):
+        pass
+
+    @abstractmethod
+    def load_listitem_history(self, owner_id, since=None, after=None,
+                              include_deleted=False, fields=None, limit=None,
+                              batch_size=None):
+        pass
+
+    @abstractmethod
+    def search_listitems(self, owner_id, terms, skip=None, limit=None,
+                         fields=None):
+        pass
+
+    @abstractmethod
+    def save_listitem(self, item):
+        pass
+
+    @abstractmethod
+    def insert_listitems(self, owner_id, items):
+        pass
+
+    @abstractmethod
+    def bulk_update_listitems(self, owner_id, item_ids, action):
+        pass
+
+    @abstractmethod
+    def load_tags(self, owner_id, prefix=None, limit=50):
+        pass
+
+    @abstractmethod
+    def enqueue_enrichment(self, item_ids):
+        pass
+
+    @abstractmethod
+    def claim_enrichment(self, stale_after):
+        pass
+
+    @abstractmethod
+    def finish_enrichment(self, item_id):
+        pass
+
+    @abstractmethod
+    def retry_enrichment(self, job, max_attempts, retry_delay):
+        pass
+
+    @abstractmethod
+    def load_url_metadata(self, url_key):
+        pass
+
+    @abstractmethod
+    def save_url_metadata(self, url_key, metadata):
+        pass
+
+    @abstractmethod
+    def apply_url_metadata(self, item_doc, metadata):
+        pass
+
+
+###
+### MongoDB
+###
+
+def writes(method):
+    """Marks a `MongoStorage` method that writes. Reads made after it in the
+    same request go to the primary, so the request sees its own writes.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.read_db = self.db
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MongoStorage(Storage):
+    """Stores everything in MongoDB with the functions in `readify.queries`.
+    `db` is a database, as returned by `queries.init_db_conn`.
+
+    `secondary_db` is a handle on the same database that reads from
+    secondaries, see `queries.init_secondary_db`. If it's given, the engines
+    returned by `with_secondary_reads` load lists, tags and searches through
+    it. Users, profiles and tokens are cached by `readify.queries`, so they're
+    always read from the primary.
+    """
+    def __init__(self, db, secondary_db=None):
+        self.db = db
+        self.secondary_db = secondary_db
+        self.read_db = db
+
+    def with_secondary_reads(self):
+        if self.secondary_db is None:
+            return self
+        storage = MongoStorage(self.db, secondary_db=self.secondary_db)
+        storage.read_db = self.secondary_db
+        return storage
+
+    def ensure_indexes(self, force=False, drop_stale=False):
+        return queries.ensure_indexes(self.db, force=force,
+                                      drop_stale=drop_stale)
+
+    def end_request(self):
+        return queries.end_request(self.db.connection)
+
+    def load_user(self, username=None, email=None):
+        return queries.load_user(self.db, username=username, email=email)
+
+    @writes
+    def save_user(self, user):
+        return queries.save_user(self.db, user)
+
+    def load_userprofile(self, owner_username=None, owner_id=None):
+        return queries.load_userprofile(self.db,
+                                        owner_username=owner_username,
+                                        owner_id=owner_id)
+
+    @writes
+    def save_userprofile(self, userprofile):
+        return queries.save_userprofile(self.db, userprofile)
+
+    def load_owner_version(self, owner_id):
+        return queries.load_owner_version(self.read_db, owner_id)
+
+    def load_owner_state(self, owner_id):
+        return queries.load_owner_state(self.read_db, owner_id)
+
+    @writes
+    def create_api_token(self, user, name=None):
+        return queries.create_api_token(self.db, user, name=name)
+
+    def verify_api_token(self, token):
+        return queries.verify_api_token(self.db, token)
+
+    def load_api_tokens(self, owner_id):
+        return queries.load_api_tokens(self.db, owner_id)
+
+    @writes
+    def revoke_api_token(self, owner_id, token_id):
+        return queries.revoke_api_token(self.db, owner_id, token_id)
+
+    def load_listitems(self, **query_args):
+        return queries.load_listitems(self.read_db, **query_args)
+
+    def count_listitems(self, **query_args):
+        return queries.load_listitems(self.read_db, fields=['_id'],
+                                      **query_args).count()
+
+    def load_listitem_by_url(self, owner_id, url, fields=None):
+        return queries.load_listitem_by_url(self.db, owner_id, url,
+                                            fields=fields)
+
+    def load_listitem_by_id(self, item_id, fields=None):
+        return queries.load_listitem_by_id(self.db, item_id, fields=fields)
+
+    def load_listitem_history(self, owner_id, **query_args):
+        return queries.load_listitem_history(self.read_db, owner_id,
+                                             **query_args)
+
+    def search_listitems(self, owner_id, terms, skip=None, limit=None,
+                         fields=None):
+        return queries.search_listitems(self.read_db, owner_id, terms,
+                                        skip=skip, limit=limit, fields=fields)
+
+    @writes
+    def save_listitem(self, item):
+        return queries.save_listitem(self.db, item)
+
+    @writes
+    def insert_listitems(self, owner_id, items):
+        return queries.insert_listitems(self.db, owner_id, items)
+
+    @writes
+    def bulk_update_listitems(self, owner_id, item_ids, action):
+        return queries.bulk_update_listitems(self.db, owner_id, item_ids,
+                                             action)
+
+    def load_tags(self, owner_id, prefix=None, limit=50):
+        return queries.load_tags(self.read_db, owner_id, prefix=prefix,
+                                 limit=limit)
+
+    @writes
+    def enqueue_enrichment(self, item_ids):
+        return queries.enqueue_enrichment(self.db, item_ids)
+
+    @writes
+    def claim_enrichment(self, stale_after):
+        return queries.claim_enrichment(self.db, stale_after)
+
+    @writes
+    def finish_enrichment(self, item_id):
+        return queries.finish_enrichment(self.db, item_id)
+
+    @writes
+    def retry_enrichment(self, job, max_attempts, retry_delay):
+        return queries.retry_enrichment(self.db, job, max_attempts,
+                                        retry_delay)
+
+    def load_url_metadata(self, url_key):
+        return queries.load_url_metadata(self.db, url_key)
+
+    @writes
+    def save_url_metadata(self, url_key, metadata):
+        return queries.save_url_metadata(self.db, url_key, metadata)
+
+    @writes
+    def apply_url_metadata(self, item_doc, metadata):
+        return queries.apply_url_metadata(self.db, item_doc, metadata)
+
+
+def init_storage(db_name=None):
+    """Connects a `MongoStorage` as configured in `readify.settings`, with
+    secondary reads if `MONGO_SECONDARY_READS` is set.
+    """
+    db = queries.init_db_conn(db_name=db_name)
+    secondary_db = None
+    if settings.MONGO_SECONDARY_READS:
+        secondary_db = queries.init_secondary_db(db)
+    return MongoStorage(db, secondary_db=secondary_db)
+
+
+###
+### In-Memory
+###
+
+def project_fields(doc, fields):
+    """Copies `doc` with the projection `fields` applied, as `find` would.
+    """
+    if not fields:
+        return dict(doc)
+    if isinstance(fields, dict):
+        if not any(fields.values()):
+            return dict((k, v) for (k, v) in doc.items()
+                        if k not in fields)
+        fields = [f for (f, included) in fields.items() if included]
+
+    projected = dict((f, doc[f]) for f in fields if f in doc)
+    projected['_id'] = doc['_id']
+    return projected
+
+
+def listitem_key(doc):
+    return (doc['updated_at'], doc['_id'])
+
+
+def history_key(doc):
+    return (doc['changed_at'], doc['_id'])
+
+
+class MemoryStorage(Storage):
+    """Keeps everything in dicts in this process, with the same behavior as
+    `MongoStorage`. Nothing is persisted and nothing is shared between
+    processes.
+
+    Item lists are filtered by scanning the owner's items, so the cost of a
+    page grows with the size of the list instead of the page.
+    """
+    def __init__(self):
+        self.users = dict()
+        self.userprofiles = dict()
+        self.owner_versions = defaultdict(int)
+        self.owner_changes = dict()
+        self.api_tokens = dict()
+        self.api_token_hashes = dict()
+        self.listitems = dict()
+        self.owner_listitems = defaultdict(dict)
+        self.url_hashes = dict()
+        self.tag_counts = defaultdict(lambda: defaultdict(int))
+        self.enrichment_jobs = dict()
+        self.url_metadata = dict()
+        # Enrichment workers share the engine between threads
+        self.enrichment_lock = threading.Lock()
+
+    def ensure_indexes(self, force=False, drop_stale=False):
+        return []
+
+    def end_request(self):
+        pass
+
+    ### Users
+
+    def load_user(self, username=None, email=None):
+        if not username:
+            raise ValueError('Username field required')
+
+        user_doc = self.users.get(username.lower())
+        if user_doc is None:
+            return None
+        return User(**user_doc)
+
+    def save_user(self, user):
+        user_doc = user.to_python()
+        if not user_doc.get('_id'):
+            user_doc['_id'] = ObjectId()
+        username = user_doc['username'].lower()
+        if username in self.users:
+            raise DuplicateKeyError('username exists: %s' % (username))
+
+        self.users[username] = user_doc
+        user._id = user_doc['_id']
+        return user._id
+
+    ### UserProfiles
+
+    def load_userprofile(self, owner_username=None, owner_id=None):
+        if owner_username:
+            (field, value) = ('owner_username', owner_username.lower())
+        elif owner_id:
+            (field, value) = ('owner_id', owner_id)
+        else:
+            raise ValueError('<owner_username> or <owner_id> field required')
+
+        for userprofile_doc in self.userprofiles.values():
+            if userprofile_doc.get(field) == value:
+                return dict(userprofile_doc)
+        return None
+
+    def save_userprofile(self, userprofile):
+        userprofile_doc = userprofile.to_python()
+        if not userprofile_doc.get('_id'):
+            userprofile_doc['_id'] = ObjectId()
+
+        self.userprofiles[userprofile_doc['_id']] = userprofile_doc
+        userprofile.id = userprofile_doc['_id']
+        self._bump_owner_version(userprofile.owner_id)
+        return userprofile.id
+
+    def load_owner_version(self, owner_id):
+        return self.owner_versions[owner_id]
+
+    def load_owner_state(self, owner_id):
+        return {
+            'version': self.owner_versions[owner_id],
+            'changed_at': self.owner_changes.get(owner_id),
+        }
+
+    def _bump_owner_version(self, owner_id):
+        self.owner_versions[owner_id] += 1
+        self.owner_changes[owner_id] = current_millis()
+
+    ### API Tokens
+
+    def create_api_token(self, user, name=None):
+        token = generate_api_token()
+        token_doc = {
+            '_id': ObjectId(),
+            'token_hash': hash_api_token(token),
+            'owner_id': user.id,
+            'owner_username': user.username,
+            'name': name,
+            'created_at': current_millis(),
+            'revoked': False,
+        }
+        self.api_tokens[token_doc['_id']] = token_doc
+        self.api_token_hashes[token_doc['token_hash']] = token_doc['_id']
+        return (token, dict(token_doc))
+
+    def verify_api_token(self, token):
+        token_id = self.api_token_hashes.get(hash_api_token(token))
+        if token_id is None or self.api_tokens[token_id]['revoked']:
+            return None
+        return dict(self.api_tokens[token_id])
+
+    def load_api_tokens(self, owner_id):
+        token_docs = [doc for doc in self.api_tokens.values()
+                      if doc['owner_id'] == owner_id and not doc['revoked']]
+        token_docs.sort(key=lambda doc: doc['created_at'])
+        return [project_fields(doc, {'token_hash': False})
+                for doc in token_docs]
+
+    def revoke_api_token(self, owner_id, token_id):
+        try:
+            token_id = ObjectId(unicode(token_id))
+        except (TypeError, InvalidId):
+            return False
+
+        token_doc = self.api_tokens.get(token_id)
+        if token_doc is None or token_doc['owner_id'] != owner_id or \
+           token_doc['revoked']:
+            return False
+
+        token_doc['revoked'] = True
+        token_doc['revoked_at'] = current_millis()
+        return True
+
+    ### ListItems
+
+    def _owner_items(self, owner_id=None, owner_username=None):
+        if owner_username:
+            owner_username = owner_username.lower()
+            return [doc for doc in self.listitems.values()
+                    if doc['owner_username'].lower() == owner_username]
+        elif owner_id:
+            return self.owner_listitems[owner_id].values()
+        raise ValueError('<owner_id> or <owner_username> field required')
+
+    def _match_listitems(self, item_id=None, owner_id=None,
+                         owner_username=None, archived=False, deleted=False,
+                         liked=None, tags=None, updated_after=None,
+                         before=None):
+        if item_id and owner_id and not owner_username:
+            docs = [self.owner_listitems[owner_id].get(item_id)]
+            docs = [doc for doc in docs if doc is not None]
+        else:
+            docs = self._owner_items(owner_id, owner_username)
+
+        matches = []
+        for doc in docs:
+            if archived is not None and doc.get('archived') != archived:
+                continue
+            if deleted is not None and doc.get('deleted') != deleted:
+                continue
+            if liked is not None and doc.get('liked') != liked:
+                continue
+            if isinstance(tags, list) and \
+               not set(tags).issubset(doc.get('tags') or []):
+                continue
+            if updated_after is not None and \
+               doc['updated_at'] < updated_after:
+                continue
+            if before is not None and listitem_key(doc) >= before:
+                continue
+            matches.append(doc)
+        return matches
+
+    def load_listitems(self, skip=None, limit=None, fields=None,
+                       **query_args):
+        matches = self._match_listitems(**query_args)
+        skip = skip or 0
+        if limit:
+            matches = heapq.nlargest(skip + limit, matches, key=listitem_key)
+        else:
+            matches.sort(key=listitem_key, reverse=True)
+        return [project_fields(doc, fields) for doc in matches[skip:]]
+
+    def count_listitems(self, **query_args):
+        return len(self._match_listitems(**query_args))
+
+    def load_listitem_by_url(self, owner_id, url, fields=None):
+        item_id = self.url_hashes.get((owner_id, url_hash(normalize_url(url))))
+        if item_id is None:
+            return None
+        return project_fields(self.listitems[item_id], fields)
+
+    def load_listitem_by_id(self, item_id, fields=None):
+        doc = self.listitems.get(item_id)
+        if doc is None:
+            return None
+        return project_fields(doc, fields)
+
+    def load_listitem_history(self, owner_id, since=None, after=None,
+                              include_deleted=False, fields=None, limit=None,
+                              batch_size=None):
+        matches = []
+        for doc in self.owner_listitems[owner_id].values():
+            if not include_deleted and doc.get('deleted'):
+                continue
+            if since is not None and doc['changed_at'] < since:
+                continue
+            if after is not None and history_key(doc) <= after:
+                continue
+            matches.append(doc)
+
+        if limit:
+            matches = heapq.nsmallest(limit, matches, key=history_key)
+        else:
+            matches.sort(key=history_key)
+        return [project_fields(doc, fields) for doc in matches]
+
+    def search_listitems(self, owner_id, terms, skip=None, limit=None,
+                         fields=None):
+        """Scores items by the weighted number of search terms found in each
+        field, using the weights of the MongoDB text index.
+        """
+        terms = set(re.findall(r'\w+', terms.lower(), re.UNICODE))
+        scored = []
+        for doc in self.owner_listitems[owner_id].values():
+            if doc.get('deleted'):
+                continue
+            score = 0
+            for (field, weight) in listitem_search_weights.items():
+                value = doc.get(field) or ''
+                if isinstance(value, list):
+                    value = u' '.join(value)
+                words = re.findall(r'\w+', value.lower(), re.UNICODE)
+                score += weight * len([w for w in words if w in terms])
+            if score:
+                scored.append((score, doc))
+
+        scored.sort(key=lambda s: s[0], reverse=True)
+        skip = skip or 0
+        if limit:
+            scored = scored[skip:skip + limit]
+        else:
+            scored = scored[skip:]
+
+        results = []
+        for (score, doc) in scored:
+            result = project_fields(doc, fields)
+            result['score'] = float(score)
+            results.append(result)
+        return results
+
+    def _store_listitem(self, item_doc):
+        key = (item_doc['owner_id'], item_doc['url_hash'])
+        if self.url_hashes.get(key, item_doc['_id']) != item_doc['_id']:
+            raise DuplicateKeyError('url exists: %s' % (item_doc['url']))
+
+        previous = self.listitems.get(item_doc['_id'])
+        if previous is not None:
+            self.url_hashes.pop((previous['owner_id'], previous['url_hash']),
+                                None)
+        self.url_hashes[key] = item_doc['_id']
+        self.listitems[item_doc['_id']] = item_doc
+        self.owner_listitems[item_doc['owner_id']][item_doc['_id']] = item_doc
+
+    def save_listitem(self, item):
+        item_doc = item.to_python()
+        item_doc['url_hash'] = url_hash(normalize_url(item_doc['url']))
+        item_doc['changed_at'] = current_millis()
+
+        previous = None
+        if item_doc.get('_id'):
+            previous = self.listitems.get(item_doc['_id'])
+        else:
+            previous = self.load_listitem_by_url(item_doc['owner_id'],
+                                                 item_doc['url'])
+            if previous is not None:
+                item_doc['_id'] = previous['_id']
+                item_doc['created_at'] = previous['created_at']
+                item_doc['liked'] = previous.get('liked', False)
+            else:
+                item_doc['_id'] = ObjectId()
+
+        self._store_listitem(item_doc)
+        item._id = item_doc['_id']
+
+        tag_deltas = defaultdict(int)
+        count_tags(tag_deltas, previous, -1)
+        count_tags(tag_deltas, item_doc, 1)
+        self._adjust_tag_counts(item_doc['owner_id'], tag_deltas)
+        self._bump_owner_version(item_doc['owner_id'])
+
+        return item_doc['_id']
+
+    def insert_listitems(self, owner_id, items):
+        item_ids = []
+        tag_deltas = defaultdict(int)
+        now = current_millis()
+        for item in items:
+            item_doc = item.to_python()
+            item_doc['_id'] = ObjectId()
+            item_doc['url_hash'] = url_hash(normalize_url(item_doc['url']))
+            item_doc['changed_at'] = now
+
+            previous_id = self.url_hashes.get((owner_id, item_doc['url_hash']))
+            if previous_id is not None:
+                previous = self.listitems[previous_id]
+                if not previous.get('deleted'):
+                    continue
+                item_doc['_id'] = previous_id
+                item_doc['created_at'] = previous['created_at']
+                item_doc['liked'] = previous.get('liked', False)
+
+            self._store_listitem(item_doc)
+            count_tags(tag_deltas, item_doc, 1)
+            item_ids.append(item_doc['_id'])
+
+        if item_ids:
+            self._adjust_tag_counts(owner_id, tag_deltas)
+            self._bump_owner_version(owner_id)
+
+        return item_ids
+
+    def bulk_update_listitems(self, owner_id, item_ids, action):
+        if action not in listitem_actions:
+            raise ValueError('Unknown action: %s' % (action))
+        (field, value) = listitem_actions[action]
+
+        results = dict()
+        tag_deltas = defaultdict(int)
+        now = current_millis()
+        owner_items = self.owner_listitems[owner_id]
+        for item_id in item_ids:
+            try:
+                object_id = ObjectId(unicode(item_id))
+            except (TypeError, InvalidId):
+                results[item_id] = 'invalid'
+                continue
+
+            doc = owner_items.get(object_id)
+            if doc is None:
+                results[item_id] = 'not_found'
+                continue
+
+            if field == 'deleted' and doc.get('deleted') != value:
+                count_tags(tag_deltas, doc, -1 if value else 1,
+                           include_deleted=True)
+            doc[field] = value
+            doc['updated_at'] = doc['changed_at'] = now
+            results[item_id] = 'updated'
+
+        if 'updated' in results.values():
+            self._adjust_tag_counts(owner_id, tag_deltas)
+            self._bump_owner_version(owner_id)
+
+        return results
+
+    ### Tags
+
+    def _adjust_tag_counts(self, owner_id, tag_deltas):
+        counts = self.tag_counts[owner_id]
+        for (tag, delta) in tag_deltas.items():
+            counts[tag] += delta
+            if counts[tag] <= 0:
+                del counts[tag]
+
+    def load_tags(self, owner_id, prefix=None, limit=50):
+        counts = self.tag_counts[owner_id].items()
+        if prefix:
+            counts = sorted((t, c) for (t, c) in counts
+                            if t.startswith(prefix))
+        else:
+            counts = sorted(counts, key=lambda tc: tc[1], reverse=True)
+
+        return [{'tag': t, 'count': c} for (t, c) in counts[:limit]]
+
+    ### Link Enrichment
+
+    def enqueue_enrichment(self, item_ids):
+        now = current_millis()
+        with self.enrichment_lock:
+            for item_id in item_ids:
+                self.enrichment_jobs.setdefault(item_id, {
+                    '_id': item_id,
+                    'state': 'pending',
+                    'queued_at': now,
+                    'next_attempt_at': now,
+                    'attempts': 0,
+                })
+
+    def claim_enrichment(self, stale_after):
+        now = current_millis()
+        with self.enrichment_lock:
+            ready = [job for job in self.enrichment_jobs.values()
+                     if (job['state'] == 'pending' and
+                         job['next_attempt_at'] <= now) or
+                        (job['state'] == 'working' and
+                         job['claimed_at'] < now - stale_after)]
+            if not ready:
+                return None
+
+            job = min(ready, key=lambda job: job['next_attempt_at'])
+            job['state'] = 'working'
+            job['claimed_at'] = now
+            job['attempts'] += 1
+            return dict(job)
+
+    def finish_enrichment(self, item_id):
+        with self.enrichment_lock:
+            self.enrichment_jobs.pop(item_id, None)
+
+    def retry_enrichment(self, job, max_attempts, retry_delay):
+        if job['attempts'] >= max_attempts:
+            return self.finish_enrichment(job['_id'])
+        next_attempt_at = current_millis() + retry_delay_for(job, retry_delay)
+        with self.enrichment_lock:
+            queued = self.enrichment_jobs.get(job['_id'])
+            if queued is not None:
+                queued['state'] = 'pending'
+                queued['next_attempt_at'] = next_attempt_at
+
+    def load_url_metadata(self, url_key):
+        metadata = self.url_metadata.get(url_key)
+        return dict(metadata) if metadata is not None else None
+
+    def save_url_metadata(self, url_key, metadata):
+        metadata = dict(metadata)
+        metadata['_id'] = url_key
+        self.url_metadata[url_key] = metadata
+
+    def apply_url_metadata(self, item_doc, metadata):
+        doc = self.listitems.get(item_doc['_id'])
+        if doc is not None:
+            doc.update(url_metadata_update(item_doc, metadata))
+        self._bump_owner_version(item_doc['owner_id'])
+        return True
@@ -0,0 +1,433 @@
+import os
+import json
+import time
+import errno
+import signal
+import logging
+import importlib
+import multiprocessing
+
+
+###
+### Worker Processes
+###
+
+# Workers touch their heartbeat file after every request and at least this
+# often while idle
+HEARTBEAT_INTERVAL = 1.0
+
+# Requests already pushed to a stopping worker are handled if they arrive
+# within this long of it disconnecting
+DRAIN_TIMEOUT = 0.5
+
+
+def load_app_factory(app_factory):
+    """Imports a function named like `web_server:make_app` and returns it.
+    """
+    (module_name, function_name) = app_factory.split(':', 1)
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def serve_forever(app, heartbeat_path, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """Handles requests for a Brubeck `app` one at a time, like `Brubeck.run`,
+    touching `heartbeat_path` to show the worker is alive.
+
+    SIGTERM or SIGINT stop the worker gracefully. It disconnects from Mongrel2
+    so no more requests are pushed to it, handles the requests it already
+    received and returns.
+    """
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    msg_conn = app.msg_conn
+    in_sock = msg_conn.in_sock
+    poll_timeout = int(heartbeat_interval * 1000)
+
+    open(heartbeat_path, 'a').close()
+    while not stopping:
+        if in_sock.poll(poll_timeout):
+            msg_conn.process_message(app, msg_conn.recv())
+        os.utime(heartbeat_path, None)
+
+    in_sock.disconnect(msg_conn.in_addr)
+    while in_sock.poll(int(DRAIN_TIMEOUT * 1000)):
+        msg_conn.process_message(app, msg_conn.recv())
+
+
+def run_worker(app_factory, heartbeat_path):
+    """The body of a forked worker process. The app is imported and built
+    here, so each worker has its own database and ZeroMQ connections and
+    picks up code changes when it's replaced.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    make_app = load_app_factory(app_factory)
+    app = make_app()
+    serve_forever(app, heartbeat_path)
+
+
+def describe_exit(status):
+    """Describes how a process ended from its `os.waitpid` status.
+    """
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal %d' % (os.WTERMSIG(status))
+    return 'exited with status %d' % (os.WEXITSTATUS(status))
+
+
+class WorkerProcess(object):
+    """The supervisor's record of a forked worker. `slot` is the worker's
+    position in the pool, kept by its replacements.
+    """
+    def __init__(self, slot, pid, heartbeat_path, restarts=0):
+        self.slot = slot
+        self.pid = pid
+        self.heartbeat_path = heartbeat_path
+        self.restarts = restarts
+        self.started_at = time.time()
+        self.stop_deadline = None
+
+    @property
+    def stopping(self):
+        return self.stop_deadline is not None
+
+    def last_heartbeat(self):
+        """When the worker last touched its heartbeat file, or None if it
+        hasn't finished starting.
+        """
+        try:
+            return os.stat(self.heartbeat_path).st_mtime
+        except OSError:
+            return None
+
+    def to_dict(self, heartbeat_timeout):
+        last_heartbeat = self.last_heartbeat()
+        healthy = (last_heartbeat is not None and not self.stopping and
+                   time.time() - last_heartbeat < heartbeat_timeout)
+        return {
+            'slot': self.slot,
+            'pid': self.pid,
+            'started_at': self.started_at,
+            'restarts': self.restarts,
+            'last_heartbeat': last_heartbeat,
+            'stopping': self.stopping,
+            'healthy': healthy,
+        }
+
+
+###
+### Supervisor
+###
+
+# Workers that start but don't touch their heartbeat within this long, or
+# stop touching it, are killed and restarted
+HEARTBEAT_TIMEOUT = 30.0
+
+# Stopped workers get this long to finish their requests before being killed
+GRACEFUL_TIMEOUT = 30.0
+
+# Workers that crash sooner than this after starting are restarted with a
+# growing delay, up to MAX_RESTART_DELAY
+MIN_UPTIME = 5.0
+MAX_RESTART_DELAY = 60.0
+
+CHECK_INTERVAL = 0.5
+
+
+class Supervisor(object):
+    """Forks `num_workers` processes that each run the app built by
+    `app_factory`, one per core by default. Every worker connects to the
+    same Mongrel2 endpoints, and Mongrel2's PUSH socket spreads requests
+    across them.
+
+    Crashed or unresponsive workers are restarted. SIGHUP replaces the
+    workers one at a time, starting each replacement before stopping the
+    worker it replaces. SIGTERM and SIGINT stop the workers gracefully.
+
+    The state of the pool is written to a JSON status file in `run_dir`,
+    read by `check_status`.
+    """
+    def __init__(self, name, app_factory, num_workers=None, run_dir='./run',
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 graceful_timeout=GRACEFUL_TIMEOUT):
+        self.name = name
+        self.app_factory = app_factory
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.run_dir = run_dir
+        self.heartbeat_timeout = heartbeat_timeout
+        self.graceful_timeout = graceful_timeout
+        self.workers = dict()
+        self.pending_restarts = []
+        self.crashes = dict()
+        self.signals = []
+        self.started_at = time.time()
+
+    @property
+    def status_path(self):
+        return status_path(self.run_dir, self.name)
+
+    def heartbeat_path(self, pid):
+        return os.path.join(self.run_dir, '%s-%d.heartbeat' % (self.name, pid))
+
+    def spawn(self, slot, restarts=0):
+        """Forks a worker for `slot`.
+        """
+        pid = os.fork()
+        if pid == 0:
+            # The supervisor's handlers only queue signals for its loop, which
+            # the worker doesn't run. Until the worker installs its own, a
+            # SIGTERM has to end it.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(self.app_factory, self.heartbeat_path(os.getpid()))
+            except Exception, e:
+                logging.exception('%s worker failed: %s' % (self.name, e))
+                code = 1
+            finally:
+                os._exit(code)
+
+        worker = WorkerProcess(slot, pid, self.heartbeat_path(pid),
+                               restarts=restarts)
+        self.workers[pid] = worker
+        logging.info('Started %s worker %d (pid %d)' % (self.name, slot, pid))
+        return worker
+
+    def stop_worker(self, worker):
+        """Asks a worker to finish its requests and exit. It's killed if it
+        hasn't within `graceful_timeout`.
+        """
+        if worker.stopping:
+            return
+        worker.stop_deadline = time.time() + self.graceful_timeout
+        self.signal_worker(worker, signal.SIGTERM)
+
+    def signal_worker(self, worker, signum):
+        try:
+            os.kill(worker.pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def slot_is_filled(self, slot):
+        for worker in self.workers.values():
+            if worker.slot == slot and not worker.stopping:
+                return True
+        return False
+
+    def reap(self):
+        """Collects exited workers and schedules a restart for any that
+        exited without being stopped, unless another worker has its slot.
+        """
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            try:
+                os.remove(worker.heartbeat_path)
+            except OSError:
+                pass
+
+            if worker.stopping or self.slot_is_filled(worker.slot):
+                logging.info('%s worker %d (pid %d) stopped'
+                             % (self.name, worker.slot, pid))
+                continue
+
+            # Workers that keep crashing on start are restarted with a delay
+            # that doubles each time
+            delay = 0
+            if time.time() - worker.started_at < MIN_UPTIME:
+                crashes = self.crashes.get(worker.slot, 0) + 1
+                self.crashes[worker.slot] = crashes
+                delay = min(2 ** (crashes - 1), MAX_RESTART_DELAY)
+            else:
+                self.crashes.pop(worker.slot, None)
+
+            logging.error('%s worker %d (pid %d) %s, restarting in %ds'
+                          % (self.name, worker.slot, pid,
+                             describe_exit(status), delay))
+            self.pending_restarts.append((time.time() + delay, worker.slot,
+                                          worker.restarts + 1))
+
+    def restart_pending(self):
+        now = time.time()
+        waiting = []
+        for (restart_at, slot, restarts) in self.pending_restarts:
+            if restart_at > now:
+                waiting.append((restart_at, slot, restarts))
+            elif not self.slot_is_filled(slot):
+                self.spawn(slot, restarts=restarts)
+        self.pending_restarts = waiting
+
+    def check_health(self):
+        """Kills workers that missed their heartbeat or didn't stop in time.
+        """
+        now = time.time()
+        for worker in self.workers.values():
+            if worker.stopping:
+                if now > worker.stop_deadline:
+                    logging.error('%s worker %d (pid %d) did not stop, '
+                                  'killing it'
+                                  % (self.name, worker.slot, worker.pid))
+                    self.signal_worker(worker, signal.SIGKILL)
+                continue
+
+            last_heartbeat = worker.last_heartbeat() or worker.started_at
+            if now - last_heartbeat > self.heartbeat_timeout:
+                logging.error('%s worker %d (pid %d) is unresponsive, '
+                              'killing it'
+                              % (self.name, worker.slot, worker.pid))
+                self.signal_worker(worker, signal.SIGKILL)
+
+    def write_status(self):
+        workers = sorted(self.workers.values(), key=lambda w: w.slot)
+        status = {
+            'name': self.name,
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'updated_at': time.time(),
+            'num_workers': self.num_workers,
+            'workers': [w.to_dict(self.heartbeat_timeout) for w in workers],
+        }
+
+        # Written to a temporary file and renamed, so readers never see a
+        # partial file
+        tmp_path = '%s.tmp' % (self.status_path)
+        with open(tmp_path, 'w') as status_file:
+            json.dump(status, status_file)
+        os.rename(tmp_path, self.status_path)
+
+    def supervise(self):
+        self.reap()
+        self.restart_pending()
+        self.check_health()
+        self.write_status()
+
+    def wait_until(self, predicate, timeout):
+        """Keeps supervising until `predicate` is true or `timeout` passes.
+        Gives up early if the supervisor is asked to stop.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.supervise()
+            if predicate():
+                return True
+            if signal.SIGTERM in self.signals or signal.SIGINT in self.signals:
+                return False
+            time.sleep(CHECK_INTERVAL / 5)
+        return False
+
+    def reload(self):
+        """Replaces each worker in turn. Each replacement has to start
+        touching its heartbeat before the worker it replaces is stopped, so
+        the pool never loses more than one worker's worth of capacity and a
+        broken deploy stops at the first worker.
+        """
+        logging.info('Reloading %s workers' % (self.name))
+        old_workers = [w for w in self.workers.values() if not w.stopping]
+        for worker in sorted(old_workers, key=lambda w: w.slot):
+            if worker.pid not in self.workers:
+                continue
+
+            replacement = self.spawn(worker.slot)
+            started = self.wait_until(
+                lambda: (replacement.pid not in self.workers or
+                         replacement.last_heartbeat() is not None),
+                self.heartbeat_timeout)
+            if not started or replacement.pid not in self.workers:
+                logging.error('Reload of %s stopped: worker %d did not start'
+                              % (self.name, worker.slot))
+                if replacement.pid in self.workers:
+                    self.stop_worker(replacement)
+                return False
+
+            self.stop_worker(worker)
+            self.wait_until(lambda: worker.pid not in self.workers,
+                            self.graceful_timeout + 1)
+
+        logging.info('Reloaded %s workers' % (self.name))
+        return True
+
+    def shutdown(self):
+        logging.info('Stopping %s workers' % (self.name))
+        for worker in self.workers.values():
+            self.stop_worker(worker)
+
+        deadline = time.time() + self.graceful_timeout + 1
+        while self.workers and time.time() < deadline:
+            self.reap()
+            self.check_health()
+            time.sleep(CHECK_INTERVAL / 5)
+
+        try:
+            os.remove(self.status_path)
+        except OSError:
+            pass
+
+    def handle_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def run(self):
+        """Starts the workers and supervises them until SIGTERM or SIGINT.
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.handle_signal)
+
+        if not os.path.isdir(self.run_dir):
+            os.makedirs(self.run_dir)
+
+        for slot in xrange(self.num_workers):
+            self.spawn(slot)
+
+        while True:
+            if self.signals:
+                signum = self.signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    break
+                elif signum == signal.SIGHUP:
+                    self.reload()
+                continue
+
+            self.supervise()
+            time.sleep(CHECK_INTERVAL)
+
+        self.shutdown()
+
+
+###
+### Health Checks
+###
+
+def status_path(run_dir, name):
+    return os.path.join(run_dir, '%s.status.json' % (name))
+
+
+def check_status(run_dir, name, max_age=10.0):
+    """Reads the status file of a running supervisor. Returns whether the
+    pool is healthy, meaning the supervisor updated the file within
+    `max_age` seconds and every worker is touching its heartbeat, and the
+    status itself, or None if there's no status file.
+    """
+    try:
+        with open(status_path(run_dir, name)) as status_file:
+            status = json.load(status_file)
+    except (IOError, ValueError):
+        return (False, None)
+
+    healthy_workers = [w for w in status['workers'] if w['healthy']]
+    healthy = (time.time() - status['updated_at'] < max_age and
+               len(healthy_workers) >= status['num_workers'])
+    return (healthy, status)
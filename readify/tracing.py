@@ -0,0 +1,185 @@
+import json
+import time
+import bisect
+import logging
+from contextlib import contextmanager
+
+
+###
+### Request Traces
+###
+
+# Requests slower than this are logged with their trace
+SLOW_REQUEST_MS = 500
+
+
+class RequestTrace(object):
+    """Collects the number of times each phase of a request ran and the
+    milliseconds spent in it, eg. `db`, `validation`, `format` and `render`.
+    Storage calls are also counted by name.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.phases = dict()
+        self.db_calls = dict()
+
+    def add(self, phase, elapsed, count=1):
+        entry = self.phases.setdefault(phase, [0, 0.0])
+        entry[0] += count
+        entry[1] += elapsed
+
+    @contextmanager
+    def measure(self, phase):
+        """Adds the time spent in the `with` block to `phase`.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, (time.time() - started) * 1000)
+
+    def elapsed(self):
+        """Milliseconds since the request started.
+        """
+        return (time.time() - self.started) * 1000
+
+
+class TracedStorage(object):
+    """Wraps a `readify.storage` engine and records each call in `trace` as
+    the `db` phase.
+
+    Results read lazily, like MongoDB cursors, hit the database as they are
+    iterated, so that time is added to the phase too.
+    """
+    def __init__(self, storage, trace):
+        self.storage = storage
+        self.trace = trace
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        def traced(*args, **kwargs):
+            with self.trace.measure('db'):
+                result = attr(*args, **kwargs)
+            self.trace.db_calls[name] = self.trace.db_calls.get(name, 0) + 1
+            if hasattr(result, 'next'):
+                result = iter_traced(result, self.trace)
+            return result
+        return traced
+
+
+def iter_traced(query_set, trace):
+    """Yields from `query_set`, adding the time spent fetching each result to
+    the `db` phase of `trace`.
+    """
+    while True:
+        started = time.time()
+        try:
+            doc = query_set.next()
+        except StopIteration:
+            return
+        finally:
+            trace.add('db', (time.time() - started) * 1000, count=0)
+        yield doc
+
+
+###
+### Aggregated Metrics
+###
+
+# Upper bounds of the histogram buckets, with one more bucket for anything
+# larger
+millis_buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+count_buckets = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+
+class Histogram(object):
+    """Counts observed values in fixed buckets.
+    """
+    def __init__(self, buckets=millis_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self):
+        return {
+            'buckets': self.buckets,
+            'counts': self.counts,
+            'count': self.count,
+            'sum': self.total,
+        }
+
+
+class RequestMetrics(object):
+    """Histograms of request and phase durations, and of storage calls per
+    request, for each handler. Metrics are kept per process.
+    """
+    def __init__(self):
+        self.handlers = dict()
+
+    def record(self, handler_name, trace, elapsed):
+        metrics = self.handlers.get(handler_name)
+        if metrics is None:
+            metrics = {
+                'total': Histogram(),
+                'db_calls': Histogram(count_buckets),
+                'phases': dict(),
+            }
+            self.handlers[handler_name] = metrics
+
+        metrics['total'].observe(elapsed)
+        metrics['db_calls'].observe(sum(trace.db_calls.values()))
+        for (phase, (count, phase_elapsed)) in trace.phases.items():
+            histogram = metrics['phases'].get(phase)
+            if histogram is None:
+                histogram = metrics['phases'][phase] = Histogram()
+            histogram.observe(phase_elapsed)
+
+    def to_dict(self):
+        return dict((name, {
+            'total': metrics['total'].to_dict(),
+            'db_calls': metrics['db_calls'].to_dict(),
+            'phases': dict((phase, histogram.to_dict()) for (phase, histogram)
+                           in metrics['phases'].items()),
+        }) for (name, metrics) in self.handlers.items())
+
+    def clear(self):
+        self.handlers.clear()
+
+
+request_metrics = RequestMetrics()
+
+
+def finish_trace(handler_name, message, status_code, trace,
+                 slow_request_ms=None):
+    """Adds a finished request to `request_metrics` and logs it as JSON if it
+    took `slow_request_ms` or longer, which defaults to `SLOW_REQUEST_MS`.
+    """
+    if slow_request_ms is None:
+        slow_request_ms = SLOW_REQUEST_MS
+    elapsed = trace.elapsed()
+    request_metrics.record(handler_name, trace, elapsed)
+
+    if elapsed >= slow_request_ms:
+        record = {
+            'handler': handler_name,
+            'method': message.method,
+            'path': message.path,
+            'status': status_code,
+            'ms': round(elapsed, 2),
+            'phases': dict((phase, {'count': count, 'ms': round(ms, 2)})
+                           for (phase, (count, ms)) in trace.phases.items()),
+            'db_calls': trace.db_calls,
+        }
+        logging.warning('Slow request: %s' % (json.dumps(record,
+                                                         sort_keys=True)))
+
+    return elapsed
@@ -0,0 +1,71 @@
+import urllib
+import urlparse
+from hashlib import sha1
+
+
+###
+### URL Normalization
+###
+
+default_ports = {
+    'http': '80',
+    'https': '443',
+}
+
+# Query parameters added by campaign and click tracking, which don't change
+# the page
+tracking_params = set(['fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid',
+                       'mc_eid', 'yclid', '_hsenc', '_hsmi'])
+tracking_prefixes = ('utm_',)
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in tracking_params or name.startswith(tracking_prefixes)
+
+
+def normalize_url(url):
+    """Puts a URL in a canonical form, so the different ways of writing the
+    same address compare equal: a scheme is added if missing, the scheme and
+    host are lowercased, default ports, fragments and tracking parameters are
+    dropped, the remaining query parameters are sorted and an empty path
+    becomes `/`.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    url = url.strip()
+    if not url.startswith('http'):
+        url = 'http://%s' % (url)
+
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+
+    if ':' in netloc:
+        (host, port) = netloc.rsplit(':', 1)
+        if default_ports.get(scheme) == port:
+            netloc = host
+
+    if not path:
+        path = '/'
+
+    params = urlparse.parse_qsl(query, keep_blank_values=True)
+    params = [(k, v) for (k, v) in params if not is_tracking_param(k)]
+    query = urllib.urlencode(sorted(params))
+
+    url = urlparse.urlunsplit((scheme, netloc, path, query, ''))
+    return url.decode('utf-8', 'replace')
+
+
+def url_host(url):
+    """The lowercased host of `url`, without a port.
+    """
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+
+def url_hash(url):
+    """A fixed length key for a normalized URL.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return sha1(url).hexdigest()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+
+from readify.supervisor import (Supervisor,
+                                check_status,
+                                HEARTBEAT_TIMEOUT,
+                                GRACEFUL_TIMEOUT)
+
+import argparse
+import json
+import logging
+import sys
+
+
+###
+### Worker Supervisor
+###
+
+# Each app is built in its worker processes by the `make_app` function of its
+# server script
+app_factories = {
+    'web': 'web_server:make_app',
+    'api': 'api_server:make_app',
+}
+
+parser = argparse.ArgumentParser(
+    description='Runs a pool of worker processes for the web or API server. '
+                'Send SIGHUP to replace the workers one at a time.')
+parser.add_argument('app', choices=sorted(app_factories),
+                    help='the server to run')
+parser.add_argument('--workers', type=int,
+                    help='number of worker processes, defaults to one per core')
+parser.add_argument('--run-dir', default='./run',
+                    help='directory for the status and heartbeat files')
+parser.add_argument('--heartbeat-timeout', type=float,
+                    default=HEARTBEAT_TIMEOUT,
+                    help='seconds before a silent worker is restarted')
+parser.add_argument('--graceful-timeout', type=float,
+                    default=GRACEFUL_TIMEOUT,
+                    help='seconds a stopping worker gets to finish requests')
+parser.add_argument('--status', action='store_true',
+                    help='print the status of a running pool and exit '
+                         'non-zero if it is unhealthy')
+args = parser.parse_args()
+
+if args.status:
+    (healthy, status) = check_status(args.run_dir, args.app)
+    print json.dumps(status, indent=2)
+    sys.exit(0 if healthy else 1)
+
+logging.basicConfig(level=logging.INFO)
+
+supervisor = Supervisor(args.app, app_factories[args.app],
+                        num_workers=args.workers,
+                        run_dir=args.run_dir,
+                        heartbeat_timeout=args.heartbeat_timeout,
+                        graceful_timeout=args.graceful_timeout)
+supervisor.run()
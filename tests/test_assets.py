@@ -0,0 +1,33 @@
+import unittest
+
+from readify.assets import minify_css
+
+
+class MinifyCSSTest(unittest.TestCase):
+    def test_declarations(self):
+        css = """
+        /* Links */
+        a, a:visited {
+            color : #333;
+            background: url(../img/bg.png) no-repeat ;
+        }
+        """
+        self.assertEqual(minify_css(css),
+                         'a,a:visited{color:#333;'
+                         'background:url(../img/bg.png) no-repeat}')
+
+    def test_selector_colons_keep_whitespace(self):
+        css = 'div :first-child { margin : 0 }\nul > li :hover{color:red}'
+        self.assertEqual(minify_css(css),
+                         'div :first-child{margin:0}ul>li :hover{color:red}')
+
+    def test_nested_blocks(self):
+        css = '@media screen and (max-width: 600px) {\n' \
+              '  .list :last-child { display : none; }\n}'
+        self.assertEqual(minify_css(css),
+                         '@media screen and (max-width: 600px){'
+                         '.list :last-child{display:none}}')
+
+
+if __name__ == '__main__':
+    unittest.main()
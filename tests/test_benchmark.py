@@ -0,0 +1,45 @@
+import os
+import unittest
+
+from readify.storage import MemoryStorage
+from readify.benchmark import Benchmark, benchmark_cases, run_benchmarks
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+
+class BenchmarkTest(unittest.TestCase):
+    """Runs the benchmark harness at a small size, so a change that breaks a
+    case fails here instead of in the middle of a benchmark run.
+    """
+    def test_every_case_runs(self):
+        results = run_benchmarks(MemoryStorage, [20], num_requests=2,
+                                 warmup=1, template_dir=TEMPLATE_DIR)
+
+        names = [name for (name, case) in benchmark_cases]
+        self.assertEqual(sorted(results['20']), sorted(names))
+        for (name, metrics) in results['20'].items():
+            self.assertTrue(metrics['p50'] > 0, name)
+            self.assertTrue(metrics['storage_calls'] >= 1, name)
+
+    def test_case_responses(self):
+        bench = Benchmark(MemoryStorage(), 20, template_dir=TEMPLATE_DIR)
+        statuses = {
+            'dashboard': '200',
+            'dashboard_cached': '200',
+            'dashboard_gzip': '200',
+            'api_list': '200',
+            'api_list_unchanged': '304',
+            'add_item': '302',
+        }
+        for (name, case) in benchmark_cases:
+            response = case(bench)
+            if name not in statuses:
+                self.assertTrue(response is not None, name)
+                continue
+            status = response.split('\r\n', 1)[0].split(' ')[1]
+            self.assertEqual(status, statuses[name], name)
+
+
+if __name__ == '__main__':
+    unittest.main()
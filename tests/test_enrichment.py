@@ -0,0 +1,244 @@
+import time
+import unittest
+import threading
+import functools
+import BaseHTTPServer
+from collections import defaultdict
+
+from readify.enrichment import (UnsafeURLError,
+                                is_public_address,
+                                fetch_metadata,
+                                build_checked_opener,
+                                enrich_item,
+                                EnrichmentPool,
+                                HostRateLimiter)
+from readify.models import User, ListItem
+from readify.queries import current_millis, retry_delay_for
+from readify.storage import MemoryStorage
+
+
+ARTICLE = """<html><head>
+<title>
+  An   article
+</title>
+<meta name="description" content="What the article is about">
+</head><body>Text</body></html>"""
+
+WITH_CANONICAL = """<html><head>
+<title>A story</title>
+<link rel="canonical" href="http://example.com/story">
+</head></html>"""
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the pages the tests fetch. Each request's path and time are
+    recorded on the server.
+    """
+    def do_GET(self):
+        server = self.server
+        server.requests[self.path].append(time.time())
+        hits = len(server.requests[self.path])
+
+        if self.path == '/old':
+            return self.redirect('/article')
+        elif self.path == '/to-file':
+            return self.redirect('file:///etc/passwd')
+        elif self.path == '/missing':
+            return self.send_error(404)
+        elif self.path == '/flaky' and hits <= server.flaky_failures:
+            return self.send_error(503)
+
+        page = WITH_CANONICAL if self.path == '/canonical' else ARTICLE
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(page)
+
+    def redirect(self, location):
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServerTest(unittest.TestCase):
+    """Runs enrichment against pages served from this process. The stub is
+    on loopback, which the fetches used in production refuse.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.base_url = 'http://127.0.0.1:%d' % (cls.server.server_port)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = defaultdict(list)
+        self.server.flaky_failures = 0
+        self.storage = MemoryStorage()
+        self.user = self.create_user('reader')
+        self.fetch = functools.partial(
+            fetch_metadata,
+            opener=build_checked_opener(is_allowed=lambda address: True))
+
+    def create_user(self, username):
+        user = User.create_user(username, 'secret')
+        self.storage.save_user(user)
+        return self.storage.load_user(username=username)
+
+    def save_item(self, path, user=None, title=None):
+        user = user or self.user
+        url = self.base_url + path
+        now = current_millis()
+        item = ListItem(owner_id=user.id, owner_username=user.username,
+                        url=url, title=title or url, created_at=now,
+                        updated_at=now)
+        item_id = self.storage.save_listitem(item)
+        self.storage.enqueue_enrichment([item_id])
+        return item_id
+
+    def load_item(self, item_id):
+        return self.storage.load_listitem_by_id(item_id)
+
+    def run_pool(self, timeout=5.0, **pool_args):
+        """Runs a pool until the queue is empty.
+        """
+        pool_args.setdefault('num_workers', 2)
+        pool_args.setdefault('host_interval', 0)
+        pool = EnrichmentPool(self.storage, fetch=self.fetch,
+                              poll_interval=0.01, **pool_args)
+        pool.start()
+        try:
+            deadline = time.time() + timeout
+            while self.storage.enrichment_jobs and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            pool.stop()
+        self.assertEqual(self.storage.enrichment_jobs, {})
+
+    def test_title_and_description(self):
+        item_id = self.save_item('/article')
+        self.assertTrue(enrich_item(self.storage, item_id,
+                                    HostRateLimiter(0), fetch=self.fetch))
+
+        item = self.load_item(item_id)
+        self.assertEqual(item['title'], u'An article')
+        self.assertEqual(item['description'], u'What the article is about')
+        self.assertEqual(item['canonical_url'], self.base_url + '/article')
+
+    def test_fetches_saved_url(self):
+        item_id = self.save_item('/article?b=2&a=1&utm_source=feed')
+        enrich_item(self.storage, item_id, HostRateLimiter(0),
+                    fetch=self.fetch)
+
+        self.assertEqual(self.server.requests.keys(),
+                         ['/article?b=2&a=1&utm_source=feed'])
+        item = self.load_item(item_id)
+        metadata = self.storage.load_url_metadata(item['url_hash'])
+        self.assertEqual(metadata['url'], self.base_url + '/article?a=1&b=2')
+
+    def test_keeps_given_title(self):
+        item_id = self.save_item('/article', title=u'Mine')
+        enrich_item(self.storage, item_id, HostRateLimiter(0),
+                    fetch=self.fetch)
+        self.assertEqual(self.load_item(item_id)['title'], u'Mine')
+
+    def test_redirect_to_canonical_url(self):
+        redirected = self.save_item('/old')
+        named = self.save_item('/canonical')
+        self.run_pool()
+
+        self.assertEqual(self.load_item(redirected)['canonical_url'],
+                         self.base_url + '/article')
+        self.assertEqual(self.load_item(named)['canonical_url'],
+                         u'http://example.com/story')
+
+    def test_metadata_is_shared(self):
+        first = self.save_item('/article')
+        second = self.save_item('/article', user=self.create_user('other'))
+        self.run_pool(num_workers=1)
+
+        self.assertEqual(len(self.server.requests['/article']), 1)
+        self.assertEqual(self.load_item(second)['title'],
+                         self.load_item(first)['title'])
+
+    def test_host_rate_limit(self):
+        for path in ['/article', '/canonical', '/flaky']:
+            self.save_item(path)
+        self.run_pool(num_workers=3, host_interval=0.2)
+
+        times = sorted(t for path_times in self.server.requests.values()
+                       for t in path_times)
+        self.assertEqual(len(times), 3)
+        gaps = [b - a for (a, b) in zip(times, times[1:])]
+        self.assertTrue(min(gaps) >= 0.18, gaps)
+
+    def test_retries_server_errors(self):
+        self.server.flaky_failures = 2
+        item_id = self.save_item('/flaky')
+        self.run_pool(retry_delay=50)
+
+        times = self.server.requests['/flaky']
+        self.assertEqual(len(times), 3)
+        self.assertEqual(self.load_item(item_id)['title'], u'An article')
+        # Each retry waits twice as long as the one before
+        self.assertTrue(times[1] - times[0] >= 0.045)
+        self.assertTrue(times[2] - times[1] >= 0.095)
+
+    def test_gives_up_after_max_attempts(self):
+        self.server.flaky_failures = 10
+        item_id = self.save_item('/flaky')
+        self.run_pool(retry_delay=10)
+
+        self.assertEqual(len(self.server.requests['/flaky']), 3)
+        self.assertFalse('canonical_url' in self.load_item(item_id))
+
+    def test_client_errors_are_not_retried(self):
+        missing = self.save_item('/missing')
+        unsafe = self.save_item('/to-file')
+        self.run_pool(retry_delay=10)
+
+        self.assertEqual(len(self.server.requests['/missing']), 1)
+        self.assertEqual(len(self.server.requests['/to-file']), 1)
+        self.assertFalse('canonical_url' in self.load_item(missing))
+        self.assertFalse('canonical_url' in self.load_item(unsafe))
+
+
+class SafeFetchTest(unittest.TestCase):
+    def test_private_addresses(self):
+        for address in ['127.0.0.1', '10.1.2.3', '172.16.0.1', '192.168.1.1',
+                        '169.254.169.254', '0.0.0.0', '100.64.0.1', '::1',
+                        '::ffff:127.0.0.1', 'fe80::1%eth0', 'fd00:ec2::254']:
+            self.assertFalse(is_public_address(address), address)
+
+    def test_public_addresses(self):
+        for address in ['8.8.8.8', '172.32.0.1', '2606:4700::1']:
+            self.assertTrue(is_public_address(address), address)
+
+    def test_refuses_other_schemes(self):
+        for url in ['file:///etc/passwd', 'ftp://example.com/',
+                    'gopher://example.com/', 'http:///']:
+            self.assertRaises(UnsafeURLError, fetch_metadata, url)
+
+    def test_refuses_private_hosts(self):
+        # Resolved before connecting, so nothing needs to be listening
+        for url in ['http://127.0.0.1:1/', 'http://localhost:1/',
+                    'https://[::1]:1/']:
+            self.assertRaises(UnsafeURLError, fetch_metadata, url,
+                              opener=build_checked_opener())
+
+    def test_retry_backoff(self):
+        delays = [retry_delay_for({'attempts': n}, 1000) for n in (1, 2, 3)]
+        self.assertEqual(delays, [1000, 2000, 4000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import os
+import re
+import json
+import logging
+import unittest
+from email.utils import formatdate
+
+from brubeck.request import Request
+from brubeck.request_handling import Brubeck
+
+import api_server
+import web_server
+from readify import settings
+from readify.assets import load_jinja2_env
+from readify.models import ListItem
+from readify.storage import MemoryStorage
+from readify.benchmark import (Benchmark,
+                               build_message,
+                               BENCHMARK_SECRET,
+                               BENCHMARK_PASSWORD)
+from readify.queries import current_millis
+
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), '..', 'templates')
+
+
+def status_of(response):
+    return response.split('\r\n', 1)[0].split(' ')[1]
+
+
+class ConditionalRequestTest(unittest.TestCase):
+    """`If-Modified-Since` on the list API, which only has whole seconds to
+    compare against changes recorded in milliseconds.
+    """
+    def setUp(self):
+        self.bench = Benchmark(MemoryStorage(), 5, template_dir=TEMPLATE_DIR)
+        self.owner_id = self.bench.user.id
+
+    def set_changed_at(self, changed_at):
+        self.bench.storage.owner_changes[self.owner_id] = changed_at
+
+    def get_list(self, since=None):
+        headers = dict()
+        if since is not None:
+            headers['if-modified-since'] = formatdate(since, usegmt=True)
+        handler = self.bench.route(self.bench.api_app, 'GET', '/',
+                                   [('count', 5)], headers=headers)
+        return (status_of(handler()), handler.headers.get('Last-Modified'))
+
+    def test_last_modified_rounds_up(self):
+        self.set_changed_at(1500000000500)
+        (status, last_modified) = self.get_list()
+        self.assertEqual(last_modified, formatdate(1500000001, usegmt=True))
+
+        self.assertEqual(self.get_list(since=1500000001)[0], '304')
+
+    def test_change_within_the_second(self):
+        # A client whose copy is from the start of the second
+        self.set_changed_at(1500000000800)
+        self.assertEqual(self.get_list(since=1500000000)[0], '200')
+
+    def test_no_last_modified_until_the_second_passes(self):
+        self.set_changed_at(current_millis() + 5000)
+        self.assertEqual(self.get_list()[1], None)
+
+
+class WebTest(unittest.TestCase):
+    """Requests to the web app as `web_server` routes them, with a seeded
+    user.
+    """
+    def setUp(self):
+        self.bench = Benchmark(MemoryStorage(), 5, template_dir=TEMPLATE_DIR)
+        self.app = Brubeck(handler_tuples=web_server.handler_tuples,
+                           msg_conn=self.bench.msg_conn,
+                           db_conn=self.bench.storage,
+                           template_loader=load_jinja2_env(TEMPLATE_DIR),
+                           cookie_secret=BENCHMARK_SECRET,
+                           login_url='/login',
+                           log_level=logging.CRITICAL)
+
+    def request(self, method, path, arguments=None):
+        """Returns the status and body of a response.
+        """
+        message = build_message(method, path, arguments=arguments,
+                                cookie=self.bench.cookie)
+        handler = self.app.route_message(Request.parse_msg(message))
+        (head, body) = handler().split('\r\n\r\n', 1)
+        return (status_of(head), body)
+
+
+class ItemFormTest(WebTest):
+    """Fields the app sets aren't on the submit and edit forms. `q` is the
+    search box in the navigation.
+    """
+    def form_field_names(self, path):
+        (status, body) = self.request('GET', path)
+        self.assertEqual(status, '200')
+        return sorted(re.findall(r'<(?:input|textarea)[^>]* name="(\w+)"',
+                                 body))
+
+    def test_submit_form(self):
+        self.assertEqual(self.form_field_names('/add_item'),
+                         ['q', 'tags', 'title', 'url'])
+
+    def test_edit_form(self):
+        item = self.bench.storage.load_listitems(owner_id=self.bench.user.id,
+                                                 archived=None, limit=1)[0]
+        self.assertEqual(self.form_field_names('/edit_item/%s' % item['_id']),
+                         ['q', 'tags', 'title', 'url'])
+
+
+class TagFilterTest(WebTest):
+    def test_non_ascii_tag_pages(self):
+        user = self.bench.user
+        for n in range(2):
+            now = current_millis()
+            self.bench.storage.save_listitem(ListItem(
+                owner_id=user.id, owner_username=user.username,
+                url=u'http://example.com/%d' % (n), title=u'Caf\xe9 %d' % (n),
+                tags=[u'caf\xe9'], created_at=now, updated_at=now))
+
+        (status, body) = self.request('GET', '/', [('tag', 'caf\xc3\xa9'),
+                                                   ('count', 1)])
+        self.assertEqual(status, '200')
+        self.assertTrue('?tag=caf%C3%A9&count=1&cursor=' in body)
+
+
+class APITest(unittest.TestCase):
+    """Requests to the API app as `api_server` routes them, with a seeded
+    user.
+    """
+    def setUp(self):
+        self.bench = Benchmark(MemoryStorage(), 5, template_dir=TEMPLATE_DIR)
+        self.app = Brubeck(handler_tuples=api_server.handler_tuples,
+                           msg_conn=self.bench.msg_conn,
+                           db_conn=self.bench.storage,
+                           cookie_secret=BENCHMARK_SECRET,
+                           log_level=logging.CRITICAL)
+
+    def request(self, method, path, arguments=None, headers=None,
+                cookie=None):
+        """Returns the status and JSON payload of a response.
+        """
+        message = build_message(method, path, arguments=arguments,
+                                cookie=cookie, headers=headers)
+        handler = self.app.route_message(Request.parse_msg(message))
+        response = handler()
+        (head, body) = response.split('\r\n\r\n', 1)
+        return (status_of(head), json.loads(body) if body else None)
+
+
+class ListCountTest(APITest):
+    def test_count_is_the_list_total_on_every_page(self):
+        user = self.bench.user
+        for n in range(3):
+            now = current_millis()
+            self.bench.storage.save_listitem(ListItem(
+                owner_id=user.id, owner_username=user.username,
+                url=u'http://example.com/%d' % (n), title=u'Link %d' % (n),
+                created_at=now, updated_at=now))
+
+        arguments = [('count', 1), ('with_count', 1)]
+        (status, payload) = self.request('GET', '/', arguments,
+                                         cookie=self.bench.cookie)
+        self.assertEqual(payload['data']['num_items'], 3)
+
+        cursor = payload['data']['next_cursor']
+        (status, payload) = self.request('GET', '/',
+                                         arguments + [('cursor', cursor)],
+                                         cookie=self.bench.cookie)
+        self.assertEqual(status, '200')
+        self.assertEqual(len(payload['data']['items']), 1)
+        self.assertEqual(payload['data']['num_items'], 3)
+
+
+class MetricsTest(APITest):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.admins = settings.ADMIN_USERNAMES
+        settings.ADMIN_USERNAMES = []
+
+    def tearDown(self):
+        settings.ADMIN_USERNAMES = self.admins
+
+    def test_requires_login(self):
+        self.assertEqual(self.request('GET', '/metrics')[0], '401')
+
+    def test_requires_admin(self):
+        self.assertEqual(self.request('GET', '/metrics',
+                                      cookie=self.bench.cookie)[0], '403')
+
+    def test_admin(self):
+        settings.ADMIN_USERNAMES = ['Bench']
+        (status, payload) = self.request('GET', '/metrics',
+                                         cookie=self.bench.cookie)
+        self.assertEqual(status, '200')
+        self.assertEqual(payload['data']['pid'], os.getpid())
+        self.assertTrue('handlers' in payload['data'])
+
+
+class TokensTest(APITest):
+    def setUp(self):
+        super(TokensTest, self).setUp()
+        self.credentials = [('username', self.bench.user.username),
+                            ('password', BENCHMARK_PASSWORD)]
+
+    def create_token(self):
+        (status, payload) = self.request(
+            'POST', '/tokens', self.credentials + [('action', 'create')])
+        self.assertEqual(status, '200')
+        return payload['data']['token']
+
+    def test_get_only_lists(self):
+        (status, payload) = self.request(
+            'GET', '/tokens', self.credentials + [('action', 'create')])
+        self.assertEqual(status, '200')
+        self.assertEqual(payload['data'], {'tokens': []})
+
+    def test_tokens_can_list_but_not_create(self):
+        token = self.create_token()
+        headers = {'authorization': 'Token %s' % (token)}
+
+        (status, payload) = self.request('GET', '/tokens', headers=headers)
+        self.assertEqual(status, '200')
+        self.assertEqual(len(payload['data']['tokens']), 1)
+
+        self.assertEqual(self.request('POST', '/tokens', [('action', 'create')],
+                                      headers=headers)[0], '403')
+
+    def test_token_argument_only_on_the_api(self):
+        token = self.create_token()
+        self.assertEqual(self.request('GET', '/', [('token', token)])[0],
+                         '200')
+
+        message = build_message('GET', '/', arguments=[('token', token)])
+        handler = self.bench.web_app.route_message(Request.parse_msg(message))
+        self.assertEqual(handler.get_current_user(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
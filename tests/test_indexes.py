@@ -0,0 +1,110 @@
+import unittest
+
+from readify.queries import (drop_stale_indexes,
+                             ensure_indexes,
+                             index_signature,
+                             collection_indexes,
+                             indexes_listitem,
+                             LISTITEM_COLLECTION,
+                             INDEX_MARKER_COLLECTION)
+
+
+class IndexedCollection(object):
+    """Reports indexes like pymongo's `index_information` and records the
+    ones dropped.
+    """
+    def __init__(self, index_information):
+        self._index_information = index_information
+        self.dropped = []
+        self.applied = []
+
+    def index_information(self):
+        return self._index_information
+
+    def drop_index(self, name):
+        self.dropped.append(name)
+
+    def ensure_index(self, keys, **options):
+        self.applied.append(keys)
+
+
+class MarkerCollection(object):
+    """Stores index version markers like the marker collection.
+    """
+    def __init__(self, markers):
+        self.markers = markers
+
+    def find_one(self, query):
+        return self.markers.get(query['_id'])
+
+    def save(self, doc):
+        self.markers[doc['_id']] = doc
+
+
+class DropStaleIndexesTest(unittest.TestCase):
+    def drop_stale(self, index_information):
+        collection = IndexedCollection(index_information)
+        db = {LISTITEM_COLLECTION: collection}
+        drop_stale_indexes(db, indexes_listitem, LISTITEM_COLLECTION)
+        return collection.dropped
+
+    def test_keeps_declared_text_index(self):
+        # MongoDB reports the fields of a text index as `_fts` and `_ftsx`
+        dropped = self.drop_stale({
+            '_id_': {'key': [('_id', 1)]},
+            'listitem_search': {'key': [('owner_id', 1),
+                                        ('_fts', 'text'),
+                                        ('_ftsx', 1)],
+                                'weights': {'title': 10}},
+        })
+        self.assertEqual(dropped, [])
+
+    def test_keeps_declared_unique_index(self):
+        dropped = self.drop_stale({
+            'owner_id_1_url_hash_1': {'key': [('owner_id', 1),
+                                              ('url_hash', 1)],
+                                      'unique': True,
+                                      'partialFilterExpression': {
+                                          'url_hash': {'$exists': True}}},
+        })
+        self.assertEqual(dropped, [])
+
+    def test_drops_undeclared_and_changed_indexes(self):
+        dropped = self.drop_stale({
+            'url_1': {'key': [('url', 1)]},
+            'owner_id_1_url_hash_1': {'key': [('owner_id', 1),
+                                              ('url_hash', 1)],
+                                      'unique': True,
+                                      'sparse': True},
+        })
+        self.assertEqual(sorted(dropped), ['owner_id_1_url_hash_1', 'url_1'])
+
+
+class EnsureIndexesTest(unittest.TestCase):
+    def setUp(self):
+        # Every collection's indexes are current, and one listitem index
+        # is no longer declared
+        markers = dict((collection, {'_id': collection,
+                                     'signature': index_signature(indexes)})
+                       for (collection, indexes) in collection_indexes.items())
+        self.db = dict((collection, IndexedCollection({}))
+                       for collection in collection_indexes)
+        self.db[LISTITEM_COLLECTION] = IndexedCollection({
+            'url_1': {'key': [('url', 1)]},
+        })
+        self.db[INDEX_MARKER_COLLECTION] = MarkerCollection(markers)
+
+    def test_current_markers_skip_collections(self):
+        self.assertEqual(ensure_indexes(self.db), [])
+        self.assertEqual(self.db[LISTITEM_COLLECTION].dropped, [])
+
+    def test_drop_stale_ignores_markers(self):
+        self.assertEqual(ensure_indexes(self.db, drop_stale=True),
+                         [LISTITEM_COLLECTION])
+        listitems = self.db[LISTITEM_COLLECTION]
+        self.assertEqual(listitems.dropped, ['url_1'])
+        self.assertEqual(len(listitems.applied), len(indexes_listitem))
+
+
+if __name__ == '__main__':
+    unittest.main()
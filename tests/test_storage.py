@@ -0,0 +1,351 @@
+import time
+import unittest
+
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+
+from readify import queries
+from readify.models import User, UserProfile, ListItem
+from readify.storage import Storage, MongoStorage, MemoryStorage
+
+
+# Dropped before each MongoDB test
+TEST_DB_NAME = 'readify_test'
+
+
+class StorageInterfaceTest(unittest.TestCase):
+    def test_incomplete_engine_fails_at_construction(self):
+        class PartialStorage(Storage):
+            def end_request(self):
+                pass
+
+        self.assertRaises(TypeError, PartialStorage)
+
+    def test_engines_are_complete(self):
+        MemoryStorage()
+
+
+class StorageTests(object):
+    """The behavior every storage engine shares. Test cases mix this in and
+    return an empty engine from `make_storage`.
+    """
+    def setUp(self):
+        self.storage = self.make_storage()
+        self.user = self.create_user('reader')
+
+    def create_user(self, username):
+        user = User.create_user(username, 'secret')
+        user.validate()
+        self.storage.save_user(user)
+        return self.storage.load_user(username=username)
+
+    def make_item(self, url, title=None, tags=None, updated_at=None,
+                  **fields):
+        updated_at = updated_at or queries.current_millis()
+        item = ListItem(owner_id=self.user.id,
+                        owner_username=self.user.username,
+                        url=url,
+                        title=title or url,
+                        tags=tags or [],
+                        created_at=updated_at,
+                        updated_at=updated_at,
+                        **fields)
+        item.validate()
+        return item
+
+    def load_items(self, **query_args):
+        query_args.setdefault('owner_id', self.user.id)
+        return list(self.storage.load_listitems(**query_args))
+
+    ### Users
+
+    def test_load_user(self):
+        user = self.storage.load_user(username='Reader')
+        self.assertEqual(user.id, self.user.id)
+        self.assertTrue(user.check_password('secret'))
+        self.assertEqual(self.storage.load_user(username='nobody'), None)
+
+    def test_duplicate_username(self):
+        user = User.create_user('READER', 'other')
+        self.assertRaises(DuplicateKeyError, self.storage.save_user, user)
+
+    ### UserProfiles
+
+    def test_userprofile(self):
+        version = self.storage.load_owner_version(self.user.id)
+        userprofile = UserProfile(owner_id=self.user.id,
+                                  owner_username=self.user.username,
+                                  name=u'Reader')
+        self.storage.save_userprofile(userprofile)
+
+        by_name = self.storage.load_userprofile(owner_username='READER')
+        by_id = self.storage.load_userprofile(owner_id=self.user.id)
+        self.assertEqual(by_name['_id'], by_id['_id'])
+        self.assertEqual(by_id['name'], u'Reader')
+        self.assertEqual(by_id['owner_id'], self.user.id)
+        self.assertTrue(self.storage.load_owner_version(self.user.id) >
+                        version)
+
+    ### API Tokens
+
+    def test_api_tokens(self):
+        (token, token_doc) = self.storage.create_api_token(self.user,
+                                                           name=u'phone')
+        verified = self.storage.verify_api_token(token)
+        self.assertEqual(verified['_id'], token_doc['_id'])
+        self.assertEqual(verified['owner_id'], self.user.id)
+
+        tokens = list(self.storage.load_api_tokens(self.user.id))
+        self.assertEqual([t['_id'] for t in tokens], [token_doc['_id']])
+        self.assertFalse('token_hash' in tokens[0])
+
+        self.assertTrue(self.storage.revoke_api_token(self.user.id,
+                                                      str(token_doc['_id'])))
+        self.assertFalse(self.storage.revoke_api_token(self.user.id,
+                                                       'not an id'))
+        self.assertEqual(self.storage.verify_api_token(token), None)
+        self.assertEqual(list(self.storage.load_api_tokens(self.user.id)),
+                         [])
+
+    ### ListItems
+
+    def test_save_and_load(self):
+        first = self.storage.save_listitem(
+            self.make_item('http://example.com/a', updated_at=1000))
+        second = self.storage.save_listitem(
+            self.make_item('http://example.com/b', updated_at=2000))
+
+        items = self.load_items()
+        self.assertEqual([item['_id'] for item in items], [second, first])
+        self.assertEqual(self.storage.count_listitems(owner_id=self.user.id),
+                         2)
+        self.assertEqual(self.load_items(item_id=first)[0]['url'],
+                         u'http://example.com/a')
+
+        # Another way of writing the same address
+        item = self.storage.load_listitem_by_url(
+            self.user.id, 'http://Example.com:80/a?utm_source=feed')
+        self.assertEqual(item['_id'], first)
+
+    def test_load_fields(self):
+        self.storage.save_listitem(self.make_item('http://example.com/a',
+                                                  tags=['news']))
+        item = self.load_items(fields=['title'])[0]
+        self.assertEqual(sorted(item), ['_id', 'title'])
+
+    def test_pages(self):
+        for n in xrange(5):
+            self.storage.save_listitem(
+                self.make_item('http://example.com/%d' % (n),
+                               updated_at=1000))
+
+        first_page = self.load_items(limit=2)
+        last = first_page[-1]
+        rest = self.load_items(before=(last['updated_at'], last['_id']))
+        ids = [item['_id'] for item in first_page + rest]
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(ids, [item['_id'] for item in self.load_items()])
+
+    def test_save_same_url_updates_item(self):
+        item_id = self.storage.save_listitem(
+            self.make_item('http://example.com/a', title=u'First'))
+        self.storage.bulk_update_listitems(self.user.id, [str(item_id)],
+                                           'like')
+
+        saved_id = self.storage.save_listitem(
+            self.make_item('http://EXAMPLE.com/a#top', title=u'Second'))
+
+        self.assertEqual(saved_id, item_id)
+        items = self.load_items()
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['title'], u'Second')
+        self.assertTrue(items[0]['liked'])
+
+    def test_change_url_to_existing(self):
+        self.storage.save_listitem(self.make_item('http://example.com/a'))
+        item_id = self.storage.save_listitem(
+            self.make_item('http://example.com/b'))
+
+        # As the edit handler does
+        item = ListItem(**self.load_items(item_id=item_id)[0])
+        item.url = u'http://example.com/a'
+        self.assertRaises(DuplicateKeyError, self.storage.save_listitem,
+                          item)
+
+    def test_insert_skips_saved_urls(self):
+        self.storage.save_listitem(self.make_item('http://example.com/a'))
+        item_ids = self.storage.insert_listitems(self.user.id, [
+            self.make_item('http://example.com/a?utm_medium=email'),
+            self.make_item('http://example.com/b', tags=['news']),
+            self.make_item('http://example.com/b#again', tags=['news']),
+        ])
+
+        self.assertEqual(len(item_ids), 1)
+        self.assertEqual(len(self.load_items()), 2)
+        self.assertEqual(self.storage.load_tags(self.user.id),
+                         [{'tag': u'news', 'count': 1}])
+
+    def test_deleted_urls_are_restored(self):
+        saved = self.storage.save_listitem(
+            self.make_item('http://example.com/a', tags=['news']))
+        imported = self.storage.save_listitem(
+            self.make_item('http://example.com/b', tags=['news']))
+        self.storage.bulk_update_listitems(self.user.id, [str(saved)], 'like')
+        self.storage.bulk_update_listitems(
+            self.user.id, [str(saved), str(imported)], 'delete')
+        self.assertEqual(self.load_items(), [])
+
+        # Saving and importing treat a deleted item the same way
+        self.assertEqual(self.storage.save_listitem(
+            self.make_item('http://example.com/a', tags=['news'])), saved)
+        self.assertEqual(self.storage.insert_listitems(self.user.id, [
+            self.make_item('http://example.com/b', tags=['news']),
+            self.make_item('http://example.com/b#again', tags=['news']),
+        ]), [imported])
+
+        items = dict((item['_id'], item) for item in self.load_items())
+        self.assertEqual(sorted(items), sorted([saved, imported]))
+        self.assertTrue(items[saved]['liked'])
+        self.assertEqual(self.storage.load_tags(self.user.id),
+                         [{'tag': u'news', 'count': 2}])
+
+    def test_bulk_update(self):
+        kept = self.storage.save_listitem(
+            self.make_item('http://example.com/a', tags=['news']))
+        archived = self.storage.save_listitem(
+            self.make_item('http://example.com/b', tags=['news']))
+
+        missing = '0' * 24
+        results = self.storage.bulk_update_listitems(
+            self.user.id, [str(archived), missing, 'bad'], 'archive')
+        self.assertEqual(results, {str(archived): 'updated',
+                                   missing: 'not_found',
+                                   'bad': 'invalid'})
+
+        self.assertEqual([item['_id'] for item in self.load_items()], [kept])
+        self.assertEqual([item['_id'] for item in
+                          self.load_items(archived=True)], [archived])
+
+        self.storage.bulk_update_listitems(self.user.id, [str(kept)],
+                                           'delete')
+        self.assertEqual(self.storage.load_tags(self.user.id),
+                         [{'tag': u'news', 'count': 1}])
+
+    def test_sync(self):
+        old = self.storage.save_listitem(
+            self.make_item('http://example.com/a'))
+        deleted = self.storage.save_listitem(
+            self.make_item('http://example.com/b'))
+        time.sleep(0.01)
+        since = queries.current_millis()
+
+        self.storage.bulk_update_listitems(self.user.id, [str(deleted)],
+                                           'delete')
+
+        changed = list(self.storage.load_listitem_history(
+            self.user.id, since=since, include_deleted=True))
+        self.assertEqual([item['_id'] for item in changed], [deleted])
+        self.assertTrue(changed[0]['deleted'])
+        self.assertTrue(changed[0]['changed_at'] >= since)
+
+        history = list(self.storage.load_listitem_history(self.user.id))
+        self.assertEqual([item['_id'] for item in history], [old])
+
+        # Changes after the last one seen, as the sync watermark loads them
+        after = (history[-1]['changed_at'], history[-1]['_id'])
+        changed = list(self.storage.load_listitem_history(
+            self.user.id, after=after, include_deleted=True))
+        self.assertEqual([item['_id'] for item in changed], [deleted])
+
+    def test_search(self):
+        by_title = self.storage.save_listitem(
+            self.make_item('http://example.com/notes',
+                           title=u'Learning python'))
+        by_url = self.storage.save_listitem(
+            self.make_item('http://example.com/python', title=u'Notes'))
+        deleted = self.storage.save_listitem(
+            self.make_item('http://example.com/old', title=u'Old python'))
+        self.storage.bulk_update_listitems(self.user.id, [str(deleted)],
+                                           'delete')
+
+        results = list(self.storage.search_listitems(self.user.id, u'python',
+                                                     fields=['title']))
+        self.assertEqual([item['_id'] for item in results], [by_title, by_url])
+        self.assertTrue(results[0]['score'] > results[1]['score'])
+
+    ### Link Enrichment
+
+    def test_enrichment_queue(self):
+        item_id = self.storage.save_listitem(
+            self.make_item('http://example.com/a'))
+        self.storage.enqueue_enrichment([item_id])
+        self.storage.enqueue_enrichment([item_id])
+
+        job = self.storage.claim_enrichment(60 * 1000)
+        self.assertEqual((job['_id'], job['attempts']), (item_id, 1))
+        self.assertEqual(self.storage.claim_enrichment(60 * 1000), None)
+
+        # Not claimed again until its retry is due
+        self.storage.retry_enrichment(job, 3, 60 * 1000)
+        self.assertEqual(self.storage.claim_enrichment(60 * 1000), None)
+        self.storage.retry_enrichment(job, 3, 0)
+        job = self.storage.claim_enrichment(60 * 1000)
+        self.assertEqual((job['_id'], job['attempts']), (item_id, 2))
+
+        self.storage.finish_enrichment(item_id)
+        self.storage.retry_enrichment(job, 3, 0)
+        self.assertEqual(self.storage.claim_enrichment(60 * 1000), None)
+
+    def test_url_metadata(self):
+        item_id = self.storage.save_listitem(
+            self.make_item('http://example.com/a', updated_at=1000))
+        item = self.storage.load_listitem_by_id(item_id)
+        self.assertEqual(self.storage.load_url_metadata(item['url_hash']),
+                         None)
+
+        metadata = {'canonical_url': u'http://example.com/a',
+                    'title': u'A page',
+                    'description': u'About a page',
+                    'fetched_at': 2000}
+        self.storage.save_url_metadata(item['url_hash'], metadata)
+        saved = self.storage.load_url_metadata(item['url_hash'])
+        self.assertEqual(saved['title'], u'A page')
+
+        self.storage.apply_url_metadata(item, saved)
+        item = self.storage.load_listitem_by_id(item_id)
+        self.assertEqual(item['title'], u'A page')
+        self.assertEqual(item['description'], u'About a page')
+        # Only the sync watermark moves
+        self.assertEqual(item['updated_at'], 1000)
+        self.assertTrue(item['changed_at'] > 1000)
+
+
+class MemoryStorageTest(StorageTests, unittest.TestCase):
+    def make_storage(self):
+        return MemoryStorage()
+
+
+class MongoStorageTest(StorageTests, unittest.TestCase):
+    """Runs against the MongoDB configured in `readify.settings`, and is
+    skipped if there isn't one.
+    """
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.db = queries.init_db_conn(db_name=TEST_DB_NAME,
+                                          connectTimeoutMS=500)
+        except ConnectionFailure:
+            raise unittest.SkipTest('MongoDB is not reachable')
+
+    def make_storage(self):
+        self.db.connection.drop_database(TEST_DB_NAME)
+        queries.user_cache.clear()
+        queries.userprofile_cache.clear()
+        queries.apitoken_cache.clear()
+
+        storage = MongoStorage(self.db)
+        storage.ensure_indexes(force=True)
+        return storage
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from readify.supervisor import Supervisor, describe_exit
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+
+def slow_app():
+    """An app factory that takes a while, so workers can be signalled
+    before they're serving.
+    """
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        time.sleep(0.05)
+
+
+def wait_for_exit(pid, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        (waited, status) = os.waitpid(pid, os.WNOHANG)
+        if waited == pid:
+            return status
+        time.sleep(0.02)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    return None
+
+
+###
+### Scenarios
+###
+
+# Each scenario forks and prints what it saw. They run in their own
+# interpreter, as `supervise.py` does, because importing brubeck patches
+# `os.fork` and `os.waitpid` with gevent's, which don't report children to
+# this loop.
+
+def scenario_exits():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(3)
+    print describe_exit(wait_for_exit(pid))
+
+    pid = os.fork()
+    if pid == 0:
+        time.sleep(5)
+        os._exit(0)
+    os.kill(pid, signal.SIGKILL)
+    print describe_exit(wait_for_exit(pid))
+
+
+def scenario_sigterm_starting_worker():
+    run_dir = tempfile.mkdtemp()
+    try:
+        supervisor = Supervisor('test', 'tests.test_supervisor:slow_app',
+                                num_workers=1, run_dir=run_dir)
+        # As in `Supervisor.run`, which the forked worker inherits
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, supervisor.handle_signal)
+
+        worker = supervisor.spawn(0)
+        time.sleep(0.2)
+        os.kill(worker.pid, signal.SIGTERM)
+
+        status = wait_for_exit(worker.pid)
+        if status is None:
+            print 'ignored SIGTERM'
+        else:
+            print describe_exit(status)
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def run_scenario(name):
+    """Runs a scenario in a new interpreter and returns its output lines.
+    """
+    code = 'from tests.test_supervisor import %s; %s()' % (name, name)
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=ROOT_DIR)
+    return output.splitlines()
+
+
+class SupervisorTest(unittest.TestCase):
+    def test_describe_exit(self):
+        self.assertEqual(run_scenario('scenario_exits'), [
+            'exited with status 3',
+            'was killed by signal %d' % (signal.SIGKILL),
+        ])
+
+    def test_sigterm_ends_a_starting_worker(self):
+        self.assertEqual(run_scenario('scenario_sigterm_starting_worker'),
+                         ['was killed by signal %d' % (signal.SIGTERM)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,6 @@
 
 from brubeck.request_handling import Brubeck
 from brubeck.connections import Mongrel2Connection
-from brubeck.templating import load_jinja2_env
 
 from readify.handlers import (AccountLoginHandler,
                               AccountCreateHandler,
@@ -11,12 +10,15 @@ from readify.handlers import (AccountLoginHandler,
                               DashboardDisplayHandler,
                               LikedDisplayHandler,
                               ArchivedDisplayHandler,
+                              SearchHandler,
                               ItemAddHandler,
                               ItemEditHandler,
+                              ItemBulkHandler,
                               SettingsHandler,
                               ProfilesHandler)
 
-from readify.queries import init_db_conn
+from readify.storage import init_storage
+from readify.assets import load_jinja2_env
 
 import logging
 
@@ -25,9 +27,6 @@ import logging
 ### Configuration
 ###
 
-# Instantiate database connection
-db_conn = init_db_conn()
-
 # Routing config
 handler_tuples = [
     (r'^/login', AccountLoginHandler),
@@ -35,25 +34,44 @@ handler_tuples = [
     (r'^/logout', AccountLogoutHandler),
     (r'^/add_item', ItemAddHandler),
     (r'^/edit_item/(?P<item_id>\w+)', ItemEditHandler),
+    (r'^/bulk', ItemBulkHandler),
     (r'^/settings', SettingsHandler),
     (r'^/archived', ArchivedDisplayHandler),
     (r'^/liked', LikedDisplayHandler),
+    (r'^/search', SearchHandler),
     (r'^/(?P<username>\w+)', ProfilesHandler),
     (r'^/$', DashboardDisplayHandler),
 ]
 
-# Application config
-config = {
-    'msg_conn': Mongrel2Connection('tcp://127.0.0.1:9997', 'tcp://127.0.0.1:9996'),
-    'handler_tuples': handler_tuples,
-    'template_loader': load_jinja2_env('./templates'),
-    'db_conn': db_conn,
-    'login_url': '/login',
-    'cookie_secret': 'OMGSOOOOOSECRET',
-    'log_level': logging.DEBUG,
-}
-
-
-# Instantiate app instance
-app = Brubeck(**config)
-app.run()
+
+def make_app():
+    """Builds the app with its own database and Mongrel2 connections. The
+    supervisor calls this in each worker process.
+    """
+    # Instantiate database connection. Handlers use it through the storage
+    # interface in `readify.storage`. Pooling, timeouts and read routing are
+    # configured in `readify.settings`.
+    db_conn = init_storage()
+
+    # Indexes are applied once here, instead of on every write
+    db_conn.ensure_indexes()
+
+    # Application config
+    config = {
+        'msg_conn': Mongrel2Connection('tcp://127.0.0.1:9997',
+                                       'tcp://127.0.0.1:9996'),
+        'handler_tuples': handler_tuples,
+        'template_loader': load_jinja2_env('./templates'),
+        'db_conn': db_conn,
+        'login_url': '/login',
+        'cookie_secret': 'OMGSOOOOOSECRET',
+        'log_level': logging.DEBUG,
+    }
+
+    return Brubeck(**config)
+
+
+if __name__ == '__main__':
+    # Instantiate app instance
+    app = make_app()
+    app.run()